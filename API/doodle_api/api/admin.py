@@ -1,5 +1,5 @@
 from django.contrib import admin
-from api.models import User, Quiz, QuizQuestion, UserQuizMark, Sketch, DrawnSketch
+from api.models import User, Quiz, QuizQuestion, UserQuizMark, UserScoreSummary, Sketch, DrawnSketch
 
 
 @admin.register(User)
@@ -29,6 +29,12 @@ class UserQuizMarkAdmin(admin.ModelAdmin):
     list_filter = ['quiz']
 
 
+@admin.register(UserScoreSummary)
+class UserScoreSummaryAdmin(admin.ModelAdmin):
+    list_display = ['id', 'user']
+    search_fields = ['user__email']
+
+
 @admin.register(Sketch)
 class SketchAdmin(admin.ModelAdmin):
     list_display = ['id', 'image', 'name']
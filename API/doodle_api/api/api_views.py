@@ -1,48 +1,78 @@
-import os
-import tensorflow as tf
-import keras
-import requests
+import statistics
+from django.conf import settings
+from django.contrib.auth.tokens import default_token_generator
 from django.http import Http404
-from rest_framework.parsers import FileUploadParser, MultiPartParser, FormParser
+from django.urls import reverse
+from rest_framework.parsers import FileUploadParser, MultiPartParser, FormParser, JSONParser
 from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework import status
+from rest_framework.exceptions import PermissionDenied, ValidationError
 from rest_framework import authentication, permissions
 from rest_framework_simplejwt.authentication import JWTTokenUserAuthentication
+from rest_framework_simplejwt.views import TokenObtainPairView
+from djoser.compat import get_user_email
+from djoser.conf import settings as djoser_settings
+from djoser.signals import user_activated
 from api.models import QuizQuestion, Quiz, UserQuizMark, Sketch, DrawnSketch
 from rest_framework import generics
 from api.permissions import IsStaff
-import cv2
-import numpy as np
-from api.serializers import QuizQuestionSerializer, QuizMarksSerializer, SketchSerializer
+from api.serializers import QuizQuestionSerializer, QuizMarksSerializer, SketchSerializer, StrokePredictSerializer, \
+    StaffTokenObtainPairSerializer
 from api.models import User
-from django.conf import settings
+from api.sampling import sample_questions
+from api.grading import SKETCH_CATEGORIES, grade_answers, grade_sketch
+from api.scores import get_quiz_scores
+from api.csv_import import decode_upload, get_import_job, import_questions, start_import_job
+from api.catalog import random_sketch
 
 
 class UserActivationView(APIView):
     """
-        Activates newly registered user by calling '/users/activation/' end point
+        Activates newly registered user the way djoser's '/users/activation/' end point does, in this process
         https://djoser.readthedocs.io/en/latest/base_endpoints.html
     """
 
+    # read by djoser's ActivationSerializer through its 'view' context
+    token_generator = default_token_generator
+
     def get(self, request, uid, token, format=None):
         payload = {
             'uid': uid,
             'token': token
         }
-        # call user activation endpoint
-        url = 'http://localhost:8000/api/auth/users/activation/'
-        response = requests.post(url, data=payload)
+        serializer = djoser_settings.SERIALIZERS.activation(data=payload, context={'request': request, 'view': self})
+
+        try:
+            serializer.is_valid(raise_exception=True)
+        except (ValidationError, PermissionDenied) as e:
+            detail = e.detail if isinstance(e.detail, dict) else {'detail': e.detail}
+            return Response(detail, status=status.HTTP_400_BAD_REQUEST)
+
+        user = serializer.user
+        user.is_active = True
+        user.save()
 
-        if response.status_code == 204:
-            return Response({'detail': 'Account activated successfully!'}, status=status.HTTP_204_NO_CONTENT)
-        else:
-            return Response(response.json(), status=status.HTTP_400_BAD_REQUEST)
+        user_activated.send(sender=self.__class__, user=user, request=request)
+
+        if djoser_settings.SEND_CONFIRMATION_EMAIL:
+            djoser_settings.EMAIL.confirmation(request, {'user': user}).send([get_user_email(user)])
+
+        return Response({'detail': 'Account activated successfully!'}, status=status.HTTP_204_NO_CONTENT)
+
+
+class StaffTokenObtainPairView(TokenObtainPairView):
+    """
+        Replaces djoser's 'api/auth/jwt/create/' so access and refresh tokens carry the is_staff claim
+     """
+
+    serializer_class = StaffTokenObtainPairSerializer
 
 
 class QuizCSVImportAPIView(APIView):
     """
         Populate quiz questions using csv data by calling 'api/upload_csv/'
+        The upload is streamed, validated row by row and inserted in chunks, invalid rows are reported back
      """
 
     authentication_classes = [JWTTokenUserAuthentication]
@@ -64,23 +94,36 @@ class QuizCSVImportAPIView(APIView):
 
             return Response(context, status=status.HTTP_400_BAD_REQUEST)
 
-        import pandas as pd
+        # big files are imported in the background, the response links to their progress
+        if file_obj.size > settings.QUIZ_IMPORT['BACKGROUND_SIZE'] or request.data.get('background') == 'true':
+            job_id = start_import_job(quiz, file_obj)
+            context = {
+                'detail': 'File is being imported!',
+                'job': job_id,
+                'progress': reverse('csv_import_job', kwargs={'job_id': job_id})
+            }
+            return Response(context, status=status.HTTP_202_ACCEPTED)
+
+        report = import_questions(quiz, decode_upload(file_obj))
+        if 'detail' in report:
+            return Response(report, status=status.HTTP_400_BAD_REQUEST)
+        if report['invalid'] and not report['created']:
+            return Response(dict(report, detail='No valid rows!'), status=status.HTTP_400_BAD_REQUEST)
 
-        df = pd.read_csv(file_obj)
-        df.info()
+        return Response(dict(report, detail='File uploaded successfully!'), status=status.HTTP_201_CREATED)
 
-        model_instances = [
-            QuizQuestion(
-                quiz=quiz,
-                question=row[1],
-                image=str(row[2]),
-                dummy_answer1=str(row[3]),
-                dummy_answer2=str(row[4]),
-                answer=str(row[5])
-            ) for row in df.itertuples()]
-        QuizQuestion.objects.bulk_create(model_instances)
 
-        return Response({'detail': 'File uploaded successfully!'}, status=status.HTTP_201_CREATED)
+class QuizCSVImportJobAPIView(APIView):
+    """ QuizCSVImportJobAPIView - progress of a background csv import, see QuizCSVImportAPIView """
+
+    authentication_classes = [JWTTokenUserAuthentication]
+    permission_classes = [permissions.IsAuthenticated, IsStaff]
+
+    def get(self, request, job_id, format=None):
+        job = get_import_job(job_id)
+        if job is None:
+            raise Http404
+        return Response(job)
 
 
 # class QuizQuestionRetrieveAPIView(generics.RetrieveAPIView):
@@ -114,9 +157,7 @@ class QuizQuestionAPIView(APIView):
             Return a 10 questions.
         """
 
-        questions = QuizQuestion.objects.filter(
-            quiz=self.get_object(name)
-        ).order_by('?')[:2]
+        questions = sample_questions(self.get_object(name), k=2)
         questions_serialized = QuizQuestionSerializer(questions, many=True)
 
         return Response(questions_serialized.data)
@@ -138,25 +179,14 @@ class QuizMarksAPIView(APIView):
         """ Calculate marks for a quiz """
 
         quiz = self.get_object(name)
-        user = User.objects.get(id=request.user.id)
 
-        marks = 0
-
-        for answer in request.data:
-            # check if quiz type is correct
-            quiz_type = QuizQuestion.objects.get(id=answer['question']).quiz.name
-
-            if name == quiz_type:
-                actual_answer = QuizQuestion.objects.get(id=answer['question']).answer.lower()
-                given_answer = answer['given_answer'].lower()
-
-                if actual_answer == given_answer:
-                    marks += 1
-            else:
-                return Response({'detail': 'Invalid data!'}, status=status.HTTP_422_UNPROCESSABLE_ENTITY)
+        # graded against the cached answer key of the quiz, no query per answer
+        marks = grade_answers(quiz, request.data)
+        if marks is None:
+            return Response({'detail': 'Invalid data!'}, status=status.HTTP_422_UNPROCESSABLE_ENTITY)
 
         payload = {
-            'user': user,
+            'user': request.user,
             'quiz': quiz,
             'marks': marks
         }
@@ -178,21 +208,21 @@ class ScoreAPIView(APIView):
     authentication_classes = [JWTTokenUserAuthentication]
     permission_classes = [permissions.IsAuthenticated]
 
-    def get_object(self, quiz):
-        try:
-            return Quiz.objects.get(name=quiz)
-        except Quiz.DoesNotExist:
+    def get_scores(self, user):
+        """ Latest and previous marks of every quiz the user took, from their single score summary row """
+
+        scores = get_quiz_scores(user)
+        if scores is None:
             raise Http404
+        return scores
 
-    def get_queryset(self, user, quiz):
+    def get_quiz_score(self, scores, quiz):
         try:
-            obj = UserQuizMark.objects.filter(user=user, quiz=quiz).order_by('timestamp').reverse()[:2]
-        except UserQuizMark.DoesNotExist:
+            return scores[quiz]
+        except KeyError:
             raise Http404
 
-        return obj
-
-    def get_overall_score(self, user):
+    def get_overall_score(self, scores):
         """ Get average score for Iq and Subject quizzes """
 
         quizzes = ['iq', 'math', 'english']
@@ -201,34 +231,22 @@ class ScoreAPIView(APIView):
         new_scores = []
 
         for quiz in quizzes:
-            quiz_obj = self.get_object(quiz)
-            queryset = self.get_queryset(user, quiz_obj)
+            score = self.get_quiz_score(scores, quiz)
 
-            try:
-                new_scores.append(queryset[0].marks)
-                prev_scores.append(queryset[1].marks)
-            except:
-                new_scores.append(queryset[0].marks)
-                prev_scores.append(0)
-
-        import statistics
+            new_scores.append(score['latest'])
+            prev_scores.append(score['previous'] if score['previous'] is not None else 0)
 
         return statistics.mean(prev_scores), statistics.mean(new_scores)
 
-    def get_final_score(self, user):
+    def get_final_score(self, scores):
         """ Get overall score for Iq, subject, speech and draw quiz """
 
-        iq_subject_score = self.get_overall_score(user=user)
+        prev_score, iq_subject_score = self.get_overall_score(scores)
 
-        try:
-            speech_score = UserQuizMark.objects.filter(user=user, quiz=self.get_object('speech_training')).latest(
-                'timestamp').marks
-            drawing_score = UserQuizMark.objects.filter(user=user, quiz=self.get_object('drawing')).latet(
-                'timestamp').marks
-        except UserQuizMark.DoesNotExist:
-            raise Http404
+        speech_score = self.get_quiz_score(scores, 'speech_training')['latest']
+        drawing_score = self.get_quiz_score(scores, 'drawing')['latest']
 
-        avg_speech_drawing_score = speech_score + drawing_score
+        avg_speech_drawing_score = (speech_score + drawing_score) / 2
 
         return (iq_subject_score + avg_speech_drawing_score) / 2
 
@@ -239,9 +257,11 @@ class ScoreAPIView(APIView):
             /quiz_performance/final_score/    - endpoint to get final average score
         """
 
+        scores = self.get_scores(request.user.id)
+
         # if the requested is average of  iq and subject related quiz marks
         if kwargs['slug'] == 'overall_score':
-            prev_score, new_score = self.get_overall_score(request.user.id)
+            prev_score, new_score = self.get_overall_score(scores)
 
             if new_score >= 9:
                 detail = "Your child's performance is very good. You're very lucky to have such a child"
@@ -265,13 +285,13 @@ class ScoreAPIView(APIView):
             }
 
         elif kwargs['slug'] == 'final_score':
-            score = self.get_final_score(user=request.user.id)
+            score = self.get_final_score(scores)
 
             context = {
                 'detail': {
-                    'previous_score': self.get_overall_score(user=request.user.id),
+                    'previous_score': self.get_overall_score(scores),
                     'current_score': {
-                        'score': self.get_final_score(user=request.user.id),
+                        'score': score,
 
                     }
                 }
@@ -284,16 +304,23 @@ class GetSketchAPIView(APIView):
     """ GetSketchAPIView - returns random image to draw """
 
     def get_object(self):
-        return Sketch.objects.order_by('?')[0]
+        sketch = random_sketch()
+        if sketch is None:
+            raise Http404
+        return sketch
 
     def get(self, request, format=None):
-        serializer = SketchSerializer(self.get_object())
-        return Response(serializer.data)
+        return Response(self.get_object())
 
 
+# the inference stack (api.inference, api.preprocessing, api.archive and through them TensorFlow and cv2) is
+# only imported inside the prediction views, workers and manage.py commands that never predict don't load it
+
 class PredictAPIView(APIView):
     """ PredictAPIView - returns predictions for the given sketch """
 
+    categories = SKETCH_CATEGORIES
+
     def get_object(self, **kwargs):
         try:
             obj = Sketch.objects.get(**kwargs)
@@ -301,19 +328,18 @@ class PredictAPIView(APIView):
             raise Http404
         return obj
 
-    def get_processed_input_img(self, image_path, size=64):
-        """ Preprocess user input image to feed to the model """
+    def missing_fields(self, data, files):
+        """ DRF style errors of the sketch_id and image fields missing from an upload, empty if both are there """
 
-        image_path = os.path.join(settings.MEDIA_ROOT, image_path)
-        test_img = cv2.imread(image_path, cv2.IMREAD_GRAYSCALE)
+        return {field: ['This field is required.'] for field, values in [('sketch_id', data), ('image', files)]
+                if field not in values}
 
-        test_img = cv2.resize(test_img, dsize=(64, 64), interpolation=cv2.INTER_CUBIC)
-        thresh = 250
-        test_img = cv2.threshold(test_img, thresh, 255, cv2.THRESH_BINARY)[1]
-        test_img = test_img.reshape((1, size, size, 1)).astype(np.float32)/255
+    def get_processed_input_img(self, image_data, size=64):
+        """ Preprocess user input image bytes to feed to the model """
 
-        print(test_img)
-        return test_img
+        from api.preprocessing import decode_sketch
+
+        return decode_sketch(image_data, size=size)
 
     def save_drawing_score(self, user, quiz, marks):
         """ Stores the marks for a quiz """
@@ -321,51 +347,109 @@ class PredictAPIView(APIView):
         obj = UserQuizMark.objects.create(user=user, quiz=quiz, marks=marks*10)
         return obj
 
+    def score_prediction(self, user, sketch_name, top_3):
+        """ Grades the top 3 predictions against the requested sketch and records the marks """
+
+        score, similarity = grade_sketch(sketch_name.name, top_3)
+
+        # save record
+        marks = self.save_drawing_score(user, Quiz.objects.get(name='drawing'), score)
+
+        context = {
+            'score': score,
+            'detail': similarity
+        }
+
+        return marks, context
+
     def post(self, request, format=None):
+        from api.archive import archive_drawing
+        from api.inference import predictor
+
+        errors = self.missing_fields(request.POST, request.FILES)
+        if errors:
+            return Response(errors, status=status.HTTP_400_BAD_REQUEST)
+
         sketch_name = self.get_object(id=request.POST['sketch_id'])
 
         image = request.FILES['image']
+        image_data = image.read()
 
         user = User.objects.get(id=1)
 
-        sketch_obj = DrawnSketch.objects.create(user=user, image=request.FILES['image'], image_name=sketch_name)
-        path = str(sketch_obj.image.name)
-        sketch = self.get_processed_input_img(path)
+        try:
+            sketch = self.get_processed_input_img(image_data)
+        except ValueError:
+            return Response({'detail': 'Invalid image!'}, status=status.HTTP_400_BAD_REQUEST)
 
-        reconstructed_model = keras.models.load_model('static/model/doodle_cnn/model.h5', compile=False)
-        pred = reconstructed_model.predict(sketch)
-        # print('\n\n\npredictions: ',  reconstructed_model.predict_proba(sketch))
-        top_3 = np.argsort(-pred)[:, 0:3].ravel()
+        top_3 = predictor.predict(sketch)
+        marks, context = self.score_prediction(user, sketch_name, top_3)
 
-        print('\n\n\n\n\nTop 3: ', top_3, '\n\n ravel:', top_3.ravel())
+        # keep the drawing for later re-scoring without making the client wait on the file write
+        archive_drawing(user, sketch_name, image_data, image.name, marks)
 
-        # categories = ['airplane', 'apple', 'bus', 'flower', 'pineapple']
-        # categories = ['airplane', 'alarm clock', 'ant', 'apple', 'bus', 'dog', 'face', 'fish', 'flower', 'ice cream']
-        categories = ['airplane', 'ant', 'apple', 'bus', 'face', 'fish', 'guitar', 'scissors', 'sun', 't-shirt']
+        return Response(context, status=status.HTTP_201_CREATED)
 
-        sketch_index = categories.index(sketch_name.name.lower())
 
-        print('\n\n\n', sketch_index)
+class PredictStrokesAPIView(PredictAPIView):
+    """
+        PredictStrokesAPIView - returns predictions for a sketch sent as QuickDraw strokes
+        Expects {"sketch_id": 1, "drawing": [[[x0, x1, ...], [y0, y1, ...]], ...]}
+    """
 
-        if sketch_index == top_3[0]:
-            score = 0.8
-            similarity = 'Similarity above 80%'
-        elif sketch_index == top_3[1]:
-            score = 0.6
-            similarity = 'Similarity above 60%'
-        elif sketch_index == top_3[2]:
-            score = 0.4
-            similarity = 'Similarity above 40%'
-        else:
-            score = 0.2
-            similarity = 'Similarity bellow 40%'
+    parser_classes = [JSONParser]
 
-        # save record
-        self.save_drawing_score(user, Quiz.objects.get(name='drawing'), score)
+    def post(self, request, format=None):
+        from api.archive import archive_strokes
+        from api.inference import predictor
+        from api.preprocessing import rasterize_strokes
 
-        context = {
-            'score': score,
-            'detail': similarity
-        }
+        serializer = StrokePredictSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+
+        sketch_name = self.get_object(id=serializer.validated_data['sketch_id'])
+        drawing = serializer.validated_data['drawing']
+
+        user = User.objects.get(id=1)
+
+        sketch = rasterize_strokes(drawing)
+
+        top_3 = predictor.predict(sketch)
+        marks, context = self.score_prediction(user, sketch_name, top_3)
+
+        archive_strokes(user, sketch_name, drawing, marks)
 
         return Response(context, status=status.HTTP_201_CREATED)
+
+
+class ModelReadinessAPIView(APIView):
+    """
+        ModelReadinessAPIView - readiness probe for the load balancer
+        Returns 200 once the doodle CNN is loaded and warmed up in this worker, 503 until then
+    """
+
+    authentication_classes = []
+    permission_classes = [permissions.AllowAny]
+
+    def get(self, request, format=None):
+        from api.inference import doodle_model
+
+        if doodle_model.is_ready():
+            return Response({'ready': True})
+
+        # nothing may have triggered the lazy load yet, kick it off so the worker eventually becomes ready
+        doodle_model.load_async()
+
+        return Response({'ready': False}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
+
+
+class InferenceStatsAPIView(APIView):
+    """ InferenceStatsAPIView - batch size and queue wait histograms of the prediction batcher, cache hit rate """
+
+    authentication_classes = [JWTTokenUserAuthentication]
+    permission_classes = [permissions.IsAuthenticated, IsStaff]
+
+    def get(self, request, format=None):
+        from api.inference import predictor
+
+        return Response(predictor.stats())
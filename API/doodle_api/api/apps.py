@@ -1,6 +1,20 @@
 from django.apps import AppConfig
+from django.conf import settings
 
 
 class ApiConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'api'
+
+    def ready(self):
+        # keeps the cached question pools, sketch catalog and score summaries in step with writes
+        from api import signals  # noqa: F401
+
+        # warns on `check --deploy` when workers would not share the cache
+        from api import checks  # noqa: F401
+
+        # warm the doodle CNN in the background so workers report ready only once it can serve predictions
+        if settings.DOODLE_MODEL['PRELOAD']:
+            from api.inference import doodle_model
+
+            doodle_model.load_async()
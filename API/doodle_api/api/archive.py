@@ -0,0 +1,44 @@
+import logging
+from concurrent.futures import ThreadPoolExecutor
+import cv2
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.db import close_old_connections
+from api.models import DrawnSketch
+from doodle_data.rasterizer import render
+
+logger = logging.getLogger(__name__)
+
+# a single writer keeps archival from competing with requests for the database
+_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='sketch-archive')
+
+# upload name of the rendered copy of a stroke upload
+STROKES_IMAGE_NAME = 'strokes.png'
+
+
+def _archive_drawing(user, sketch, image_data, image_name, marks, strokes=None):
+    try:
+        DrawnSketch.objects.create(user=user, image=ContentFile(image_data, name=image_name),
+                                   image_name=sketch, marks=marks, strokes=strokes)
+    except Exception:
+        logger.exception('Failed to archive drawing of %s for %s', sketch, user)
+    finally:
+        close_old_connections()
+
+
+def archive_drawing(user, sketch, image_data, image_name, marks=None):
+    """ Stores a drawn sketch as a DrawnSketch in the background, off the request's latency path """
+
+    return _executor.submit(_archive_drawing, user, sketch, image_data, image_name, marks)
+
+
+def _archive_strokes(user, sketch, drawing, marks):
+    # keep the archived copy at the full 256x256 QuickDraw resolution
+    img = render(drawing, size=256, lw=settings.DOODLE_MODEL['LINE_WIDTH'], backend=settings.DOODLE_MODEL['RENDERER'])
+    _archive_drawing(user, sketch, cv2.imencode('.png', img)[1].tobytes(), STROKES_IMAGE_NAME, marks, drawing)
+
+
+def archive_strokes(user, sketch, drawing, marks=None):
+    """ Stores a stroke upload as a DrawnSketch with its strokes and a PNG rendering, in the background """
+
+    return _executor.submit(_archive_strokes, user, sketch, drawing, marks)
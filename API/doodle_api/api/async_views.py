@@ -0,0 +1,107 @@
+"""
+    Async variants of the predict and sketch endpoints, served under ASGI (doodle_api/asgi.py)
+
+    The event loop only awaits: upload parsing and the ORM calls run through sync_to_async, sketch decoding
+    on a bounded thread pool and inference on the prediction batcher's worker. A waiting upload holds no
+    thread, and once ASYNC_MAX_PENDING predictions are in flight new ones get a 429 with Retry-After
+    instead of piling up. Like the sync views they import the inference stack on first use.
+"""
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.http import JsonResponse
+from api.api_views import PredictAPIView
+from api.catalog import random_sketch
+from api.models import Sketch, User
+
+_executor = ThreadPoolExecutor(max_workers=settings.DOODLE_MODEL['ASYNC_WORKERS'],
+                               thread_name_prefix='async-predict')
+_slots = threading.BoundedSemaphore(settings.DOODLE_MODEL['ASYNC_MAX_PENDING'])
+
+# scoring and recording marks is shared with the sync view, it uses no request state
+_scorer = PredictAPIView()
+
+
+async def _run(func, *args):
+    return await asyncio.wrap_future(_executor.submit(func, *args))
+
+
+@sync_to_async(thread_sensitive=False)
+def _parse_upload(request):
+    # request.POST / request.FILES read and parse the whole multipart body
+    return request.POST, request.FILES
+
+
+def _read_sketch(image):
+    from api.preprocessing import decode_sketch
+
+    image_data = image.read()
+    # decode_sketch reuses this thread's buffer for the next upload, while this one may still wait for its batch
+    return image_data, decode_sketch(image_data).copy()
+
+
+def _busy():
+    response = JsonResponse({'detail': 'Too many predictions in progress, try again shortly!'}, status=429)
+    response['Retry-After'] = str(settings.DOODLE_MODEL['ASYNC_RETRY_AFTER'])
+    return response
+
+
+async def predict(request):
+    """ Async PredictAPIView - returns predictions for the given sketch """
+
+    from api.archive import archive_drawing
+    from api.inference import predictor
+
+    if request.method != 'POST':
+        return JsonResponse({'detail': 'Method "{}" not allowed.'.format(request.method)}, status=405)
+
+    # admission control, the slot is held until the prediction is done
+    if not _slots.acquire(blocking=False):
+        return _busy()
+
+    try:
+        data, files = await _parse_upload(request)
+        errors = _scorer.missing_fields(data, files)
+        if errors:
+            return JsonResponse(errors, status=400)
+
+        try:
+            sketch_name = await sync_to_async(Sketch.objects.get)(id=data['sketch_id'])
+        except (Sketch.DoesNotExist, ValueError):
+            return JsonResponse({'detail': 'Not found.'}, status=404)
+
+        image = files['image']
+        try:
+            image_data, sketch = await _run(_read_sketch, image)
+        except ValueError:
+            return JsonResponse({'detail': 'Invalid image!'}, status=400)
+
+        top_3 = await asyncio.wrap_future(predictor.submit(sketch))
+    finally:
+        _slots.release()
+
+    user = await sync_to_async(User.objects.get)(id=1)
+    marks, context = await sync_to_async(_scorer.score_prediction)(user, sketch_name, top_3)
+
+    archive_drawing(user, sketch_name, image_data, image.name, marks)
+
+    return JsonResponse(context, status=201)
+
+
+async def sketch(request):
+    """ Async GetSketchAPIView - returns random image to draw """
+
+    if request.method != 'GET':
+        return JsonResponse({'detail': 'Method "{}" not allowed.'.format(request.method)}, status=405)
+
+    data = await sync_to_async(random_sketch)()
+    if data is None:
+        return JsonResponse({'detail': 'Not found.'}, status=404)
+    return JsonResponse(data)
+
+
+# like DRF's APIView these are token / anonymous endpoints, csrf_exempt() would turn them into sync views
+predict.csrf_exempt = True
+sketch.csrf_exempt = True
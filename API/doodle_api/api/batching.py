@@ -0,0 +1,129 @@
+import bisect
+import queue
+import threading
+import time
+from concurrent.futures import Future
+import numpy as np
+
+
+class Histogram:
+    """ Histogram - thread-safe fixed-bucket histogram for tuning the batcher """
+
+    def __init__(self, bounds):
+        self.bounds = list(bounds)
+        self._counts = [0] * (len(self.bounds) + 1)
+        self._total = 0
+        self._sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        with self._lock:
+            self._counts[bisect.bisect_left(self.bounds, value)] += 1
+            self._total += 1
+            self._sum += value
+
+    def snapshot(self):
+        """ Returns the bucket counts keyed by their upper bound ('+Inf' for the overflow bucket) """
+
+        with self._lock:
+            buckets = {str(bound): count for bound, count in zip(self.bounds, self._counts)}
+            buckets['+Inf'] = self._counts[-1]
+
+            return {
+                'count': self._total,
+                'mean': self._sum / self._total if self._total else 0,
+                'buckets': buckets,
+            }
+
+
+class MicroBatcher:
+    """
+        MicroBatcher - runs concurrent single-sketch predictions as one batched forward pass
+
+        Callers submit a (1, 64, 64, 1) tensor and block on their own future. A single worker thread collects
+        requests until either max_batch_size is reached or the oldest request has waited max_wait_ms, then calls
+        predict_fn once on the stacked batch and hands every caller the top_k class indices of its own row.
+        Batching only pays off when the process serves requests concurrently (threaded runserver, gthread/ASGI).
+    """
+
+    def __init__(self, predict_fn, max_batch_size=32, max_wait_ms=5, top_k=3):
+        self.predict_fn = predict_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.top_k = top_k
+
+        self.batch_sizes = Histogram([1, 2, 4, 8, 16, 32, 64, 128])
+        self.queue_wait_ms = Histogram([0.5, 1, 2, 5, 10, 20, 50, 100, 250])
+
+        self._queue = queue.Queue()
+        self._worker = None
+        self._start_lock = threading.Lock()
+
+    def _ensure_worker(self):
+        if self._worker is None:
+            with self._start_lock:
+                if self._worker is None:
+                    self._worker = threading.Thread(target=self._run, name='doodle-micro-batcher', daemon=True)
+                    self._worker.start()
+
+    def submit(self, tensor):
+        """ Queues a single sketch tensor and returns a future resolving to its top_k class indices """
+
+        self._ensure_worker()
+
+        future = Future()
+        self._queue.put((tensor, future, time.monotonic()))
+        return future
+
+    def predict(self, tensor, timeout=None):
+        """ Returns the top_k class indices for a single sketch tensor, waiting for its batch to run """
+
+        return self.submit(tensor).result(timeout=timeout)
+
+    def _collect(self):
+        """ Blocks for the first request, then drains the queue until the batch is full or the wait is over """
+
+        batch = [self._queue.get()]
+        deadline = batch[0][2] + self.max_wait
+
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                # requests that queued up while the previous batch ran are taken without waiting any longer
+                if remaining > 0:
+                    batch.append(self._queue.get(timeout=remaining))
+                else:
+                    batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+
+            started = time.monotonic()
+            self.batch_sizes.observe(len(batch))
+            for _, _, enqueued in batch:
+                self.queue_wait_ms.observe((started - enqueued) * 1000)
+
+            try:
+                pred = self.predict_fn(np.concatenate([tensor for tensor, _, _ in batch], axis=0))
+                top_k = np.argsort(-pred, axis=1)[:, 0:self.top_k]
+            except Exception as exc:
+                for _, future, _ in batch:
+                    future.set_exception(exc)
+                continue
+
+            for row, (_, future, _) in zip(top_k, batch):
+                future.set_result(row)
+
+    def stats(self):
+        return {
+            'max_batch_size': self.max_batch_size,
+            'max_wait_ms': self.max_wait * 1000,
+            'queued': self._queue.qsize(),
+            'batch_size': self.batch_sizes.snapshot(),
+            'queue_wait_ms': self.queue_wait_ms.snapshot(),
+        }
@@ -0,0 +1,55 @@
+import threading
+import uuid
+from django.core.cache import cache
+from django.db import transaction
+
+
+class ProcessLocalCache:
+    """
+        ProcessLocalCache - values built once per worker process and invalidated across processes
+
+        Every value is kept in this process together with the version stamp it was built under. The stamps
+        live in the Django cache, so invalidate() in any process makes every process rebuild on its next
+        get(), at the price of a single cache read per lookup. Inside a transaction the stamp only changes once
+        it commits.
+    """
+
+    def __init__(self, name, build):
+        self.name = name
+        self.build = build
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _version_key(self, key):
+        return 'api:{}:{}:version'.format(self.name, key)
+
+    def _version(self, key):
+        version = cache.get(self._version_key(key))
+        if version is None:
+            # first use or evicted stamp, add() keeps a concurrently set stamp instead of overwriting it
+            cache.add(self._version_key(key), uuid.uuid4().hex, timeout=None)
+            version = cache.get(self._version_key(key))
+        return version
+
+    def get(self, key=None):
+        version = self._version(key)
+
+        entry = self._values.get(key)
+        if entry is not None and entry[0] == version:
+            return entry[1]
+
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None or entry[0] != version:
+                entry = (version, self.build(key))
+                self._values[key] = entry
+        return entry[1]
+
+    def _bump(self, key):
+        cache.set(self._version_key(key), uuid.uuid4().hex, timeout=None)
+        self._values.pop(key, None)
+
+    def invalidate(self, key=None):
+        # a stamp bumped before the commit lets another process rebuild from the rows as they were before the
+        # write and keep that value under the new stamp
+        transaction.on_commit(lambda: self._bump(key))
@@ -0,0 +1,19 @@
+import random
+from api.caching import ProcessLocalCache
+from api.models import Sketch
+from api.serializers import SketchSerializer
+
+
+def _sketches(key=None):
+    return SketchSerializer(Sketch.objects.order_by('id'), many=True).data
+
+
+# serialized sketches (id, name, image url), rebuilt after api.signals invalidates it
+sketch_catalog = ProcessLocalCache('sketches', _sketches)
+
+
+def random_sketch():
+    """ Serialized random sketch to draw, or None while there are no sketches """
+
+    sketches = sketch_catalog.get()
+    return random.choice(sketches) if sketches else None
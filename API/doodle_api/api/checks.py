@@ -0,0 +1,24 @@
+from django.conf import settings
+from django.core.checks import Warning, register
+
+# backends that keep their entries inside one process
+PROCESS_LOCAL_CACHES = {
+    'django.core.cache.backends.locmem.LocMemCache',
+    'django.core.cache.backends.dummy.DummyCache',
+}
+
+
+@register(deploy=True)
+def check_shared_cache(app_configs, **kwargs):
+    """ Version stamps of api.caching and background csv import jobs reach every worker only through a shared cache """
+
+    if settings.CACHES['default']['BACKEND'] not in PROCESS_LOCAL_CACHES:
+        return []
+
+    return [Warning(
+        'The default cache is local to each process.',
+        hint='With several worker processes, set CACHE_BACKEND to a shared cache such as memcached or redis. Otherwise '
+             'question and answer key changes reach other workers only when they restart, and background csv '
+             'import progress polled from another worker answers 404.',
+        id='api.W001',
+    )]
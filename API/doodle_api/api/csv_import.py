@@ -0,0 +1,146 @@
+import codecs
+import csv
+import logging
+import os
+import tempfile
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+from django.core.cache import cache
+from django.db import close_old_connections, transaction
+from api.models import QuizQuestion
+from api.signals import invalidate_quiz_questions
+
+logger = logging.getLogger(__name__)
+
+# csv columns in order, after the header row
+COLUMNS = ['question', 'image', 'dummy_answer1', 'dummy_answer2', 'answer']
+REQUIRED = {'question', 'dummy_answer1', 'dummy_answer2', 'answer'}
+
+# one import at a time, a background import never competes with itself for the database
+_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='csv-import')
+
+JOB_TIMEOUT = 60 * 60 * 24
+
+
+def validate_row(values):
+    """ Returns (QuizQuestion field values, list of errors) of one csv row """
+
+    if len(values) < len(COLUMNS):
+        return None, ['expected {} columns, got {}'.format(len(COLUMNS), len(values))]
+
+    fields = {column: value.strip() for column, value in zip(COLUMNS, values)}
+    errors = []
+    for column, value in fields.items():
+        max_length = QuizQuestion._meta.get_field(column).max_length
+        if column in REQUIRED and not value:
+            errors.append('{} is required'.format(column))
+        elif len(value) > max_length:
+            errors.append('{} is longer than {} characters'.format(column, max_length))
+
+    return fields, errors
+
+
+def import_questions(quiz, lines, chunk_size=None, max_errors=None, progress=None):
+    """
+        Streams csv lines (str) into QuizQuestions of a quiz
+
+        Rows are validated one by one and inserted in chunk_size transactions, so memory stays flat however
+        big the file is. Invalid rows are skipped and reported, at most max_errors of them in detail.
+        progress(report) is called after every chunk. A line that is not UTF-8 ends the import, the rows before
+        it are kept and report['detail'] tells where it stopped.
+    """
+
+    chunk_size = chunk_size or settings.QUIZ_IMPORT['CHUNK_SIZE']
+    max_errors = settings.QUIZ_IMPORT['MAX_ERRORS'] if max_errors is None else max_errors
+
+    report = {'rows': 0, 'created': 0, 'invalid': 0, 'errors': []}
+    chunk = []
+
+    def flush():
+        with transaction.atomic():
+            QuizQuestion.objects.bulk_create(chunk)
+            # bulk_create sends no post_save signals, the caches are invalidated once the chunk commits
+            invalidate_quiz_questions(quiz.id)
+        report['created'] += len(chunk)
+        chunk.clear()
+
+        if progress is not None:
+            progress(report)
+
+    reader = csv.reader(lines)
+    next(reader, None)  # header
+
+    try:
+        for values in reader:
+            if not any(value.strip() for value in values):
+                continue
+
+            report['rows'] += 1
+            fields, errors = validate_row(values)
+            if errors:
+                report['invalid'] += 1
+                if len(report['errors']) < max_errors:
+                    report['errors'].append({'line': reader.line_num, 'errors': errors})
+                continue
+
+            chunk.append(QuizQuestion(quiz=quiz, **fields))
+            if len(chunk) >= chunk_size:
+                flush()
+    except UnicodeDecodeError:
+        report['detail'] = 'Line {} is not UTF-8 encoded, the rest of the file was not imported!'.format(
+            reader.line_num + 1)
+
+    if chunk:
+        flush()
+    return report
+
+
+def decode_upload(file_obj):
+    """ Lines of an uploaded csv decoded on the fly, without reading the whole upload """
+
+    return codecs.iterdecode(file_obj, 'utf-8-sig')
+
+
+def _job_key(job_id):
+    return 'api:csv-import:{}'.format(job_id)
+
+
+def get_import_job(job_id):
+    return cache.get(_job_key(job_id))
+
+
+def _run_import_job(job_id, quiz, path):
+    def save(report, status, **extra):
+        cache.set(_job_key(job_id), dict(report, status=status, quiz=quiz.name, **extra), JOB_TIMEOUT)
+
+    report = {'rows': 0, 'created': 0, 'invalid': 0, 'errors': []}
+    try:
+        save(report, 'running')
+        with open(path, 'rb') as f:
+            report = import_questions(quiz, decode_upload(f), progress=lambda report: save(report, 'running'))
+        save(report, 'failed' if 'detail' in report else 'done')
+    except Exception as e:
+        logger.exception('Quiz csv import %s failed', job_id)
+        # rows of the chunks committed before the failure stay imported
+        save(get_import_job(job_id) or report, 'failed', detail=str(e))
+    finally:
+        os.remove(path)
+        close_old_connections()
+
+
+def start_import_job(quiz, file_obj):
+    """
+        Imports an upload in the background and returns the job id, poll get_import_job for its progress
+
+        The upload is spooled to a temporary file first, Django removes its own copy when the request ends.
+    """
+
+    job_id = uuid.uuid4().hex
+    with tempfile.NamedTemporaryFile(suffix='.csv', delete=False) as f:
+        for data in file_obj.chunks():
+            f.write(data)
+
+    cache.set(_job_key(job_id), {'status': 'pending', 'quiz': quiz.name}, JOB_TIMEOUT)
+    _executor.submit(_run_import_job, job_id, quiz, f.name)
+    return job_id
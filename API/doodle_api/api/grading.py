@@ -0,0 +1,59 @@
+from api.caching import ProcessLocalCache
+from api.models import QuizQuestion
+
+
+def _answer_key(quiz_id):
+    return {pk: answer.lower() for pk, answer in QuizQuestion.objects.filter(quiz_id=quiz_id).values_list('id', 'answer')}
+
+
+# question id -> lower-cased answer of every quiz, rebuilt after api.signals or the csv import invalidate the quiz
+answer_keys = ProcessLocalCache('answer-keys', _answer_key)
+
+
+def grade_answers(quiz, answers):
+    """
+        Counts the correct answers of a submission, [{'question': id, 'given_answer': str}, ...]
+
+        Returns None when the submission is malformed or any question is not part of the quiz.
+    """
+
+    if not isinstance(answers, list):
+        return None
+
+    answer_key = answer_keys.get(quiz.id)
+
+    marks = 0
+    for answer in answers:
+        if not isinstance(answer, dict) or not isinstance(answer.get('given_answer'), str):
+            return None
+        try:
+            actual_answer = answer_key.get(int(answer.get('question')))
+        except (TypeError, ValueError):
+            return None
+        if actual_answer is None:
+            return None
+
+        if actual_answer == answer['given_answer'].lower():
+            marks += 1
+
+    return marks
+
+
+# classes of the served doodle CNN, in the order of its outputs
+# SKETCH_CATEGORIES = ['airplane', 'apple', 'bus', 'flower', 'pineapple']
+# SKETCH_CATEGORIES = ['airplane', 'alarm clock', 'ant', 'apple', 'bus', 'dog', 'face', 'fish', 'flower', 'ice cream']
+SKETCH_CATEGORIES = ['airplane', 'ant', 'apple', 'bus', 'face', 'fish', 'guitar', 'scissors', 'sun', 't-shirt']
+
+
+def grade_sketch(sketch_name, top_3):
+    """ Returns (score, similarity) of a drawing of sketch_name from the model's top 3 class indices """
+
+    sketch_index = SKETCH_CATEGORIES.index(sketch_name.lower())
+
+    if sketch_index == top_3[0]:
+        return 0.8, 'Similarity above 80%'
+    elif sketch_index == top_3[1]:
+        return 0.6, 'Similarity above 60%'
+    elif sketch_index == top_3[2]:
+        return 0.4, 'Similarity above 40%'
+    return 0.2, 'Similarity bellow 40%'
@@ -0,0 +1,126 @@
+import logging
+import threading
+import numpy as np
+from django.conf import settings
+from doodle_data.backends import get_backend
+from api.batching import MicroBatcher
+from api.inference_pool import InferencePoolClient
+from api.prediction_cache import CachedPredictor, PredictionCache
+
+logger = logging.getLogger(__name__)
+
+
+class ModelRegistry:
+    """
+        ModelRegistry - keeps the doodle CNN resident for the lifetime of the process
+
+        The model is loaded once (lazily on first use, or eagerly from ApiConfig.ready()), warmed up with a
+        dummy prediction and then shared by every request handled by the process. The backend (doodle_data.backends)
+        decides what runs it, the Keras model or its quantized TFLite export.
+    """
+
+    def __init__(self, backend, input_shape=(64, 64, 1)):
+        self.backend = backend
+        self.input_shape = input_shape
+        self._model = None
+        self._ready = threading.Event()
+        self._load_lock = threading.Lock()
+        self._predict_lock = threading.Lock()
+        self._loader = None
+
+    def load(self):
+        """ Returns the loaded model, loading and warming it up on first call """
+
+        if self._model is None:
+            with self._load_lock:
+                if self._model is None:
+                    self.backend.load()
+
+                    # the first predict call builds the predict function, pay for it before serving traffic
+                    self.backend.predict(np.zeros((1,) + tuple(self.input_shape), dtype=np.float32))
+
+                    self._model = self.backend
+                    self._ready.set()
+        return self._model
+
+    @property
+    def version(self):
+        """ Version of the loaded artifact (see doodle_data.backends), None until it is loaded """
+
+        model = self._model
+        return model.version if model is not None else None
+
+    def _load_in_background(self):
+        try:
+            self.load()
+        except Exception:
+            logger.exception('Failed to load the doodle model from %s', getattr(self.backend, 'path', self.backend))
+        finally:
+            # a failed load is retried by the next load_async(), e.g. from the next readiness probe
+            with self._load_lock:
+                self._loader = None
+
+    def load_async(self):
+        """ Starts loading the model in a background thread, if it isn't loaded or loading already """
+
+        with self._load_lock:
+            if self._loader is None and self._model is None:
+                self._loader = threading.Thread(target=self._load_in_background, name='doodle-model-loader',
+                                                daemon=True)
+                self._loader.start()
+
+    def is_ready(self):
+        """ True once the model is loaded and warmed up """
+
+        return self._ready.is_set()
+
+    def predict(self, batch):
+        """ Runs the model on a (N, 64, 64, 1) batch and returns the class probabilities """
+
+        model = self.load()
+        with self._predict_lock:
+            return model.predict(batch)
+
+
+def model_path():
+    return settings.DOODLE_MODEL['TFLITE_PATH' if settings.DOODLE_MODEL['BACKEND'] == 'tflite' else 'PATH']
+
+
+def model_backend():
+    """ The backend of the served model, as configured by DOODLE_MODEL """
+
+    return get_backend(settings.DOODLE_MODEL['BACKEND'], model_path(), num_threads=settings.DOODLE_MODEL['NUM_THREADS'])
+
+
+def model_version():
+    """
+        Version of the model doodle_model serves, so results never outlive a model update
+
+        Loads the model first, or asks the inference pool, whose workers report the artifact they loaded.
+    """
+
+    doodle_model.load()
+    return doodle_model.version
+
+
+# with an inference pool (manage.py run_inference_pool) the model lives in the pool's processes only
+if settings.DOODLE_MODEL['POOL_SOCKET']:
+    doodle_model = InferencePoolClient(settings.DOODLE_MODEL['POOL_SOCKET'],
+                                       timeout=settings.DOODLE_MODEL['POOL_TIMEOUT'])
+else:
+    doodle_model = ModelRegistry(model_backend())
+
+predictor = MicroBatcher(
+    doodle_model.predict,
+    max_batch_size=settings.DOODLE_MODEL['MAX_BATCH_SIZE'],
+    max_wait_ms=settings.DOODLE_MODEL['MAX_WAIT_MS'],
+)
+
+if settings.DOODLE_MODEL['CACHE_SIZE']:
+    predictor = CachedPredictor(
+        predictor,
+        PredictionCache(settings.DOODLE_MODEL['CACHE_SIZE'], settings.DOODLE_MODEL['CACHE_TTL']),
+        # read on every lookup, it is None until the model is loaded and changes once the inference pool serves
+        # another artifact (its workers reload after a restart)
+        version=lambda: doodle_model.version,
+    )
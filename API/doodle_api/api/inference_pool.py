@@ -0,0 +1,225 @@
+"""
+    A local inference service: a fixed pool of worker processes that own the doodle CNN, fed over a Unix socket
+
+    The pool (`python manage.py run_inference_pool`) binds one socket, then forks workers that each load the
+    model and take turns accepting connections on it. Web workers send their micro batches through
+    InferencePoolClient, one connection per batch. This way the model is held by the pool's processes only,
+    and any number of web processes share them.
+
+    The pool runs on Linux: it needs Unix domain sockets and the fork start method, serve() and the management
+    command refuse to start without them (Windows has neither).
+
+    Tensors cross the socket as raw float32 bytes, nothing is pickled:
+        request   !I batch size n, then n * 64 * 64 * 1 float32    (n = 0 is a readiness ping)
+        response  !III n, classes, length of the version, then the utf-8 model version of the worker
+                  and n * classes float32 probabilities
+        error     !III ERROR, length of the message, 0, then the utf-8 message
+"""
+import logging
+import multiprocessing
+import multiprocessing.connection
+import os
+import signal
+import socket
+import struct
+import time
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+REQUEST = struct.Struct('!I')
+RESPONSE = struct.Struct('!III')
+ERROR = 0xFFFFFFFF
+
+# a worker that dies straight away (missing model file, out of memory) is not restarted in a tight loop
+RESTART_DELAY = 1
+
+# readiness probes should not hang while every worker is still loading its model
+PING_TIMEOUT = 1
+
+# workers inherit the bound listening socket through fork
+SUPPORTED = hasattr(socket, 'AF_UNIX') and 'fork' in multiprocessing.get_all_start_methods()
+UNSUPPORTED_MESSAGE = 'The inference pool needs Unix domain sockets and the fork start method, run it on Linux'
+
+
+def _recv_into(sock, view):
+    while len(view):
+        received = sock.recv_into(view)
+        if not received:
+            raise ConnectionError('Inference pool connection closed mid message')
+        view = view[received:]
+
+
+def _recv(sock, size):
+    data = bytearray(size)
+    _recv_into(sock, memoryview(data))
+    return data
+
+
+def _handle(conn, model, input_shape):
+    n, = REQUEST.unpack(_recv(conn, REQUEST.size))
+    version = model.version.encode('utf-8')
+    if n == 0:
+        conn.sendall(RESPONSE.pack(0, 0, len(version)) + version)
+        return
+
+    batch = np.empty((n,) + tuple(input_shape), dtype=np.float32)
+    _recv_into(conn, memoryview(batch).cast('B'))
+
+    try:
+        pred = np.ascontiguousarray(model.predict(batch), dtype=np.float32)
+    except Exception as e:
+        logger.exception('Inference pool prediction failed')
+        message = str(e).encode('utf-8')
+        conn.sendall(RESPONSE.pack(ERROR, len(message), 0) + message)
+        return
+
+    conn.sendall(RESPONSE.pack(*pred.shape, len(version)) + version)
+    conn.sendall(memoryview(pred).cast('B'))
+
+
+def _worker(listener, load_model, input_shape):
+    # the parent handles shutdown, a ^C in the terminal reaches the whole process group
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+    model = load_model()
+    model.load()
+    logger.info('Inference worker %s ready', os.getpid())
+
+    while True:
+        conn, _ = listener.accept()
+        with conn:
+            try:
+                _handle(conn, model, input_shape)
+            except (ConnectionError, OSError):
+                # the client gave up (timeout) or went away, its batch has already failed on its side
+                pass
+
+
+def serve(socket_path, workers, load_model, input_shape=(64, 64, 1), backlog=128):
+    """
+        Runs the pool until SIGTERM / SIGINT, restarting workers that die
+
+        load_model() is called in every worker and returns an object with load(), predict(batch) and the version
+        of the loaded model, see api.inference.ModelRegistry. It runs after the fork, the parent never imports
+        the model runtime. A restarted worker loads the artifact again and reports its new version.
+    """
+
+    if not SUPPORTED:
+        raise RuntimeError(UNSUPPORTED_MESSAGE)
+
+    if os.path.exists(socket_path):
+        os.unlink(socket_path)
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(socket_path)
+    listener.listen(backlog)
+
+    context = multiprocessing.get_context('fork')
+
+    def start():
+        process = context.Process(target=_worker, args=(listener, load_model, input_shape), daemon=True)
+        process.start()
+        return process
+
+    stopping = []
+
+    def stop(signum, frame):
+        stopping.append(signum)
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    processes = [start() for _ in range(workers)]
+    try:
+        while not stopping:
+            multiprocessing.connection.wait([process.sentinel for process in processes], timeout=1)
+            dead = [i for i, process in enumerate(processes) if not process.is_alive()]
+            if not dead or stopping:
+                continue
+
+            time.sleep(RESTART_DELAY)
+            for i in dead:
+                logger.warning('Inference worker %s exited with %s, restarting', processes[i].pid,
+                               processes[i].exitcode)
+                processes[i] = start()
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.join()
+        listener.close()
+        os.unlink(socket_path)
+
+
+class InferencePoolClient:
+    """
+        InferencePoolClient - stands in for ModelRegistry in web workers when an inference pool serves the model
+
+        predict(batch) sends the batch to the pool and returns its class probabilities, so it plugs into the
+        MicroBatcher like ModelRegistry.predict does. Nothing is loaded in the calling process. version is the
+        model version reported by the pool worker that answered last, None before any did.
+    """
+
+    def __init__(self, socket_path, timeout=10, input_shape=(64, 64, 1)):
+        self.socket_path = socket_path
+        self.timeout = timeout
+        self.input_shape = input_shape
+        self.version = None
+
+    def _connect(self, timeout):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(timeout)
+        try:
+            sock.connect(self.socket_path)
+        except OSError:
+            sock.close()
+            raise
+        return sock
+
+    def load(self):
+        """ Loads nothing, but fails unless a pool worker answers, which also reports the model version """
+
+        if not self.is_ready():
+            raise ConnectionError('No inference pool worker answers on {}'.format(self.socket_path))
+        return self
+
+    def load_async(self):
+        pass
+
+    def is_ready(self):
+        """ True once a pool worker answers a ping, workers only accept connections once their model is loaded """
+
+        try:
+            with self._connect(PING_TIMEOUT) as sock:
+                sock.sendall(REQUEST.pack(0))
+                n, classes, version_length = RESPONSE.unpack(_recv(sock, RESPONSE.size))
+                if (n, classes) != (0, 0):
+                    return False
+                self.version = _recv(sock, version_length).decode('utf-8')
+                return True
+        except OSError:
+            return False
+
+    def predict(self, batch):
+        """ Runs the model on a (N, 64, 64, 1) batch in the pool and returns the class probabilities """
+
+        batch = np.ascontiguousarray(batch, dtype=np.float32)
+        if batch.shape[1:] != tuple(self.input_shape):
+            raise ValueError('Expected a (N, {}) batch, got {}'.format(
+                ', '.join(map(str, self.input_shape)), batch.shape))
+
+        with self._connect(self.timeout) as sock:
+            sock.sendall(REQUEST.pack(len(batch)))
+            sock.sendall(memoryview(batch).cast('B'))
+
+            n, classes, version_length = RESPONSE.unpack(_recv(sock, RESPONSE.size))
+            if n == ERROR:
+                raise RuntimeError('Inference pool error: {}'.format(_recv(sock, classes).decode('utf-8')))
+
+            # a restarted worker may have loaded a newer artifact
+            self.version = _recv(sock, version_length).decode('utf-8')
+
+            pred = np.empty((n, classes), dtype=np.float32)
+            _recv_into(sock, memoryview(pred).cast('B'))
+            return pred
@@ -0,0 +1,96 @@
+import re
+import statistics
+import time
+from datetime import timedelta
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.utils import timezone
+from api.models import Quiz, QuizQuestion, User, UserQuizMark, UserScoreSummary
+
+QUIZZES = ['iq', 'math', 'english', 'drawing', 'speech_training']
+
+# plan fragments of a full table scan or an explicit sort, for sqlite and postgres
+FULL_SCAN = re.compile(r'\bSCAN\b|Seq Scan|USE TEMP B-TREE|\bSort\b')
+
+# grows with the quiz and is only read once per worker process, so only its plan is checked
+UNTIMED = {'question id pool'}
+
+
+class Command(BaseCommand):
+    help = 'Seeds UserQuizMark and QuizQuestion with millions of rows inside a rolled back transaction and fails ' \
+           'unless the queries of the score and quiz endpoints are index-backed and fast'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=20000)
+        parser.add_argument('--marks', type=int, default=2000000, help='UserQuizMark rows to seed')
+        parser.add_argument('--questions', type=int, default=1000000, help='QuizQuestion rows to seed')
+        parser.add_argument('--repeat', type=int, default=50, help='timed runs of every query')
+        parser.add_argument('--max-ms', type=float, default=5.0, help='median time allowed per query')
+        parser.add_argument('--batch-size', type=int, default=10000)
+
+    def seed(self, users, marks, questions, batch_size):
+        quizzes = [Quiz.objects.get_or_create(name=name)[0] for name in QUIZZES]
+
+        first = User.objects.order_by('-id').values_list('id', flat=True).first() or 0
+        User.objects.bulk_create(
+            (User(email='bench{}@example.com'.format(first + i), username='bench{}'.format(first + i))
+             for i in range(users)), batch_size=batch_size)
+        user_ids = list(User.objects.filter(id__gt=first).values_list('id', flat=True))
+
+        now = timezone.now()
+        UserQuizMark.objects.bulk_create(
+            (UserQuizMark(user_id=user_ids[i % len(user_ids)], quiz=quizzes[i // len(user_ids) % len(quizzes)],
+                          marks=i % 11, timestamp=now - timedelta(seconds=i)) for i in range(marks)),
+            batch_size=batch_size)
+
+        QuizQuestion.objects.bulk_create(
+            (QuizQuestion(quiz=quizzes[i % len(quizzes)], question='question {}'.format(i), dummy_answer1='a',
+                          dummy_answer2='b', answer='c') for i in range(questions)),
+            batch_size=batch_size)
+
+        return user_ids[len(user_ids) // 2], quizzes[0]
+
+    def queries(self, user_id, quiz):
+        """ The queries behind ScoreAPIView, QuizQuestionAPIView and QuizMarksAPIView, see api.scores / api.sampling """
+
+        question_ids = list(QuizQuestion.objects.filter(quiz=quiz).values_list('id', flat=True)[:2])
+        return {
+            'score summary read': UserScoreSummary.objects.filter(user_id=user_id).values_list('scores', flat=True),
+            'newest marks of a quiz': UserQuizMark.objects.filter(user_id=user_id, quiz=quiz).order_by(
+                '-timestamp', '-id').values('id', 'marks', 'timestamp')[:2],
+            'question id pool': QuizQuestion.objects.filter(quiz=quiz).values_list('id', flat=True),
+            'sampled questions': QuizQuestion.objects.filter(pk__in=question_ids),
+        }
+
+    def handle(self, *args, **options):
+        failures = []
+
+        with transaction.atomic():
+            started = time.perf_counter()
+            user_id, quiz = self.seed(options['users'], options['marks'], options['questions'], options['batch_size'])
+            self.stdout.write('Seeded {} marks and {} questions in {:.1f}s'.format(
+                options['marks'], options['questions'], time.perf_counter() - started))
+
+            for name, queryset in self.queries(user_id, quiz).items():
+                plan = queryset.explain()
+                if FULL_SCAN.search(plan):
+                    failures.append('{} is not index-backed:\n{}'.format(name, plan))
+
+                timings = []
+                for _ in range(options['repeat']):
+                    started = time.perf_counter()
+                    list(queryset.all())
+                    timings.append((time.perf_counter() - started) * 1000)
+
+                median = statistics.median(timings)
+                if median > options['max_ms'] and name not in UNTIMED:
+                    failures.append('{} took {:.2f} ms, more than {} ms'.format(name, median, options['max_ms']))
+
+                self.stdout.write('{:<24} median {:8.2f} ms   {}'.format(name, median, ' | '.join(plan.splitlines())))
+
+            # nothing seeded is kept
+            transaction.set_rollback(True)
+
+        if failures:
+            raise CommandError('\n'.join(failures))
+        self.stdout.write(self.style.SUCCESS('All queries are index-backed'))
@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand
+from api.models import UserQuizMark, UserScoreSummary
+from api.scores import rebuild_score_summary
+
+
+class Command(BaseCommand):
+    help = 'Rebuilds every UserScoreSummary from the UserQuizMark table, e.g. after the summaries were introduced'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--user', type=int, action='append', help='only rebuild these user ids')
+
+    def handle(self, *args, **options):
+        user_ids = options['user'] or UserQuizMark.objects.order_by().values_list('user_id', flat=True).distinct()
+
+        rebuilt = 0
+        for user_id in user_ids:
+            rebuild_score_summary(user_id)
+            rebuilt += 1
+
+        # summaries of users whose marks are all gone
+        if not options['user']:
+            UserScoreSummary.objects.exclude(user_id__in=UserQuizMark.objects.values('user_id')).delete()
+
+        self.stdout.write(self.style.SUCCESS('Rebuilt {} score summaries'.format(rebuilt)))
@@ -0,0 +1,176 @@
+import json
+import multiprocessing
+import os
+import re
+import time
+from concurrent.futures import ProcessPoolExecutor
+import django
+import numpy as np
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from api.grading import SKETCH_CATEGORIES, grade_sketch
+from api.models import DrawnSketch, Sketch, UserQuizMark
+from api.scores import refresh_quiz_score
+
+# kept under MEDIA_ROOT by default, next to the archived drawings it tracks and out of the source tree
+CHECKPOINT_NAME = 'rescore_sketches.json'
+
+
+def _decode(drawing):
+    """
+        Runs in the decode pool: the 64x64 image of an archived drawing as it was fed to the model
+
+        Drawings sent as strokes are rendered from their strokes like PredictStrokesAPIView does, uploaded images
+        are decoded to the binary bitmap of PredictAPIView.
+    """
+
+    from api.preprocessing import decode_sketch, rasterize_strokes
+
+    path, strokes = drawing
+    try:
+        if strokes is not None:
+            return rasterize_strokes(strokes)[0, :, :, 0].copy()
+        with open(path, 'rb') as f:
+            return decode_sketch(f.read())[0, :, :, 0].copy()
+    except (OSError, ValueError):
+        return None
+
+
+class Command(BaseCommand):
+    help = 'Re-scores every archived DrawnSketch with the current model and updates the linked drawing marks, ' \
+           'e.g. after shipping a new model. Resumes from its checkpoint after an interruption'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=1024, help='drawings read and written per transaction')
+        parser.add_argument('--batch-size', type=int, default=256, help='drawings per forward pass')
+        parser.add_argument('--workers', type=int, default=os.cpu_count(), help='image decoding processes')
+        parser.add_argument('--checkpoint', help='progress file, defaults to MEDIA_ROOT/{}'.format(CHECKPOINT_NAME))
+        parser.add_argument('--restart', action='store_true', help='ignore the checkpoint, start from the beginning')
+
+    def load_checkpoint(self, path, version, restart):
+        if not restart and os.path.exists(path):
+            with open(path) as f:
+                checkpoint = json.load(f)
+            # a checkpoint of another model is stale, that model's scores are the ones being replaced
+            if checkpoint['version'] == version:
+                return checkpoint
+        return {'version': version, 'last_id': 0, 'done': False, 'rescored': 0, 'changed': 0, 'skipped': 0,
+                'unrecorded_strokes': 0}
+
+    def save_checkpoint(self, path, checkpoint):
+        with open(path + '.tmp', 'w') as f:
+            json.dump(checkpoint, f, indent=2)
+        os.replace(path + '.tmp', path)
+
+    def chunks(self, last_id, chunk_size):
+        """ Keyset pagination over the drawings after last_id, every page is an index range scan """
+
+        while True:
+            chunk = list(DrawnSketch.objects.filter(id__gt=last_id).order_by('id').values(
+                'id', 'image', 'strokes', 'image_name_id', 'marks_id', 'marks__marks', 'marks__user_id',
+                'marks__quiz_id'
+            )[:chunk_size])
+            if not chunk:
+                return
+            yield chunk
+            last_id = chunk[-1]['id']
+
+    def handle(self, *args, **options):
+        from api.archive import STROKES_IMAGE_NAME
+        from api.inference import doodle_model, model_version
+
+        # stroke uploads archived before DrawnSketch.strokes existed only kept their 256x256 rendering, not what the
+        # model was fed, they are skipped. Matches their storage name, with the suffix storage adds to a taken name
+        name, ext = os.path.splitext(STROKES_IMAGE_NAME)
+        unrecorded_strokes = re.compile(r'^{}/{}(_[a-zA-Z0-9]{{7}})?{}$'.format(
+            DrawnSketch._meta.get_field('image').upload_to, re.escape(name), re.escape(ext)))
+
+        sketch_names = dict(Sketch.objects.values_list('id', 'name'))
+        batch_size = options['batch_size']
+
+        if options['checkpoint'] is None:
+            os.makedirs(settings.MEDIA_ROOT, exist_ok=True)
+            options['checkpoint'] = os.path.join(settings.MEDIA_ROOT, CHECKPOINT_NAME)
+
+        # spawned decode processes never inherit the model runtime or the database connections and work the same
+        # everywhere, they set Django up before unpickling _decode imports this module and so api.models
+        with ProcessPoolExecutor(max_workers=options['workers'], mp_context=multiprocessing.get_context('spawn'),
+                                 initializer=django.setup) as pool:
+            # the version of the model that actually serves, loaded here or reported by the inference pool
+            version = model_version()
+            checkpoint = self.load_checkpoint(options['checkpoint'], version, options['restart'])
+            if checkpoint['done']:
+                self.stdout.write(self.style.SUCCESS('Every drawing is already scored by {}, pass --restart to '
+                                                     'rescore them again'.format(version)))
+                return
+            if checkpoint['last_id']:
+                self.stdout.write('Resuming after drawing {}'.format(checkpoint['last_id']))
+            # checkpoints written before unrecorded strokes were counted
+            checkpoint.setdefault('unrecorded_strokes', 0)
+
+            def decode(chunk):
+                drawings = [(default_storage.path(drawing['image']), drawing['strokes']) for drawing in chunk]
+                return pool.map(_decode, drawings, chunksize=max(1, len(drawings) // (4 * options['workers'])))
+
+            chunks = self.chunks(checkpoint['last_id'], options['chunk_size'])
+            chunk = next(chunks, None)
+            decoded = decode(chunk) if chunk else None
+
+            started = time.perf_counter()
+            rescored = 0
+
+            while chunk:
+                # the next chunk decodes in the pool while this one runs through the model
+                next_chunk = next(chunks, None)
+                bitmaps = list(decoded)
+                decoded = decode(next_chunk) if next_chunk else None
+
+                unrecorded = {drawing['id'] for drawing in chunk
+                              if drawing['strokes'] is None and unrecorded_strokes.match(drawing['image'])}
+                scorable = [(drawing, bitmap) for drawing, bitmap in zip(chunk, bitmaps) if bitmap is not None and
+                            drawing['id'] not in unrecorded and drawing['marks_id'] is not None and
+                            sketch_names[drawing['image_name_id']].lower() in SKETCH_CATEGORIES]
+
+                changed = []
+                for start in range(0, len(scorable), batch_size):
+                    batch = scorable[start:start + batch_size]
+                    tensor = np.stack([bitmap for _, bitmap in batch])[..., np.newaxis]
+                    top_3 = np.argsort(-doodle_model.predict(tensor), axis=1)[:, :3]
+
+                    for (drawing, _), top in zip(batch, top_3):
+                        score, _ = grade_sketch(sketch_names[drawing['image_name_id']], top)
+                        marks = round(score * 10)
+                        if marks != drawing['marks__marks']:
+                            changed.append((drawing, marks))
+
+                with transaction.atomic():
+                    UserQuizMark.objects.bulk_update(
+                        [UserQuizMark(id=drawing['marks_id'], marks=marks) for drawing, marks in changed], ['marks'])
+
+                    # bulk_update sends no post_save, refresh the score summaries of the changed marks
+                    for user_id, quiz_id in {(drawing['marks__user_id'], drawing['marks__quiz_id'])
+                                             for drawing, _ in changed}:
+                        refresh_quiz_score(user_id, quiz_id, create=False)
+
+                checkpoint['last_id'] = chunk[-1]['id']
+                checkpoint['rescored'] += len(scorable)
+                checkpoint['changed'] += len(changed)
+                checkpoint['skipped'] += len(chunk) - len(scorable)
+                checkpoint['unrecorded_strokes'] += len(unrecorded)
+                self.save_checkpoint(options['checkpoint'], checkpoint)
+
+                rescored += len(chunk)
+                elapsed = time.perf_counter() - started
+                self.stdout.write('{} drawings up to id {}, {} marks changed, {:.0f} drawings/s'.format(
+                    rescored, checkpoint['last_id'], checkpoint['changed'], rescored / elapsed))
+
+                chunk = next_chunk
+
+        checkpoint['done'] = True
+        self.save_checkpoint(options['checkpoint'], checkpoint)
+        self.stdout.write(self.style.SUCCESS(
+            'Rescored {rescored} drawings with {version}, {changed} marks changed, {skipped} skipped (no linked '
+            'marks, unreadable image, a category the model does not know, or one of the {unrecorded_strokes} stroke '
+            'uploads archived before their strokes were kept)'.format(**checkpoint)))
@@ -0,0 +1,31 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from api import inference_pool
+from api.inference import ModelRegistry, model_backend
+
+
+class Command(BaseCommand):
+    help = 'Runs the doodle CNN in a fixed pool of worker processes that the web workers send their predictions ' \
+           'to over a Unix socket, point DOODLE_MODEL_POOL_SOCKET of the web workers to the same socket (Linux only)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--socket', default=settings.DOODLE_MODEL['POOL_SOCKET'],
+                            help='Unix socket path, defaults to DOODLE_MODEL_POOL_SOCKET')
+        parser.add_argument('--workers', type=int, default=settings.DOODLE_MODEL['POOL_WORKERS'],
+                            help='model processes, each holds one copy of the model')
+
+    def handle(self, *args, **options):
+        if not inference_pool.SUPPORTED:
+            raise CommandError(inference_pool.UNSUPPORTED_MESSAGE)
+        if not options['socket']:
+            raise CommandError('No socket path, pass --socket or set DOODLE_MODEL_POOL_SOCKET')
+        if options['workers'] < 1:
+            raise CommandError('--workers must be at least 1')
+
+        self.stdout.write('Inference pool of {} {} workers listening on {}'.format(
+            options['workers'], settings.DOODLE_MODEL['BACKEND'], options['socket']))
+        self.stdout.flush()
+
+        inference_pool.serve(options['socket'], options['workers'], lambda: ModelRegistry(model_backend()))
+
+        self.stdout.write('Inference pool stopped')
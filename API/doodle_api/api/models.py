@@ -1,8 +1,8 @@
-from datetime import datetime
 from django.contrib.auth.base_user import AbstractBaseUser, BaseUserManager
 from django.contrib.auth.models import PermissionsMixin
 from django.core.validators import MinValueValidator, MaxValueValidator
 from django.db import models
+from django.utils import timezone
 
 
 class UserAccountManager(BaseUserManager):
@@ -70,12 +70,32 @@ class UserQuizMark(models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE)
     quiz = models.ForeignKey(Quiz, on_delete=models.CASCADE)
     marks = models.IntegerField(validators=[MinValueValidator(0), MaxValueValidator(10)])
-    timestamp = models.DateTimeField(default=datetime.now())
+    timestamp = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        indexes = [
+            # newest marks of a user in a quiz (score summaries), read straight off the index without a sort
+            models.Index(fields=['user', 'quiz', '-timestamp', '-id'], name='userquizmark_user_quiz_ts'),
+        ]
 
     def __str__(self):
         return '{} - {}'.format(self.user, self.quiz)
 
 
+class UserScoreSummary(models.Model):
+    """
+        UserScoreSummary model - latest and previous marks of every quiz a user took, one row per user
+        scores: {quiz id: {'quiz': name, 'latest': marks, 'previous': marks or None, 'timestamp': iso, 'id': mark id}}
+        kept up to date from UserQuizMark writes by api.signals
+    """
+
+    user = models.OneToOneField(User, on_delete=models.CASCADE, related_name='score_summary')
+    scores = models.JSONField(default=dict)
+
+    def __str__(self):
+        return '{} - scores'.format(self.user)
+
+
 class QuizQuestion(models.Model):
     """ QuizQuestion model - stores questions that belongs to a quiz"""
 
@@ -86,6 +106,12 @@ class QuizQuestion(models.Model):
     dummy_answer2 = models.CharField(max_length=255)
     answer = models.CharField(max_length=255)
 
+    class Meta:
+        indexes = [
+            # question id pools of a quiz are read from the index alone
+            models.Index(fields=['quiz', 'id'], name='quizquestion_quiz_id'),
+        ]
+
     def __str__(self):
         return 'Question{}'.format(self.quiz, self.question)
 
@@ -101,12 +127,16 @@ class Sketch(models.Model):
 
 
 class DrawnSketch(models.Model):
-    """ DrawnSketch model - stores sketches drawn by the user """
+    """
+        DrawnSketch model - stores sketches drawn by the user
+        strokes: the QuickDraw strokes of drawings sent as strokes, image is then only a rendered copy
+    """
 
     user = models.ForeignKey(User, on_delete=models.CASCADE)
     marks = models.ForeignKey(UserQuizMark, on_delete=models.CASCADE, null=True, blank=True)
     image = models.ImageField(upload_to='sketches')
     image_name = models.ForeignKey(Sketch, on_delete=models.CASCADE)
+    strokes = models.JSONField(null=True, blank=True)
     
     def __str__(self):
         return '{}-{}'.format(self.user, self.image_name)
\ No newline at end of file
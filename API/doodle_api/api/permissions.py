@@ -1,13 +1,32 @@
+from django.conf import settings
+from django.core.cache import cache
 from rest_framework import permissions
 from api.models import User
 
 
+def _cached_is_staff(user_id):
+    """ Staff flag from the database, cached for STAFF_CLAIM_CACHE_TTL seconds (0 disables the cache) """
+
+    ttl = settings.STAFF_CLAIM_CACHE_TTL
+    key = 'api:is_staff:{}'.format(user_id)
+
+    is_staff = cache.get(key) if ttl else None
+    if is_staff is None:
+        is_staff = User.objects.filter(id=user_id).values_list('is_staff', flat=True).first() or False
+        if ttl:
+            cache.set(key, is_staff, ttl)
+    return is_staff
+
+
 class IsStaff(permissions.BasePermission):
     """
         Custom permission to only allow staff to do actions.
+        Reads the signed is_staff claim of the access token, tokens issued before the claim existed fall back
+        to a cached database lookup.
     """
     def has_permission(self, request, view):
-        is_staff = User.objects.get(id=request.user.id).is_staff
-
-        return is_staff
+        token = request.auth
+        if token is not None and 'is_staff' in token:
+            return bool(token['is_staff'])
 
+        return _cached_is_staff(request.user.id)
@@ -0,0 +1,138 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+import numpy as np
+
+
+def sketch_key(tensor, version):
+    """
+        Digest of a sketch tensor for the given model version
+
+        Uploaded images are thresholded to a binary bitmap by decode_sketch, those are hashed as their packed bits
+        (512 bytes for 64x64). Rendered strokes are anti-aliased and fall back to their raw float32 bytes.
+    """
+
+    bits = tensor.astype(bool)
+    data = np.packbits(bits) if np.array_equal(bits, tensor) else np.ascontiguousarray(tensor)
+
+    digest = hashlib.blake2b(version.encode('utf-8'), digest_size=16)
+    digest.update(str(tensor.shape).encode('ascii'))
+    digest.update(data)
+    return digest.digest()
+
+
+class PredictionCache:
+    """ PredictionCache - thread-safe bounded LRU of top-k predictions, each expiring ttl seconds after it was made """
+
+    def __init__(self, max_entries, ttl):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.evictions = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[1] < time.monotonic():
+                del self._entries[key]
+                self.expired += 1
+                entry = None
+
+            if entry is None:
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'max_entries': self.max_entries,
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0,
+                'expired': self.expired,
+                'evictions': self.evictions,
+            }
+
+
+class CachedPredictor:
+    """
+        CachedPredictor - answers repeated sketches from a PredictionCache, only new ones reach the batcher
+
+        Has the MicroBatcher interface (submit / predict / stats). Identical sketches submitted while the first
+        is still queued share its future instead of running again, client retries usually arrive that way.
+        version() returns the version of the model currently served, entries are keyed by it, and sketches
+        bypass the cache while it is None (the model is not loaded yet).
+    """
+
+    def __init__(self, batcher, cache, version):
+        self.batcher = batcher
+        self.cache = cache
+        self.version = version
+        self._pending = {}
+        self._lock = threading.Lock()
+        self.coalesced = 0
+
+    def _done(self, key, version, future):
+        with self._lock:
+            del self._pending[key]
+        # a result that raced a model update may come from either model, it is not kept
+        if future.exception() is None and self.version() == version:
+            self.cache.put(key, future.result())
+
+    def submit(self, tensor):
+        """ Returns a future resolving to the top_k class indices of a single sketch tensor """
+
+        version = self.version()
+        if version is None:
+            return self.batcher.submit(tensor)
+
+        key = sketch_key(tensor, version)
+
+        top_k = self.cache.get(key)
+        if top_k is not None:
+            future = Future()
+            future.set_result(top_k)
+            return future
+
+        with self._lock:
+            future = self._pending.get(key)
+            if future is not None:
+                self.coalesced += 1
+                return future
+
+            future = self._pending[key] = self.batcher.submit(tensor)
+        future.add_done_callback(lambda future: self._done(key, version, future))
+        return future
+
+    def predict(self, tensor, timeout=None):
+        """ Returns the top_k class indices for a single sketch tensor """
+
+        return self.submit(tensor).result(timeout=timeout)
+
+    def stats(self):
+        return dict(self.batcher.stats(), cache=dict(self.cache.stats(), coalesced=self.coalesced))
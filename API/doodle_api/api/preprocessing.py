@@ -0,0 +1,63 @@
+import threading
+import cv2
+import numpy as np
+from django.conf import settings
+from doodle_data.rasterizer import render
+
+_buffers = threading.local()
+
+
+def _get_buffers(size):
+    """ Returns this thread's (gray, tensor) buffers for the given size, allocating them on first use """
+
+    buffers = getattr(_buffers, 'by_size', None)
+    if buffers is None:
+        buffers = _buffers.by_size = {}
+
+    if size not in buffers:
+        buffers[size] = (
+            np.empty((size, size), dtype=np.uint8),
+            np.empty((1, size, size, 1), dtype=np.float32),
+        )
+    return buffers[size]
+
+
+def decode_sketch(image_data, size=64, thresh=250):
+    """
+        Decodes an uploaded sketch straight from its bytes into a (1, size, size, 1) float32 tensor
+
+        The image is resized, thresholded and normalized in per-thread buffers that are reused between calls,
+        so the returned array is only valid until the next call on the same thread.
+    """
+
+    # cv2 asserts on an empty buffer instead of returning None
+    if not image_data:
+        raise ValueError('Empty sketch image')
+
+    img = cv2.imdecode(np.frombuffer(image_data, dtype=np.uint8), cv2.IMREAD_GRAYSCALE)
+    if img is None:
+        raise ValueError('Unable to decode sketch image')
+
+    gray, tensor = _get_buffers(size)
+
+    cv2.resize(img, (size, size), dst=gray, interpolation=cv2.INTER_CUBIC)
+    cv2.threshold(gray, thresh, 255, cv2.THRESH_BINARY, dst=gray)
+    np.divide(gray, np.float32(255), out=tensor[0, :, :, 0])
+
+    return tensor
+
+
+def rasterize_strokes(drawing, size=64):
+    """
+        Renders a QuickDraw stroke list straight into a (1, size, size, 1) float32 tensor
+
+        Uses the renderer the served model was trained with (DOODLE_MODEL['RENDERER']), so stroke uploads get
+        exactly the training-time preprocessing. Shares decode_sketch's per-thread buffers.
+    """
+
+    img = render(drawing, size=size, lw=settings.DOODLE_MODEL['LINE_WIDTH'], backend=settings.DOODLE_MODEL['RENDERER'])
+
+    _, tensor = _get_buffers(size)
+    np.divide(img, np.float32(255), out=tensor[0, :, :, 0])
+
+    return tensor
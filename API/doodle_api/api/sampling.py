@@ -0,0 +1,27 @@
+import random
+from api.caching import ProcessLocalCache
+from api.models import QuizQuestion
+
+
+def _question_ids(quiz_id):
+    return list(QuizQuestion.objects.filter(quiz_id=quiz_id).values_list('id', flat=True))
+
+
+# question ids of every quiz, rebuilt after api.signals or the csv import invalidate the quiz
+question_pool = ProcessLocalCache('quiz-questions', _question_ids)
+
+
+def sample_questions(quiz, k):
+    """
+        Returns k distinct random questions of a quiz
+
+        Picks from the cached id pool and fetches only the picked rows, instead of ORDER BY RANDOM() over
+        every question of the quiz.
+    """
+
+    ids = question_pool.get(quiz.id)
+    picked = random.sample(ids, min(k, len(ids)))
+
+    # the quiz filter drops questions moved to another quiz since the pool was built
+    questions = QuizQuestion.objects.in_bulk(picked) if picked else {}
+    return [questions[pk] for pk in picked if pk in questions and questions[pk].quiz_id == quiz.id]
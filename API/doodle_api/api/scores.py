@@ -0,0 +1,70 @@
+from django.db import transaction
+from api.models import Quiz, UserQuizMark, UserScoreSummary
+
+
+def _quiz_score(quiz_name, marks):
+    """ Summary entry of one quiz from its newest marks, newest first """
+
+    return {
+        'quiz': quiz_name,
+        'latest': marks[0]['marks'],
+        'previous': marks[1]['marks'] if len(marks) > 1 else None,
+        'timestamp': marks[0]['timestamp'].isoformat(),
+        'id': marks[0]['id'],
+    }
+
+
+def refresh_quiz_score(user_id, quiz_id, create=True):
+    """
+        Recomputes the summary entry of one quiz of a user from its two newest marks
+
+        Called for every UserQuizMark write, so it costs a constant number of queries. With create=False
+        users without a summary row are left alone, e.g. while a deleted user's marks are cascading.
+    """
+
+    with transaction.atomic():
+        # a no-op update takes the row lock (and sqlite's write lock) before anything is read, so concurrent
+        # writers queue up instead of failing to upgrade a read lock
+        summaries = UserScoreSummary.objects.filter(user_id=user_id)
+        if not summaries.update(user_id=user_id):
+            if not create:
+                return None
+            # first mark of the user, a concurrent first mark may insert the row first: get_or_create falls back
+            # to reading it on the IntegrityError, then the row is locked like any other
+            UserScoreSummary.objects.get_or_create(user_id=user_id)
+            summaries.update(user_id=user_id)
+        summary = summaries.get()
+
+        marks = list(UserQuizMark.objects.filter(user_id=user_id, quiz_id=quiz_id).order_by(
+            '-timestamp', '-id').values('id', 'marks', 'timestamp')[:2])
+        quiz_name = Quiz.objects.filter(id=quiz_id).values_list('name', flat=True).first() if marks else None
+
+        if quiz_name is None:
+            summary.scores.pop(str(quiz_id), None)
+        else:
+            summary.scores[str(quiz_id)] = _quiz_score(quiz_name, marks)
+
+        summary.save()
+        return summary
+
+
+def rebuild_score_summary(user_id):
+    """ Recomputes a user's whole summary from all of their marks """
+
+    newest = {}
+    for mark in UserQuizMark.objects.filter(user_id=user_id).order_by('-timestamp', '-id').values(
+            'id', 'marks', 'timestamp', 'quiz_id', 'quiz__name'):
+        newest.setdefault((mark['quiz_id'], mark['quiz__name']), []).append(mark)
+
+    scores = {str(quiz_id): _quiz_score(quiz_name, marks[:2]) for (quiz_id, quiz_name), marks in newest.items()}
+    summary, _ = UserScoreSummary.objects.update_or_create(user_id=user_id, defaults={'scores': scores})
+    return summary
+
+
+def get_quiz_scores(user_id):
+    """ {quiz name: summary entry} of a user from the single summary row, None when they have no marks yet """
+
+    scores = UserScoreSummary.objects.filter(user_id=user_id).values_list('scores', flat=True).first()
+    if scores is None:
+        return None
+    return {entry['quiz']: entry for entry in scores.values()}
@@ -1,8 +1,8 @@
 from rest_framework import serializers, status
 from djoser.serializers import UserCreateSerializer
+from rest_framework_simplejwt.serializers import TokenObtainPairSerializer
 from django.contrib.auth import get_user_model
 from api.models import Quiz, QuizQuestion, UserQuizMark, Sketch
-import numpy as np
 
 User = get_user_model()
 
@@ -13,6 +13,16 @@ class UserCreateSerializer(UserCreateSerializer):
         fields = ['id', 'email', 'username', 'first_name', 'last_name', 'password']
 
 
+class StaffTokenObtainPairSerializer(TokenObtainPairSerializer):
+    """ Issues token pairs carrying the user's staff flag, so IsStaff needs no database lookup """
+
+    @classmethod
+    def get_token(cls, user):
+        token = super().get_token(user)
+        token['is_staff'] = user.is_staff
+        return token
+
+
 class QuizQuestionSerializer(serializers.ModelSerializer):
     """ Serializer for quiz questions """
 
@@ -63,3 +73,22 @@ class SketchSerializer(serializers.ModelSerializer):
         model = Sketch
         fields = '__all__'
 
+
+class StrokePredictSerializer(serializers.Serializer):
+    """ Serializer for QuickDraw stroke uploads - [[[x0, x1, ...], [y0, y1, ...]], ...] on a 256x256 canvas """
+
+    sketch_id = serializers.IntegerField()
+    drawing = serializers.ListField(
+        child=serializers.ListField(
+            child=serializers.ListField(child=serializers.IntegerField(min_value=0, max_value=255)),
+            min_length=2
+        ),
+        min_length=1
+    )
+
+    def validate_drawing(self, value):
+        for stroke in value:
+            if len(stroke[0]) != len(stroke[1]):
+                raise serializers.ValidationError('Every stroke needs as many x as y coordinates.')
+
+        return value
@@ -0,0 +1,49 @@
+from django.db.models.signals import post_delete, post_save, pre_save
+from django.dispatch import receiver
+from api.catalog import sketch_catalog
+from api.grading import answer_keys
+from api.models import QuizQuestion, Sketch, UserQuizMark
+from api.sampling import question_pool
+from api.scores import refresh_quiz_score
+
+
+def invalidate_quiz_questions(quiz_id):
+    """ Drops the cached question pool and answer key of a quiz, for changes that send no signals """
+
+    question_pool.invalidate(quiz_id)
+    answer_keys.invalidate(quiz_id)
+
+
+@receiver(pre_save, sender=QuizQuestion)
+def invalidate_previous_quiz(sender, instance, raw=False, **kwargs):
+    """ A question moved to another quiz leaves the pool of its old quiz too """
+
+    if instance.pk is None or raw:
+        return
+
+    previous = QuizQuestion.objects.filter(pk=instance.pk).values_list('quiz_id', flat=True).first()
+    if previous is not None and previous != instance.quiz_id:
+        invalidate_quiz_questions(previous)
+
+
+@receiver(post_save, sender=QuizQuestion)
+@receiver(post_delete, sender=QuizQuestion)
+def invalidate_question_caches(sender, instance, **kwargs):
+    invalidate_quiz_questions(instance.quiz_id)
+
+
+@receiver(post_save, sender=Sketch)
+@receiver(post_delete, sender=Sketch)
+def invalidate_sketch_catalog(sender, instance, **kwargs):
+    sketch_catalog.invalidate()
+
+
+@receiver(post_save, sender=UserQuizMark)
+def update_score_summary(sender, instance, raw=False, **kwargs):
+    if not raw:
+        refresh_quiz_score(instance.user_id, instance.quiz_id)
+
+
+@receiver(post_delete, sender=UserQuizMark)
+def revert_score_summary(sender, instance, **kwargs):
+    refresh_quiz_score(instance.user_id, instance.quiz_id, create=False)
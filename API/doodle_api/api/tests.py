@@ -1,3 +1,1045 @@
-from django.test import TestCase
+import io
+import json
+import multiprocessing
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import Future, TimeoutError
+from datetime import timedelta
+from unittest import mock, skipUnless
+import cv2
+import numpy as np
+from decouple import config
+from django.conf import settings
+from django.contrib.auth.tokens import default_token_generator
+from django.core import mail
+from django.core.cache import cache
+from django.core.checks import run_checks
+from django.core.files.base import ContentFile
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import CommandError, call_command
+from django.db import transaction
+from django.db.models.query import QuerySet
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.utils import timezone
+from djoser.utils import encode_uid
+from rest_framework.test import APIClient
+from rest_framework_simplejwt.tokens import AccessToken, RefreshToken
+from api.batching import MicroBatcher
+from api.archive import _archive_strokes
+from api.caching import ProcessLocalCache
+from api.csv_import import _run_import_job, get_import_job, import_questions
+from api.grading import SKETCH_CATEGORIES, grade_answers
+from api.management.commands.benchmark_query_plans import FULL_SCAN, Command as BenchmarkQueryPlans
+from api.inference import ModelRegistry
+from api import inference_pool
+from api.inference_pool import InferencePoolClient, _handle
+from api.models import DrawnSketch, Quiz, QuizQuestion, Sketch, User, UserQuizMark, UserScoreSummary
+from api.prediction_cache import CachedPredictor, PredictionCache
+from api.preprocessing import decode_sketch, rasterize_strokes
+from api.sampling import sample_questions
+from api.scores import get_quiz_scores, rebuild_score_summary
+from api.views import REFERENCE_IMAGE_DIR, REFERENCE_IMAGE_MAX_AGE, reference_image_etag
 
-# Create your tests here.
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# What a fresh worker loads before serving its first request: Django, every app, the url conf and so every view
+# module, plus api.inference itself, which must not load the model runtime until something predicts. Run with
+# `baseline` it only imports Django, measured in the same test run on the same machine.
+STARTUP_SCRIPT = '''
+import json, os, sys, time
+started = time.perf_counter()
+import django
+if sys.argv[1:] != ['baseline']:
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'doodle_api.settings')
+    django.setup()
+    from django.urls import get_resolver
+    get_resolver().url_patterns
+    import api.inference
+seconds = time.perf_counter() - started
+if os.path.exists('/proc/self/status'):
+    # Linux ru_maxrss keeps the peak of the test process this one was started from, VmHWM is this process's own
+    with open('/proc/self/status') as f:
+        rss_mb = next(int(line.split()[1]) for line in f if line.startswith('VmHWM:')) / 1024
+else:
+    # macOS reports ru_maxrss in bytes, Windows has no resource module and reports nothing
+    try:
+        import resource
+        rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024 ** 2
+    except ImportError:
+        rss_mb = None
+print(json.dumps({'seconds': seconds, 'rss_mb': rss_mb, 'modules': sorted(sys.modules)}))
+'''
+
+# loaded only by processes that predict
+INFERENCE_MODULES = ['tensorflow', 'keras', 'cv2', 'PIL', 'api.preprocessing', 'api.archive']
+
+# what the project may add to the baseline, importing the model runtime alone costs several times that
+# (raise them on unusually slow or loaded machines)
+STARTUP_MAX_EXTRA_SECONDS = config('STARTUP_MAX_EXTRA_SECONDS', default=1.5, cast=float)
+STARTUP_MAX_EXTRA_RSS_MB = config('STARTUP_MAX_EXTRA_RSS_MB', default=100, cast=float)
+
+
+def measure_startup(*args, runs=2):
+    """ Fastest of `runs` fresh interpreters running STARTUP_SCRIPT """
+
+    startups = []
+    for _ in range(runs):
+        output = subprocess.run([sys.executable, '-c', STARTUP_SCRIPT, *args], cwd=settings.BASE_DIR,
+                                capture_output=True, text=True, check=True).stdout
+        startups.append(json.loads(output.splitlines()[-1]))
+    return min(startups, key=lambda startup: startup['seconds'])
+
+
+class StartupTestCase(SimpleTestCase):
+    """ StartupTestCase - import time and memory of a worker that has not predicted anything yet """
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.baseline = measure_startup('baseline')
+        cls.startup = measure_startup()
+
+    def test_inference_stack_is_not_imported(self):
+        loaded = [module for module in INFERENCE_MODULES if module in self.startup['modules']]
+        self.assertEqual(loaded, [])
+
+    def test_import_time(self):
+        self.assertLess(self.startup['seconds'] - self.baseline['seconds'], STARTUP_MAX_EXTRA_SECONDS,
+                        'worker startup took {:.2f}s, {:.2f}s to import Django'.format(
+                            self.startup['seconds'], self.baseline['seconds']))
+
+    @skipUnless(resource, 'peak RSS is only measured on Unix')
+    def test_memory(self):
+        self.assertLess(self.startup['rss_mb'] - self.baseline['rss_mb'], STARTUP_MAX_EXTRA_RSS_MB,
+                        'worker startup peaked at {:.0f} MB RSS, {:.0f} MB after importing Django'.format(
+                            self.startup['rss_mb'], self.baseline['rss_mb']))
+
+
+class FlakyBackend:
+    """ Model backend stub whose first load_failures loads raise """
+
+    def __init__(self, load_failures=0, classes=10, version='flaky'):
+        self.load_failures = load_failures
+        self.classes = classes
+        self.loads = 0
+        self.artifact_version = version
+        self.version = None
+
+    def load(self):
+        self.loads += 1
+        if self.loads <= self.load_failures:
+            raise OSError('model file missing')
+        self.version = self.artifact_version
+
+    def predict(self, batch):
+        return np.full((len(batch), self.classes), 1 / self.classes, dtype=np.float32)
+
+
+class ModelRegistryTestCase(SimpleTestCase):
+
+    def load_in_background(self, registry):
+        registry.load_async()
+        loader = registry._loader
+        if loader is not None:
+            loader.join(5)
+
+    def test_load_async(self):
+        registry = ModelRegistry(FlakyBackend())
+        self.assertFalse(registry.is_ready())
+
+        self.load_in_background(registry)
+        self.assertTrue(registry.is_ready())
+
+    def test_failed_background_load_is_retried(self):
+        registry = ModelRegistry(FlakyBackend(load_failures=1))
+
+        with self.assertLogs('api.inference', 'ERROR'):
+            self.load_in_background(registry)
+        self.assertFalse(registry.is_ready())
+        self.assertIsNone(registry._loader)
+
+        self.load_in_background(registry)
+        self.assertTrue(registry.is_ready())
+        self.assertEqual(registry.backend.loads, 2)
+
+    def test_version_follows_the_loaded_artifact(self):
+        registry = ModelRegistry(FlakyBackend(version='v1'))
+        self.assertIsNone(registry.version)
+
+        registry.load()
+        self.assertEqual(registry.version, 'v1')
+        self.assertEqual(registry.predict(sketch(0)).shape, (1, 10))
+
+
+@skipUnless(inference_pool.SUPPORTED, inference_pool.UNSUPPORTED_MESSAGE)
+class InferencePoolTestCase(SimpleTestCase):
+    """ InferencePoolTestCase - the client against a pool worker's request handling, in a thread """
+
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.socket_path = os.path.join(tmp.name, 'pool.sock')
+
+        self.model = ModelRegistry(FlakyBackend(version='v1'))
+        self.model.load()
+
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        listener.bind(self.socket_path)
+        listener.listen(8)
+        self.addCleanup(listener.close)
+
+        def serve():
+            while True:
+                try:
+                    conn, _ = listener.accept()
+                except OSError:
+                    return
+                with conn:
+                    _handle(conn, self.model, (64, 64, 1))
+
+        threading.Thread(target=serve, daemon=True).start()
+
+    def test_version_is_reported_by_the_pool(self):
+        client = InferencePoolClient(self.socket_path, timeout=5)
+        self.assertIsNone(client.version)
+
+        self.assertIs(client.load(), client)
+        self.assertEqual(client.version, 'v1')
+
+        # a worker restarted on a new artifact
+        self.model = ModelRegistry(FlakyBackend(version='v2'))
+        self.model.load()
+        self.assertEqual(client.predict(np.zeros((3, 64, 64, 1), np.float32)).shape, (3, 10))
+        self.assertEqual(client.version, 'v2')
+
+    def test_load_fails_without_a_pool(self):
+        client = InferencePoolClient(self.socket_path + '.missing')
+        self.assertFalse(client.is_ready())
+        with self.assertRaises(ConnectionError):
+            client.load()
+
+
+def pool_model():
+    return ModelRegistry(FlakyBackend(version='pool'))
+
+
+@skipUnless(inference_pool.SUPPORTED, inference_pool.UNSUPPORTED_MESSAGE)
+class InferencePoolServeTestCase(SimpleTestCase):
+    """ InferencePoolServeTestCase - serve() with forked workers in a child process, as run_inference_pool runs it """
+
+    def test_ping_and_predict(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        socket_path = os.path.join(tmp.name, 'pool.sock')
+
+        pool = multiprocessing.get_context('fork').Process(target=inference_pool.serve,
+                                                           args=(socket_path, 2, pool_model))
+        pool.start()
+        self.addCleanup(pool.kill)
+
+        client = InferencePoolClient(socket_path, timeout=5)
+        for _ in range(100):
+            if client.is_ready():
+                break
+            time.sleep(0.1)
+        self.assertIs(client.load(), client)
+        self.assertEqual(client.version, 'pool')
+
+        pred = client.predict(np.zeros((3, 64, 64, 1), np.float32))
+        np.testing.assert_array_equal(pred, np.full((3, 10), 0.1, np.float32))
+
+        # SIGTERM stops the workers and removes the socket
+        pool.terminate()
+        pool.join(10)
+        self.assertEqual(pool.exitcode, 0)
+        self.assertFalse(os.path.exists(socket_path))
+
+    def test_refused_without_unix_sockets_or_fork(self):
+        with mock.patch('api.inference_pool.SUPPORTED', False):
+            with self.assertRaisesMessage(CommandError, 'run it on Linux'):
+                call_command('run_inference_pool', socket='pool.sock', stdout=io.StringIO())
+            with self.assertRaisesMessage(RuntimeError, 'run it on Linux'):
+                inference_pool.serve('pool.sock', 1, pool_model)
+
+
+def sketch(value):
+    return np.full((1, 64, 64, 1), value, dtype=np.float32)
+
+
+class MicroBatcherTestCase(SimpleTestCase):
+
+    def predict_fn(self, batch):
+        """ Records the batch sizes, row i scores class int(mean of row i) highest """
+
+        self.batches.append(len(batch))
+        pred = np.zeros((len(batch), 10), dtype=np.float32)
+        pred[np.arange(len(batch)), batch.reshape(len(batch), -1).mean(axis=1).astype(int)] = 1
+        return pred
+
+    def setUp(self):
+        self.batches = []
+
+    def test_concurrent_requests_share_a_forward_pass(self):
+        batcher = MicroBatcher(self.predict_fn, max_batch_size=32, max_wait_ms=200)
+
+        futures = [batcher.submit(sketch(i)) for i in range(5)]
+
+        # every caller gets the top class of its own row
+        self.assertEqual([future.result(5)[0] for future in futures], [0, 1, 2, 3, 4])
+        self.assertEqual(self.batches, [5])
+        self.assertEqual(batcher.stats()['batch_size']['count'], 1)
+
+    def test_batches_are_capped_at_max_batch_size(self):
+        batcher = MicroBatcher(self.predict_fn, max_batch_size=4, max_wait_ms=200)
+
+        futures = [batcher.submit(sketch(1)) for _ in range(10)]
+        for future in futures:
+            future.result(5)
+
+        self.assertEqual(sum(self.batches), 10)
+        self.assertLessEqual(max(self.batches), 4)
+
+    def test_errors_reach_every_caller_of_the_batch(self):
+        def fail(batch):
+            raise RuntimeError('model failed')
+
+        batcher = MicroBatcher(fail, max_wait_ms=50)
+        futures = [batcher.submit(sketch(0)) for _ in range(3)]
+
+        for future in futures:
+            with self.assertRaises(RuntimeError):
+                future.result(5)
+
+        # the worker survives a failed batch
+        batcher.predict_fn = self.predict_fn
+        self.assertEqual(batcher.predict(sketch(3), timeout=5)[0], 3)
+
+    def test_predict_timeout(self):
+        release = threading.Event()
+
+        def slow(batch):
+            release.wait(5)
+            return self.predict_fn(batch)
+
+        batcher = MicroBatcher(slow, max_wait_ms=1)
+        try:
+            with self.assertRaises(TimeoutError):
+                batcher.predict(sketch(0), timeout=0.05)
+        finally:
+            release.set()
+
+
+class PredictionCacheTestCase(SimpleTestCase):
+
+    def test_least_recently_used_entries_are_evicted(self):
+        cache = PredictionCache(max_entries=2, ttl=60)
+        cache.put('a', [1])
+        cache.put('b', [2])
+        cache.get('a')
+        cache.put('c', [3])
+
+        self.assertEqual((cache.get('a'), cache.get('b'), cache.get('c')), ([1], None, [3]))
+        self.assertEqual(cache.stats()['evictions'], 1)
+
+    @mock.patch('api.prediction_cache.time.monotonic')
+    def test_entries_expire(self, monotonic):
+        cache = PredictionCache(max_entries=10, ttl=60)
+        monotonic.return_value = 1000
+        cache.put('a', [1])
+
+        monotonic.return_value = 1060
+        self.assertEqual(cache.get('a'), [1])
+
+        monotonic.return_value = 1061
+        self.assertIsNone(cache.get('a'))
+
+        stats = cache.stats()
+        self.assertEqual((stats['entries'], stats['hits'], stats['misses'], stats['expired']), (0, 1, 1, 1))
+        self.assertEqual(stats['hit_rate'], 0.5)
+
+
+class StubBatcher:
+    """ Batcher stub whose futures the test resolves """
+
+    def __init__(self):
+        self.futures = []
+
+    def submit(self, tensor):
+        self.futures.append(Future())
+        return self.futures[-1]
+
+    def stats(self):
+        return {}
+
+
+class CachedPredictorTestCase(SimpleTestCase):
+
+    def setUp(self):
+        self.batcher = StubBatcher()
+        self.version = 'v1'
+        self.predictor = CachedPredictor(self.batcher, PredictionCache(max_entries=10, ttl=60), lambda: self.version)
+
+    def test_identical_pending_sketches_are_coalesced(self):
+        first, second = self.predictor.submit(sketch(1)), self.predictor.submit(sketch(1))
+        other = self.predictor.submit(sketch(0))
+
+        self.assertIs(first, second)
+        self.assertIsNot(first, other)
+        self.assertEqual(len(self.batcher.futures), 2)
+
+        first.set_result([3, 1, 2])
+        self.assertEqual(self.predictor.predict(sketch(1), timeout=1), [3, 1, 2])
+        self.assertEqual(len(self.batcher.futures), 2)
+        self.assertEqual(self.predictor.stats()['cache']['coalesced'], 1)
+
+    def test_errors_are_not_cached(self):
+        self.predictor.submit(sketch(1)).set_exception(RuntimeError('model failed'))
+
+        self.predictor.submit(sketch(1))
+        self.assertEqual(len(self.batcher.futures), 2)
+
+    def test_entries_are_keyed_by_the_served_version(self):
+        self.predictor.submit(sketch(1)).set_result([1, 2, 3])
+
+        self.version = 'v2'
+        future = self.predictor.submit(sketch(1))
+        self.assertEqual(len(self.batcher.futures), 2)
+
+        # answered by the old model while the new one took over, not cached under either version
+        self.version = 'v3'
+        future.set_result([4, 5, 6])
+        self.predictor.submit(sketch(1))
+        self.assertEqual(len(self.batcher.futures), 3)
+
+    def test_no_cache_before_the_model_is_loaded(self):
+        self.version = None
+        self.predictor.submit(sketch(1)).set_result([1, 2, 3])
+        self.predictor.submit(sketch(1))
+
+        self.assertEqual(len(self.batcher.futures), 2)
+        self.assertEqual(self.predictor.stats()['cache']['entries'], 0)
+
+
+class DecodeSketchTestCase(SimpleTestCase):
+
+    def test_decode(self):
+        img = np.full((300, 300), 255, np.uint8)
+        cv2.line(img, (10, 10), (250, 200), 0, 5)
+        tensor = decode_sketch(cv2.imencode('.png', img)[1].tobytes())
+
+        self.assertEqual(tensor.shape, (1, 64, 64, 1))
+        self.assertEqual(set(np.unique(tensor)), {0, 1})
+
+    def test_invalid_images_raise_value_error(self):
+        for image_data in [b'', b'xx']:
+            with self.subTest(image_data=image_data), self.assertRaises(ValueError):
+                decode_sketch(image_data)
+
+
+class ProcessLocalCacheTestCase(TestCase):
+
+    def build(self, key):
+        self.builds.append(key)
+        return [key, len(self.builds)]
+
+    def setUp(self):
+        cache.clear()
+        self.builds = []
+
+    def test_values_are_built_once_per_key(self):
+        values = ProcessLocalCache('test', self.build)
+
+        self.assertEqual(values.get(1), [1, 1])
+        self.assertEqual(values.get(1), [1, 1])
+        self.assertEqual(values.get(2), [2, 2])
+        self.assertEqual(self.builds, [1, 2])
+
+    def test_invalidate_reaches_other_processes(self):
+        # two instances sharing the Django cache stand in for two worker processes
+        this_process, other_process = ProcessLocalCache('test', self.build), ProcessLocalCache('test', self.build)
+        this_process.get(1)
+        other_process.get(1)
+        other_process.get(2)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            this_process.invalidate(1)
+
+        self.assertEqual(other_process.get(1), [1, 4])
+        self.assertEqual(other_process.get(2), [2, 3])
+        self.assertEqual(this_process.get(1), [1, 5])
+
+    def test_invalidate_waits_for_the_commit(self):
+        this_process, other_process = ProcessLocalCache('test', self.build), ProcessLocalCache('test', self.build)
+        this_process.get(1)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            this_process.invalidate(1)
+
+            # rebuilt in another process between the write and the commit, from the rows before the write
+            self.assertEqual(other_process.get(1), [1, 2])
+            self.assertEqual(this_process.get(1), [1, 1])
+
+        self.assertEqual(other_process.get(1), [1, 3])
+        self.assertEqual(this_process.get(1), [1, 4])
+
+    def test_rolled_back_write_keeps_the_values(self):
+        values = ProcessLocalCache('test', self.build)
+        values.get(1)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            try:
+                with transaction.atomic():
+                    values.invalidate(1)
+                    raise ValueError
+            except ValueError:
+                pass
+
+        self.assertEqual(values.get(1), [1, 1])
+
+    def test_evicted_version_stamp_rebuilds(self):
+        values = ProcessLocalCache('test', self.build)
+        values.get(1)
+
+        cache.clear()
+
+        self.assertEqual(values.get(1), [1, 2])
+        self.assertEqual(values.get(1), [1, 2])
+
+
+class ReferenceImageTestCase(SimpleTestCase):
+
+    def setUp(self):
+        media_root = tempfile.TemporaryDirectory()
+        self.addCleanup(media_root.cleanup)
+        media_settings = override_settings(MEDIA_ROOT=media_root.name)
+        media_settings.enable()
+        self.addCleanup(media_settings.disable)
+
+        self.image_dir = os.path.join(media_root.name, REFERENCE_IMAGE_DIR)
+        os.makedirs(self.image_dir)
+        for name in [os.path.join(REFERENCE_IMAGE_DIR, 'cat.png'), 'secret.txt']:
+            with open(os.path.join(media_root.name, name), 'wb') as f:
+                f.write(b'image')
+
+    def test_validators(self):
+        response = self.client.get('/media/quiz_images/cat.png')
+        self.assertEqual(response.status_code, 200)
+
+        response = self.client.get('/media/quiz_images/cat.png', HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 304)
+
+    def test_streamed_by_django(self):
+        response = self.client.get('/media/quiz_images/cat.png')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b''.join(response.streaming_content), b'image')
+        self.assertEqual((response['Content-Type'], response['Content-Length']), ('image/png', '5'))
+        self.assertIn('max-age={}'.format(REFERENCE_IMAGE_MAX_AGE), response['Cache-Control'])
+        self.assertEqual(self.client.get('/media/quiz_images/dog.png').status_code, 404)
+
+    def test_sent_by_the_web_server(self):
+        os.makedirs(os.path.join(self.image_dir, 'sketch dir'))
+        with open(os.path.join(self.image_dir, 'sketch dir', 'cat.png'), 'wb') as f:
+            f.write(b'image')
+
+        url = '/media/quiz_images/sketch%20dir/cat.png'
+        for header, value in [('X-Accel-Redirect', '/protected/quiz_images/sketch%20dir/cat.png'),
+                              ('X-Sendfile', os.path.join(self.image_dir, 'sketch dir', 'cat.png'))]:
+            with self.subTest(header=header), self.settings(REFERENCE_IMAGE_SENDFILE=header):
+                response = self.client.get(url)
+
+                self.assertEqual(response.status_code, 200)
+                self.assertEqual((response[header], response['Content-Type'], response.content),
+                                 (value, 'image/png', b''))
+                self.assertIn('ETag', response)
+                self.assertIn('Last-Modified', response)
+
+                response = self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag'])
+                self.assertEqual(response.status_code, 304)
+                self.assertNotIn(header, response)
+
+    def test_no_validators_outside_the_image_directory(self):
+        for path in ['../secret.txt', '../' + REFERENCE_IMAGE_DIR + '/../secret.txt', '/etc/hostname']:
+            with self.subTest(path=path):
+                self.assertIsNone(reference_image_etag(None, path))
+
+        response = self.client.get('/media/quiz_images/..%2Fsecret.txt')
+        self.assertEqual(response.status_code, 400)
+        self.assertNotIn('ETag', response)
+        self.assertNotIn('Last-Modified', response)
+
+
+# the api migrations are not committed, the database test cases need `python manage.py makemigrations api` first,
+# the same step that creates the tables on deployment
+
+
+class SampleQuestionsTestCase(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.quiz, self.other_quiz = Quiz.objects.create(name='iq'), Quiz.objects.create(name='math')
+        self.questions = [QuizQuestion.objects.create(quiz=self.quiz, question='question {}'.format(i),
+                                                      dummy_answer1='a', dummy_answer2='b', answer='c')
+                          for i in range(5)]
+
+    def test_distinct_questions_of_the_quiz(self):
+        for _ in range(10):
+            questions = sample_questions(self.quiz, k=2)
+            self.assertEqual(len(set(questions)), 2)
+            self.assertTrue(set(questions) <= set(self.questions))
+
+        self.assertCountEqual(sample_questions(self.quiz, k=10), self.questions)
+        self.assertEqual(sample_questions(self.other_quiz, k=2), [])
+
+    def test_changed_questions_invalidate_the_pool(self):
+        sample_questions(self.quiz, k=5)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            added = QuizQuestion.objects.create(quiz=self.quiz, question='added', dummy_answer1='a',
+                                                dummy_answer2='b', answer='c')
+            moved = self.questions[0]
+            moved.quiz = self.other_quiz
+            moved.save()
+            self.questions[1].delete()
+
+        self.assertCountEqual(sample_questions(self.quiz, k=10), [added] + self.questions[2:])
+        self.assertEqual(sample_questions(self.other_quiz, k=2), [moved])
+
+
+class GradeAnswersTestCase(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.quiz = Quiz.objects.create(name='iq')
+        self.questions = [QuizQuestion.objects.create(quiz=self.quiz, question='question {}'.format(i),
+                                                      dummy_answer1='a', dummy_answer2='b',
+                                                      answer='Answer {}'.format(i)) for i in range(3)]
+
+    def test_marks(self):
+        answers = [{'question': self.questions[0].id, 'given_answer': 'answer 0'},
+                   {'question': str(self.questions[1].id), 'given_answer': 'ANSWER 1'},
+                   {'question': self.questions[2].id, 'given_answer': 'b'}]
+        self.assertEqual(grade_answers(self.quiz, answers), 2)
+        self.assertEqual(grade_answers(self.quiz, []), 0)
+
+    def test_malformed_submissions(self):
+        question = self.questions[0].id
+        other_quiz = QuizQuestion.objects.create(quiz=Quiz.objects.create(name='math'), question='question',
+                                                 dummy_answer1='a', dummy_answer2='b', answer='c')
+
+        for answers in [{'question': question, 'given_answer': 'a'}, 'answer', [None], [['question']],
+                        [{'given_answer': 'a'}], [{'question': question}], [{'question': question, 'given_answer': 1}],
+                        [{'question': 'x', 'given_answer': 'a'}], [{'question': other_quiz.id, 'given_answer': 'c'}]]:
+            with self.subTest(answers=answers):
+                self.assertIsNone(grade_answers(self.quiz, answers))
+
+    def test_malformed_submission_is_unprocessable(self):
+        client = APIClient()
+        client.force_authenticate(User.objects.create_user('user', 'user@example.com', 'password'))
+
+        response = client.post('/api/quiz_marks/record/iq/', [{'question': self.questions[0].id}], format='json')
+        self.assertEqual(response.status_code, 422)
+
+
+class ScoreSummaryTestCase(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user('user', 'user@example.com', 'password')
+        self.iq, self.math = Quiz.objects.create(name='iq'), Quiz.objects.create(name='math')
+        self.now = timezone.now()
+
+    def mark(self, quiz, marks, minutes):
+        return UserQuizMark.objects.create(user=self.user, quiz=quiz, marks=marks,
+                                           timestamp=self.now + timedelta(minutes=minutes))
+
+    def scores(self):
+        return {quiz: (entry['latest'], entry['previous']) for quiz, entry in get_quiz_scores(self.user.id).items()}
+
+    def test_summary_follows_mark_writes(self):
+        self.assertIsNone(get_quiz_scores(self.user.id))
+
+        self.mark(self.iq, 4, 0)
+        self.assertEqual(self.scores(), {'iq': (4, None)})
+
+        newest = self.mark(self.iq, 7, 2)
+        self.mark(self.iq, 5, 1)
+        self.mark(self.math, 9, 0)
+        self.assertEqual(self.scores(), {'iq': (7, 5), 'math': (9, None)})
+
+        newest.marks = 8
+        newest.save()
+        self.assertEqual(self.scores(), {'iq': (8, 5), 'math': (9, None)})
+
+        newest.delete()
+        self.assertEqual(self.scores(), {'iq': (5, 4), 'math': (9, None)})
+
+        UserQuizMark.objects.filter(quiz=self.math).delete()
+        self.assertEqual(self.scores(), {'iq': (5, 4)})
+
+        incremental = UserScoreSummary.objects.get(user=self.user).scores
+        self.assertEqual(rebuild_score_summary(self.user.id).scores, incremental)
+
+    def test_deleting_the_user(self):
+        self.mark(self.iq, 4, 0)
+        self.user.delete()
+        self.assertFalse(UserScoreSummary.objects.exists())
+
+    def test_concurrent_first_marks(self):
+        # another first mark of the user inserts the summary row right after this writer found none
+        update = QuerySet.update
+        raced = []
+
+        def racing_update(queryset, **kwargs):
+            updated = update(queryset, **kwargs)
+            if queryset.model is UserScoreSummary and not raced:
+                raced.append(True)
+                UserQuizMark.objects.create(user=self.user, quiz=self.math, marks=9, timestamp=self.now)
+            return updated
+
+        with mock.patch.object(QuerySet, 'update', racing_update):
+            self.mark(self.iq, 4, 0)
+
+        self.assertEqual(UserScoreSummary.objects.filter(user=self.user).count(), 1)
+        self.assertEqual(self.scores(), {'iq': (4, None), 'math': (9, None)})
+
+
+class QueryPlanTestCase(TestCase):
+    """ QueryPlanTestCase - plans of the benchmark_query_plans queries on the test database, without the seeding """
+
+    def test_queries_are_index_backed(self):
+        user = User.objects.create_user('user', 'user@example.com', 'password')
+        quiz = Quiz.objects.create(name='iq')
+        for i in range(3):
+            UserQuizMark.objects.create(user=user, quiz=quiz, marks=i)
+            QuizQuestion.objects.create(quiz=quiz, question='question {}'.format(i), dummy_answer1='a',
+                                        dummy_answer2='b', answer='c')
+
+        plans = {name: queryset.explain() for name, queryset in BenchmarkQueryPlans().queries(user.id, quiz).items()}
+
+        for name, plan in plans.items():
+            with self.subTest(query=name):
+                self.assertIsNone(FULL_SCAN.search(plan), plan)
+        self.assertIn('USING INDEX userquizmark_user_quiz_ts', plans['newest marks of a quiz'])
+        # sqlite indexes carry the rowid, so the quiz foreign key index covers the id pool just like (quiz, id)
+        self.assertIn('USING COVERING INDEX', plans['question id pool'])
+
+
+def csv_lines(*rows):
+    return ['question,image,dummy_answer1,dummy_answer2,answer\n'] + [row + '\n' for row in rows]
+
+
+class CSVImportTestCase(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.quiz = Quiz.objects.create(name='iq')
+
+    def test_invalid_rows_are_reported(self):
+        progress = []
+        report = import_questions(self.quiz, csv_lines(
+            'q1,,a,b,c', 'q2,,a,b', '', ',,a,b,c', 'q3,,a,b,{}'.format('c' * 256), 'q4,,a,b,c', 'q5,,a,b,c'
+        ), chunk_size=2, progress=lambda report: progress.append(report['created']))
+
+        self.assertEqual(report, {'rows': 6, 'created': 3, 'invalid': 3, 'errors': [
+            {'line': 3, 'errors': ['expected 5 columns, got 4']},
+            {'line': 5, 'errors': ['question is required']},
+            {'line': 6, 'errors': ['answer is longer than 255 characters']},
+        ]})
+        self.assertEqual(progress, [2, 3])
+        self.assertEqual(list(QuizQuestion.objects.values_list('question', flat=True).order_by('id')),
+                         ['q1', 'q4', 'q5'])
+
+    def test_detailed_errors_are_capped(self):
+        report = import_questions(self.quiz, csv_lines(*[',,a,b,c'] * 5), max_errors=2)
+        self.assertEqual((report['invalid'], len(report['errors'])), (5, 2))
+
+    def upload(self, content):
+        client = APIClient()
+        client.force_authenticate(User.objects.get_or_create(email='staff@example.com', username='staff',
+                                                             is_staff=True)[0])
+        return client.post('/api/upload_csv/', {'quiz': 'iq', 'file': SimpleUploadedFile('questions.csv', content)})
+
+    def test_upload(self):
+        response = self.upload(''.join(csv_lines('q1,,a,b,c', ',,a,b,c')).encode('utf-8'))
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual((response.data['created'], response.data['invalid']), (1, 1))
+
+        response = self.upload(''.join(csv_lines(',,a,b,c')).encode('utf-8'))
+        self.assertEqual(response.status_code, 400)
+
+    def test_upload_that_is_not_utf8(self):
+        response = self.upload(''.join(csv_lines('q1,,a,b,c', 'caf\xe9,,a,b,c')).encode('latin-1'))
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.data['detail'], 'Line 3 is not UTF-8 encoded, the rest of the file was not imported!')
+        self.assertEqual(response.data['created'], 1)
+
+    def test_background_import_that_is_not_utf8_fails(self):
+        with tempfile.NamedTemporaryFile(suffix='.csv', delete=False) as f:
+            f.write(''.join(csv_lines('caf\xe9,,a,b,c')).encode('latin-1'))
+
+        # the import runs in this thread, inside the test transaction
+        with mock.patch('api.csv_import.close_old_connections'):
+            _run_import_job('job', self.quiz, f.name)
+
+        job = get_import_job('job')
+        self.assertEqual(job['status'], 'failed')
+        self.assertIn('not UTF-8 encoded', job['detail'])
+        self.assertFalse(os.path.exists(f.name))
+
+
+class AsyncPredictTestCase(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user('user', 'user@example.com', 'password', id=1)
+        self.apple = Sketch.objects.create(name='Apple', image='quiz_images/apple.png')
+        Quiz.objects.create(name='drawing')
+
+        img = np.full((300, 300), 255, np.uint8)
+        cv2.line(img, (10, 10), (250, 200), 0, 5)
+        self.png = cv2.imencode('.png', img)[1].tobytes()
+
+        # a predictor that always ranks apple first, no archived files and room for two predictions
+        self.predictor = mock.Mock()
+        self.predictor.submit.side_effect = lambda sketch: self.top_3(SKETCH_CATEGORIES.index('apple'), 1, 2)
+        self.slots = threading.BoundedSemaphore(2)
+        self.archive_drawing = mock.Mock()
+
+        for target, value in [('api.inference.predictor', self.predictor), ('api.async_views._slots', self.slots),
+                              ('api.archive.archive_drawing', self.archive_drawing)]:
+            patcher = mock.patch(target, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def top_3(self, *indices):
+        future = Future()
+        future.set_result(list(indices))
+        return future
+
+    def post(self, url='/api/async/predict/', **data):
+        return APIClient().post(url, data)
+
+    def image(self):
+        return SimpleUploadedFile('apple.png', self.png, content_type='image/png')
+
+    def test_predict(self):
+        response = self.post(sketch_id=self.apple.id, image=self.image())
+
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.json(), {'score': 0.8, 'detail': 'Similarity above 80%'})
+        self.assertEqual(UserQuizMark.objects.get().marks, 8)
+
+        sketch, = self.predictor.submit.call_args[0]
+        np.testing.assert_array_equal(sketch, decode_sketch(self.png))
+        user, sketch_name, image_data, image_name, marks = self.archive_drawing.call_args[0]
+        self.assertEqual((user, sketch_name, image_data, image_name), (self.user, self.apple, self.png, 'apple.png'))
+
+        # the slot is released once the prediction is done
+        self.assertTrue(self.slots.acquire(blocking=False) and self.slots.acquire(blocking=False))
+
+    def test_busy(self):
+        self.slots.acquire()
+        self.slots.acquire()
+
+        response = self.post(sketch_id=self.apple.id, image=self.image())
+
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response['Retry-After'], str(settings.DOODLE_MODEL['ASYNC_RETRY_AFTER']))
+        self.assertEqual(response.json(), {'detail': 'Too many predictions in progress, try again shortly!'})
+        self.predictor.submit.assert_not_called()
+
+        self.slots.release()
+        self.assertEqual(self.post(sketch_id=self.apple.id, image=self.image()).status_code, 201)
+
+    def test_missing_fields(self):
+        required = ['This field is required.']
+        for url in ['/api/async/predict/', '/api/predict/']:
+            for data, errors in [({}, {'sketch_id': required, 'image': required}),
+                                 ({'sketch_id': self.apple.id}, {'image': required}),
+                                 ({'image': self.image()}, {'sketch_id': required})]:
+                with self.subTest(url=url, data=sorted(data)):
+                    response = self.post(url, **data)
+                    self.assertEqual((response.status_code, response.json()), (400, errors))
+
+        self.predictor.submit.assert_not_called()
+        self.assertTrue(self.slots.acquire(blocking=False) and self.slots.acquire(blocking=False))
+
+
+class UserActivationTestCase(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user('user', 'user@example.com', 'password')
+        self.uid, self.token = encode_uid(self.user.pk), default_token_generator.make_token(self.user)
+
+    def activate(self, uid, token):
+        return APIClient().get('/api/activate/{}/{}/'.format(uid, token))
+
+    def test_activation(self):
+        with mock.patch('api.api_views.user_activated.send') as user_activated:
+            response = self.activate(self.uid, self.token)
+
+        self.assertEqual(response.status_code, 204)
+        self.assertEqual(response.data, {'detail': 'Account activated successfully!'})
+        self.user.refresh_from_db()
+        self.assertTrue(self.user.is_active)
+        user_activated.assert_called_once()
+        self.assertEqual([message.to for message in mail.outbox], [['user@example.com']])
+
+    def test_invalid_uid_or_token(self):
+        for uid, token, data in [
+            ('x', self.token, {'uid': ["Invalid user id or user doesn't exist."]}),
+            (encode_uid(self.user.pk + 1), self.token, {'uid': ["Invalid user id or user doesn't exist."]}),
+            (self.uid, 'x-x', {'token': ['Invalid token for given user.']}),
+        ]:
+            with self.subTest(uid=uid, token=token):
+                response = self.activate(uid, token)
+                self.assertEqual((response.status_code, response.data), (400, data))
+
+        self.user.refresh_from_db()
+        self.assertFalse(self.user.is_active)
+        self.assertEqual(mail.outbox, [])
+
+    def test_stale_token(self):
+        self.assertEqual(self.activate(self.uid, self.token).status_code, 204)
+
+        response = self.activate(self.uid, self.token)
+        self.assertEqual((response.status_code, response.data), (400, {'detail': 'Stale token for given user.'}))
+        self.assertEqual(len(mail.outbox), 1)
+
+
+class IsStaffTestCase(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.staff = User.objects.create_user('staff', 'staff@example.com', 'password', is_staff=True, is_active=True)
+        self.user = User.objects.create_user('user', 'user@example.com', 'password', is_active=True)
+
+    def get_job(self, token):
+        # staff get a 404 for the unknown job, everyone else a 403
+        return APIClient().get('/api/upload_csv/missing/', HTTP_AUTHORIZATION='JWT {}'.format(token))
+
+    def test_issued_tokens_carry_the_claim(self):
+        for user, is_staff in [(self.staff, True), (self.user, False)]:
+            with self.subTest(user=user.email):
+                response = APIClient().post('/api/auth/jwt/create/', {'email': user.email, 'password': 'password'})
+
+                self.assertEqual(response.status_code, 200)
+                self.assertIs(AccessToken(response.data['access'])['is_staff'], is_staff)
+                self.assertIs(RefreshToken(response.data['refresh'])['is_staff'], is_staff)
+                self.assertEqual(self.get_job(response.data['access']).status_code, 404 if is_staff else 403)
+
+    def test_claim_is_trusted_without_a_lookup(self):
+        # the claim wins over the database until the token expires
+        for user, is_staff, status_code in [(self.user, True, 404), (self.staff, False, 403)]:
+            token = AccessToken.for_user(user)
+            token['is_staff'] = is_staff
+            with self.subTest(is_staff=is_staff), self.assertNumQueries(0):
+                self.assertEqual(self.get_job(token).status_code, status_code)
+
+    def test_legacy_tokens_fall_back_to_a_cached_lookup(self):
+        staff_token, user_token = AccessToken.for_user(self.staff), AccessToken.for_user(self.user)
+        self.assertNotIn('is_staff', staff_token)
+
+        with self.assertNumQueries(2):
+            self.assertEqual(self.get_job(staff_token).status_code, 404)
+            self.assertEqual(self.get_job(user_token).status_code, 403)
+
+        # served from the cache until STAFF_CLAIM_CACHE_TTL runs out
+        User.objects.filter(id=self.user.id).update(is_staff=True)
+        with self.assertNumQueries(0):
+            self.assertEqual(self.get_job(staff_token).status_code, 404)
+            self.assertEqual(self.get_job(user_token).status_code, 403)
+
+        with self.settings(STAFF_CLAIM_CACHE_TTL=0), self.assertNumQueries(1):
+            self.assertEqual(self.get_job(user_token).status_code, 404)
+
+
+class SharedCacheCheckTestCase(SimpleTestCase):
+
+    def test_process_local_cache_warns_on_deploy(self):
+        self.assertIn('api.W001', [warning.id for warning in run_checks(include_deployment_checks=True)])
+
+        with override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+                                                   'LOCATION': 'cache'}}):
+            self.assertNotIn('api.W001', [warning.id for warning in run_checks(include_deployment_checks=True)])
+
+
+class RecordingModel:
+    """ doodle_model stub that records its batches and always predicts apple """
+
+    version = 'recording'
+
+    def __init__(self):
+        self.batches = []
+
+    def load(self):
+        return self
+
+    def predict(self, batch):
+        self.batches.append(batch)
+        pred = np.zeros((len(batch), len(SKETCH_CATEGORIES)), dtype=np.float32)
+        pred[:, SKETCH_CATEGORIES.index('apple')] = 1
+        return pred
+
+
+class RescoreSketchesTestCase(TestCase):
+
+    def setUp(self):
+        media_root = tempfile.TemporaryDirectory()
+        self.addCleanup(media_root.cleanup)
+        media_settings = override_settings(MEDIA_ROOT=media_root.name)
+        media_settings.enable()
+        self.addCleanup(media_settings.disable)
+        self.checkpoint = os.path.join(media_root.name, 'rescore_sketches.json')
+
+        self.user = User.objects.create_user('user', 'user@example.com', 'password')
+        self.apple = Sketch.objects.create(name='Apple', image='quiz_images/apple.png')
+        self.quiz = Quiz.objects.create(name='drawing')
+
+    def mark(self):
+        return UserQuizMark.objects.create(user=self.user, quiz=self.quiz, marks=0)
+
+    def test_drawings_are_rescored_from_what_the_model_was_fed(self):
+        img = np.full((300, 300), 255, np.uint8)
+        cv2.line(img, (10, 10), (250, 200), 0, 5)
+        png = cv2.imencode('.png', img)[1].tobytes()
+        DrawnSketch.objects.create(user=self.user, image=ContentFile(png, name='apple.png'), image_name=self.apple,
+                                   marks=self.mark())
+
+        strokes = [[[0, 120, 255], [0, 200, 40]], [[30, 60], [250, 10]]]
+        with mock.patch('api.archive.close_old_connections'):
+            _archive_strokes(self.user, self.apple, strokes, self.mark())
+
+        # a stroke upload archived before DrawnSketch.strokes existed, stored as strokes_<suffix>.png
+        unrecorded = DrawnSketch.objects.create(user=self.user, image=ContentFile(png, name='strokes.png'),
+                                                image_name=self.apple, marks=self.mark())
+        self.assertRegex(unrecorded.image.name, r'^sketches/strokes_\w{7}\.png$')
+
+        # the drawings are decoded in spawned processes, the checkpoint goes to MEDIA_ROOT
+        model = RecordingModel()
+        with mock.patch('api.inference.doodle_model', model):
+            call_command('rescore_sketches', workers=2, stdout=io.StringIO())
+
+        batch, = model.batches
+        np.testing.assert_array_equal(batch[0], decode_sketch(png)[0])
+        np.testing.assert_array_equal(batch[1], rasterize_strokes(strokes)[0])
+
+        self.assertEqual(list(UserQuizMark.objects.order_by('id').values_list('marks', flat=True)), [8, 8, 0])
+        with open(self.checkpoint) as f:
+            checkpoint = json.load(f)
+        self.assertEqual((checkpoint['rescored'], checkpoint['skipped'], checkpoint['unrecorded_strokes']), (2, 1, 1))
+
+        stdout = io.StringIO()
+        with mock.patch('api.inference.doodle_model', model):
+            call_command('rescore_sketches', workers=1, checkpoint=self.checkpoint, stdout=stdout)
+        self.assertIn('already scored by recording', stdout.getvalue())
+        self.assertEqual(len(model.batches), 1)
@@ -1,13 +1,22 @@
 from django.urls import path
-from api.api_views import UserActivationView, QuizCSVImportAPIView, QuizQuestionAPIView, QuizMarksAPIView, ScoreAPIView, \
-    GetSketchAPIView, PredictAPIView
+from api import async_views
+from api.api_views import UserActivationView, QuizCSVImportAPIView, QuizCSVImportJobAPIView, QuizQuestionAPIView, \
+    QuizMarksAPIView, ScoreAPIView, GetSketchAPIView, PredictAPIView, PredictStrokesAPIView, ModelReadinessAPIView, \
+    InferenceStatsAPIView
 
 urlpatterns = [
     path('activate/<str:uid>/<str:token>/', UserActivationView.as_view(), name='user_activation'),
     path('upload_csv/', QuizCSVImportAPIView.as_view(), name='csv_import'),
+    path('upload_csv/<str:job_id>/', QuizCSVImportJobAPIView.as_view(), name='csv_import_job'),
     path('quiz_questions/<str:name>/', QuizQuestionAPIView.as_view(), name='quiz_questions'),
     path('quiz_marks/record/<str:name>/', QuizMarksAPIView.as_view(), name='record_quiz_marks'),
     path('quiz_performance/<slug>/', ScoreAPIView.as_view(), name='scores'),
     path('sketch/', GetSketchAPIView.as_view(), name='drawing'),
     path('predict/', PredictAPIView.as_view(), name='predict'),
+    path('predict/strokes/', PredictStrokesAPIView.as_view(), name='predict_strokes'),
+    # async variants, only worth it when served by an ASGI server
+    path('async/sketch/', async_views.sketch, name='async_drawing'),
+    path('async/predict/', async_views.predict, name='async_predict'),
+    path('health/ready/', ModelReadinessAPIView.as_view(), name='readiness'),
+    path('inference/stats/', InferenceStatsAPIView.as_view(), name='inference_stats'),
 ]
@@ -1,3 +1,68 @@
-from django.shortcuts import render
+import mimetypes
+import os
+from datetime import datetime, timezone
+from urllib.parse import quote
+from django.conf import settings
+from django.core.exceptions import SuspiciousFileOperation
+from django.http import FileResponse, Http404, HttpResponse
+from django.utils._os import safe_join
+from django.views.decorators.cache import cache_control
+from django.views.decorators.http import condition
 
-# Create your views here.
+# reference images are only ever replaced by uploads under a new name, clients may keep them for a month
+REFERENCE_IMAGE_MAX_AGE = 60 * 60 * 24 * 30
+REFERENCE_IMAGE_DIR = 'quiz_images'
+
+
+def _reference_image_path(path):
+    """ Filesystem path of a reference image, raises SuspiciousFileOperation for paths outside the image directory """
+
+    return safe_join(os.path.join(settings.MEDIA_ROOT, REFERENCE_IMAGE_DIR), path)
+
+
+def _reference_image_stat(path):
+    try:
+        # no validators for paths outside the image directory, reference_image() refuses those too
+        return os.stat(_reference_image_path(path))
+    except (OSError, ValueError, SuspiciousFileOperation):
+        return None
+
+
+def reference_image_etag(request, path):
+    stat = _reference_image_stat(path)
+    return '{:x}-{:x}'.format(stat.st_mtime_ns, stat.st_size) if stat else None
+
+
+def reference_image_last_modified(request, path):
+    stat = _reference_image_stat(path)
+    return datetime.fromtimestamp(stat.st_mtime, tz=timezone.utc) if stat else None
+
+
+@cache_control(public=True, max_age=REFERENCE_IMAGE_MAX_AGE)
+@condition(etag_func=reference_image_etag, last_modified_func=reference_image_last_modified)
+def reference_image(request, path):
+    """
+        Serves the sketch and quiz reference images with ETag / Last-Modified validators and long cache headers,
+        repeat requests from a client that already has the image get an empty 304
+
+        With REFERENCE_IMAGE_SENDFILE set, the web server sends the file named in that header, otherwise Django
+        streams it.
+    """
+
+    full_path = _reference_image_path(path)
+    if not os.path.isfile(full_path):
+        raise Http404('"{}" does not exist'.format(path))
+
+    header = settings.REFERENCE_IMAGE_SENDFILE
+    if not header:
+        return FileResponse(open(full_path, 'rb'))
+
+    content_type, _ = mimetypes.guess_type(full_path)
+    response = HttpResponse(content_type=content_type or 'application/octet-stream')
+    if header == 'X-Accel-Redirect':
+        # an internal nginx location aliased to the image directory
+        relative_path = os.path.relpath(full_path, os.path.join(settings.MEDIA_ROOT, REFERENCE_IMAGE_DIR))
+        response[header] = settings.REFERENCE_IMAGE_SENDFILE_URL + quote(relative_path.replace(os.sep, '/'))
+    else:
+        response[header] = full_path
+    return response
@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/3.2/ref/settings/
 """
 import os
+import sys
 from pathlib import Path
 from decouple import config
 
@@ -19,6 +20,11 @@ config.encoding = 'cp1251'
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
 
+# Shared QuickDraw tooling (doodle_data) lives at the repository root, next to the training notebooks
+REPO_DIR = BASE_DIR.parent.parent
+if str(REPO_DIR) not in sys.path:
+    sys.path.append(str(REPO_DIR))
+
 
 # Quick-start development settings - unsuitable for production
 # See https://docs.djangoproject.com/en/3.2/howto/deployment/checklist/
@@ -89,6 +95,20 @@ DATABASES = {
 }
 
 
+# Cache
+# https://docs.djangoproject.com/en/3.2/topics/cache/
+# every worker keeps its own copy of cached querysets (api.caching), the version stamps that invalidate
+# them live here, as does the progress of background csv imports, so with several worker processes point this
+# to a shared backend such as memcached or redis (`manage.py check --deploy` warns about a process-local one)
+
+CACHES = {
+    'default': {
+        'BACKEND': config('CACHE_BACKEND', default='django.core.cache.backends.locmem.LocMemCache'),
+        'LOCATION': config('CACHE_LOCATION', default='doodle-api'),
+    }
+}
+
+
 # Password validation
 # https://docs.djangoproject.com/en/3.2/ref/settings/#auth-password-validators
 
@@ -119,6 +139,10 @@ SIMPLE_JWT = {
    'AUTH_HEADER_TYPES': ('JWT',),
 }
 
+# IsStaff reads the is_staff claim of access tokens, tokens issued without it fall back to a database lookup
+# cached for this many seconds (0 queries the database every time)
+STAFF_CLAIM_CACHE_TTL = config('STAFF_CLAIM_CACHE_TTL', default=60, cast=int)
+
 # Djoser settings
 # https://djoser.readthedocs.io/en/latest/settings.html#user-id-field
 
@@ -170,6 +194,14 @@ STATICFILES_DIRS = [
 MEDIA_URL = '/media/'
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
 
+# the quiz reference images under MEDIA_ROOT/quiz_images are answered by api.views.reference_image, which handles
+# the cache validators. REFERENCE_IMAGE_SENDFILE 'X-Accel-Redirect' (nginx, pointing at the internal location
+# REFERENCE_IMAGE_SENDFILE_URL) or 'X-Sendfile' (Apache mod_xsendfile, lighttpd) leaves sending the file to the
+# web server, left empty Django streams it itself
+
+REFERENCE_IMAGE_SENDFILE = config('REFERENCE_IMAGE_SENDFILE', default='')
+REFERENCE_IMAGE_SENDFILE_URL = config('REFERENCE_IMAGE_SENDFILE_URL', default='/protected/quiz_images/')
+
 
 # # SMTP Configurations
 
@@ -180,6 +212,50 @@ EMAIL_HOST_USER = config('EMAIL_HOST_USER')
 EMAIL_HOST_PASSWORD = config('EMAIL_HOST_PASSWORD')
 EMAIL_USE_TLS = True
 
+# Doodle CNN
+# BACKEND 'keras' serves the float32 model at PATH, 'tflite' the int8 export at TFLITE_PATH
+# (python -m doodle_data.quantize export), run on NUM_THREADS interpreter threads (None lets TFLite pick)
+# PRELOAD loads and warms the model from ApiConfig.ready() instead of on the first prediction
+# concurrent predictions are batched up to MAX_BATCH_SIZE sketches or MAX_WAIT_MS of queueing
+# stroke uploads are rendered with the same RENDERER and LINE_WIDTH the served model was trained on
+# the async (ASGI) predict endpoint decodes on ASYNC_WORKERS threads and answers 429, Retry-After
+# ASYNC_RETRY_AFTER seconds, once ASYNC_MAX_PENDING predictions are in flight
+# with POOL_SOCKET set, web workers don't load the model, they send their batches to the inference pool
+# started with `manage.py run_inference_pool` (POOL_WORKERS processes) and fail them after POOL_TIMEOUT seconds,
+# the pool uses Unix sockets and fork and runs on Linux only
+# the top 3 of the last CACHE_SIZE distinct sketches are kept for CACHE_TTL seconds per worker (0 disables it)
+
+DOODLE_MODEL = {
+    'BACKEND': config('DOODLE_MODEL_BACKEND', default='keras'),
+    'PATH': os.path.join(BASE_DIR, 'static', 'model', 'doodle_cnn', 'model.h5'),
+    'TFLITE_PATH': os.path.join(BASE_DIR, 'static', 'model', 'doodle_cnn', 'model_int8.tflite'),
+    'NUM_THREADS': config('DOODLE_MODEL_NUM_THREADS', default=None, cast=lambda value: int(value) if value else None),
+    'PRELOAD': config('DOODLE_MODEL_PRELOAD', default=False, cast=bool),
+    'MAX_BATCH_SIZE': config('DOODLE_MODEL_MAX_BATCH_SIZE', default=32, cast=int),
+    'MAX_WAIT_MS': config('DOODLE_MODEL_MAX_WAIT_MS', default=5, cast=float),
+    'RENDERER': 'pil',
+    'LINE_WIDTH': 5,
+    'ASYNC_WORKERS': config('DOODLE_MODEL_ASYNC_WORKERS', default=4, cast=int),
+    'ASYNC_MAX_PENDING': config('DOODLE_MODEL_ASYNC_MAX_PENDING', default=256, cast=int),
+    'ASYNC_RETRY_AFTER': 1,
+    'POOL_SOCKET': config('DOODLE_MODEL_POOL_SOCKET', default=''),
+    'POOL_WORKERS': config('DOODLE_MODEL_POOL_WORKERS', default=2, cast=int),
+    'POOL_TIMEOUT': 10,
+    'CACHE_SIZE': config('DOODLE_MODEL_CACHE_SIZE', default=10000, cast=int),
+    'CACHE_TTL': config('DOODLE_MODEL_CACHE_TTL', default=60 * 60, cast=int),
+}
+
+# Quiz csv import
+# rows are inserted in CHUNK_SIZE transactions and at most MAX_ERRORS invalid rows are reported in detail
+# uploads above BACKGROUND_SIZE bytes are imported in the background, their progress is kept in the cache,
+# which must be shared by the workers for the progress to be polled from any of them
+
+QUIZ_IMPORT = {
+    'CHUNK_SIZE': config('QUIZ_IMPORT_CHUNK_SIZE', default=500, cast=int),
+    'MAX_ERRORS': 100,
+    'BACKGROUND_SIZE': config('QUIZ_IMPORT_BACKGROUND_SIZE', default=2 * 1024 * 1024, cast=int),
+}
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/3.2/ref/settings/#default-auto-field
 
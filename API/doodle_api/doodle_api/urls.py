@@ -15,10 +15,15 @@ Including another URLconf
 """
 from django.contrib import admin
 from django.urls import path, include
+from api.api_views import StaffTokenObtainPairView
+from api.views import reference_image
 
 urlpatterns = [
     path('admin/', admin.site.urls),
     path('api/', include('api.urls')),
     path('api/auth/', include('djoser.urls')),
+    # ahead of djoser's jwt/create, tokens carry the staff claim read by api.permissions.IsStaff
+    path('api/auth/jwt/create/', StaffTokenObtainPairView.as_view(), name='jwt-create'),
     path('api/auth/', include('djoser.urls.jwt')),
+    path('media/quiz_images/<path:path>', reference_image, name='reference_image'),
 ]
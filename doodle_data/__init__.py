@@ -0,0 +1,3 @@
+"""
+    doodle_data - QuickDraw dataset tooling shared by the training notebooks and the doodle API
+"""
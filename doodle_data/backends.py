@@ -0,0 +1,113 @@
+"""
+    Inference backends for the doodle CNN, used by the API's ModelRegistry and by doodle_data.quantize
+
+    Every backend loads one model artifact and maps a float32 (N, 64, 64, 1) batch to (N, classes)
+    probabilities. 'keras' serves the trained model.h5, 'tflite' the compact artifact exported with
+    `python -m doodle_data.quantize export` (int8 weights and activations, float input and output).
+    load() also sets version, the backend name and a content digest of the artifact it loaded.
+"""
+import hashlib
+import numpy as np
+
+
+def artifact_version(name, path, chunk_size=1024 ** 2):
+    """ '{name}:{digest}' of a model file, the same artifact has the same version on every host """
+
+    digest = hashlib.blake2b(digest_size=12)
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return '{}:{}'.format(name, digest.hexdigest())
+
+
+class KerasBackend:
+    """ KerasBackend - the float32 Keras model as trained """
+
+    name = 'keras'
+
+    def __init__(self, path, num_threads=None, **kwargs):
+        self.path = path
+        self.num_threads = num_threads
+        self.version = None
+        self._model = None
+
+    def load(self):
+        self.version = artifact_version(self.name, self.path)
+
+        if self.num_threads:
+            import tensorflow as tf
+
+            # only takes effect before the TensorFlow runtime initializes, i.e. in a fresh process
+            tf.config.threading.set_intra_op_parallelism_threads(self.num_threads)
+            tf.config.threading.set_inter_op_parallelism_threads(1)
+
+        import keras
+
+        self._model = keras.models.load_model(self.path, compile=False)
+
+    def predict(self, batch):
+        # predict() sets up a tf.data pipeline per call, for request sized batches that dwarfs the forward pass
+        return self._model.predict_on_batch(batch)
+
+
+class TFLiteBackend:
+    """
+        TFLiteBackend - a TFLite flatbuffer run by the TFLite interpreter
+
+        The interpreter is resized whenever the batch size changes, the micro batcher's batch sizes settle
+        quickly so this is rare. It is not thread-safe, the ModelRegistry serializes predict calls.
+    """
+
+    name = 'tflite'
+
+    def __init__(self, path, num_threads=None, **kwargs):
+        self.path = path
+        self.num_threads = num_threads
+        self.version = None
+        self._interpreter = None
+        self._batch_size = None
+
+    def load(self):
+        self.version = artifact_version(self.name, self.path)
+
+        try:
+            from ai_edge_litert.interpreter import Interpreter
+        except ImportError:
+            import tensorflow as tf
+
+            Interpreter = tf.lite.Interpreter
+
+        self._interpreter = Interpreter(model_path=self.path, num_threads=self.num_threads)
+        self._input = self._interpreter.get_input_details()[0]
+        self._output = self._interpreter.get_output_details()[0]
+        self._interpreter.allocate_tensors()
+        self._batch_size = int(self._input['shape'][0])
+
+    def _resize(self, batch_size):
+        self._interpreter.resize_tensor_input(self._input['index'], [batch_size] + list(self._input['shape'][1:]))
+        self._interpreter.allocate_tensors()
+        self._batch_size = batch_size
+
+    def predict(self, batch):
+        if len(batch) != self._batch_size:
+            self._resize(len(batch))
+
+        self._interpreter.set_tensor(self._input['index'], np.ascontiguousarray(batch, dtype=np.float32))
+        self._interpreter.invoke()
+        return self._interpreter.get_tensor(self._output['index'])
+
+
+BACKENDS = {
+    'keras': KerasBackend,
+    'tflite': TFLiteBackend,
+}
+
+
+def get_backend(name, path, **kwargs):
+    """ Returns an unloaded backend by name, see BACKENDS """
+
+    try:
+        backend = BACKENDS[name]
+    except KeyError:
+        raise ValueError('Unknown doodle model backend {!r}, expected one of {}'.format(name, ', '.join(BACKENDS)))
+    return backend(path, **kwargs)
@@ -0,0 +1,87 @@
+"""
+    Rasterizer benchmark - images/sec of the notebook renderers against rasterize_batch
+
+    Usage:
+        python -m doodle_data.benchmark --csv dataset/airplane.csv --nrows 20000
+        python -m doodle_data.benchmark                      # synthetic QuickDraw-like drawings
+"""
+import argparse
+import json
+import time
+import numpy as np
+import pandas as pd
+from doodle_data.rasterizer import draw_cv2, draw_it, pack_drawings, rasterize_batch
+
+LEGACY_RENDERERS = {
+    'cv2': draw_cv2,
+    'pil': draw_it,
+}
+
+
+def synthetic_drawings(n, seed=0):
+    """ Random walks with roughly the stroke and point counts of simplified QuickDraw drawings """
+
+    rng = np.random.default_rng(seed)
+    drawings = []
+    for _ in range(n):
+        drawing = []
+        for _ in range(rng.integers(1, 8)):
+            points = np.clip(rng.integers(0, 256, 2) + rng.normal(0, 12, (rng.integers(2, 25), 2)).cumsum(0), 0, 255)
+            drawing.append([points[:, 0].astype(int).tolist(), points[:, 1].astype(int).tolist()])
+        drawings.append(drawing)
+    return drawings
+
+
+def timed(func, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = func()
+        best = min(best, time.perf_counter() - started)
+    return best, result
+
+
+def run(drawings, size=64, lw=6, backends=('cv2', 'pil'), repeat=3):
+    """ Benchmarks every backend on the given drawings and returns images/sec of both implementations """
+
+    packed = pack_drawings(drawings)
+    out = np.empty((len(drawings), size, size), dtype=np.uint8)
+    report = {}
+
+    for backend in backends:
+        legacy = LEGACY_RENDERERS[backend]
+
+        legacy_time, expected = timed(lambda: np.stack([legacy(d, size=size, lw=lw) for d in drawings]), repeat)
+        batch_time, actual = timed(lambda: rasterize_batch(*packed, size=size, lw=lw, backend=backend, out=out), repeat)
+
+        report[backend] = {
+            'legacy_images_per_sec': round(len(drawings) / legacy_time),
+            'batch_images_per_sec': round(len(drawings) / batch_time),
+            'speedup': round(legacy_time / batch_time, 2),
+            'identical': bool(np.array_equal(expected, actual)),
+        }
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--csv', help='QuickDraw csv with a drawing column, synthetic drawings when omitted')
+    parser.add_argument('--nrows', type=int, default=10000)
+    parser.add_argument('--size', type=int, default=64)
+    parser.add_argument('--lw', type=int, default=6)
+    parser.add_argument('--backend', choices=sorted(LEGACY_RENDERERS), action='append')
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    if args.csv:
+        drawings = pd.read_csv(args.csv, nrows=args.nrows, usecols=['drawing'])['drawing'].apply(json.loads).tolist()
+    else:
+        drawings = synthetic_drawings(args.nrows)
+
+    report = run(drawings, size=args.size, lw=args.lw, backends=args.backend or sorted(LEGACY_RENDERERS),
+                 repeat=args.repeat)
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
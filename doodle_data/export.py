@@ -0,0 +1,126 @@
+"""
+    Parallel exporter of the QuickDraw category csvs to PNG files sorted into per-class folders
+
+    Replaces the render-and-save loop of `Dataset to imgs.ipynb` and the second sorting pass of
+    img2folders.py. The parent streams every category csv in chunks, a process pool parses and rasterizes
+    each chunk in one batch (draw_it's renderer, black strokes on white at 256x256) and writes
+    {output_dir}/{word}/{word}_{i}.png straight into the class folder. manifest.json records the finished
+    chunks of every category, so a rerun skips them without checking any file on disk.
+
+    Usage:
+        python -m doodle_data.export dataset "D:/doodle images" --workers 8
+"""
+import argparse
+import os
+import time
+from concurrent.futures import ALL_COMPLETED, FIRST_COMPLETED, ProcessPoolExecutor, wait
+import cv2
+import pandas as pd
+from doodle_data.shards import read_manifest, write_manifest
+from doodle_data.shuffle import list_categories
+from doodle_data.strokes import parse_drawings
+
+
+def export_chunk(output_dir, word, start, texts, size=256, lw=5, backend='pil'):
+    """ Renders one chunk of a category and writes its PNGs, rows are numbered from `start` """
+
+    images = parse_drawings(texts).rasterize(size=size, lw=lw, backend=backend)
+    class_dir = os.path.join(output_dir, word)
+    for i, image in enumerate(images, start):
+        cv2.imwrite(os.path.join(class_dir, '{}_{}.png'.format(word, i)), image)
+
+    return word, start, len(images)
+
+
+def export_pngs(input_dir, output_dir, size=256, lw=5, backend='pil', chunksize=1000, workers=None):
+    """
+        Exports every drawing of every category csv in input_dir to output_dir/{word}/{word}_{i}.png
+
+        Returns the manifest. Rerunning with the same arguments only exports chunks not finished before.
+    """
+
+    categories = list_categories(input_dir)
+    for word in categories:
+        os.makedirs(os.path.join(output_dir, word), exist_ok=True)
+
+    params = {'size': size, 'lw': lw, 'backend': backend, 'chunksize': chunksize}
+    manifest = read_manifest(output_dir) or dict(params, chunks={}, categories={})
+    if any(manifest[key] != value for key, value in params.items()):
+        raise ValueError('{} was exported with {}, not {}'.format(
+            output_dir, {key: manifest[key] for key in params}, params))
+
+    started = time.perf_counter()
+    written = 0
+    # chunks still rendering per category, and the row count of categories read to the end
+    in_flight, totals = {}, {}
+
+    def finish(word):
+        manifest['categories'][word] = totals.pop(word)
+        manifest['chunks'].pop(word, None)
+        print('exported {} ({} images, {:.0f} files/sec)'.format(
+            word, manifest['categories'][word], written / (time.perf_counter() - started)))
+
+    def collect(futures, return_when=FIRST_COMPLETED):
+        nonlocal written
+        done, pending = wait(futures, return_when=return_when)
+        for future in done:
+            word, start, rows = future.result()
+            manifest['chunks'].setdefault(word, []).append(start)
+            written += rows
+            in_flight[word] -= 1
+            if not in_flight[word] and word in totals:
+                finish(word)
+        if done:
+            write_manifest(output_dir, manifest)
+        return pending
+
+    workers = workers or os.cpu_count() or 1
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        pending = set()
+
+        for word in categories:
+            if word in manifest['categories']:
+                continue
+
+            finished = set(manifest['chunks'].get(word, []))
+            in_flight[word] = rows = 0
+            for df in pd.read_csv(os.path.join(input_dir, word + '.csv'), usecols=['drawing'], chunksize=chunksize):
+                if rows not in finished:
+                    pending.add(pool.submit(export_chunk, output_dir, word, rows, df['drawing'].values, size=size,
+                                            lw=lw, backend=backend))
+                    in_flight[word] += 1
+                rows += len(df)
+
+                # a couple of chunks per worker in flight, the parent never holds more drawings than that
+                if len(pending) >= 2 * workers:
+                    pending = collect(pending)
+
+            totals[word] = rows
+            if not in_flight[word]:
+                finish(word)
+                write_manifest(output_dir, manifest)
+
+        collect(pending, ALL_COMPLETED)
+
+    elapsed = time.perf_counter() - started
+    print('{} files in {:.0f}s, {:.0f} files/sec'.format(written, elapsed, written / elapsed if elapsed else 0))
+    return manifest
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('input_dir', help='directory of per-category QuickDraw csvs')
+    parser.add_argument('output_dir')
+    parser.add_argument('--size', type=int, default=256)
+    parser.add_argument('--lw', type=int, default=5)
+    parser.add_argument('--backend', choices=['cv2', 'pil'], default='pil')
+    parser.add_argument('--chunksize', type=int, default=1000, help='drawings rendered per task')
+    parser.add_argument('--workers', type=int, help='worker processes, defaults to the cpu count')
+    args = parser.parse_args()
+
+    export_pngs(args.input_dir, args.output_dir, size=args.size, lw=args.lw, backend=args.backend,
+                chunksize=args.chunksize, workers=args.workers)
+
+
+if __name__ == '__main__':
+    main()
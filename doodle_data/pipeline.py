@@ -0,0 +1,149 @@
+"""
+    Multi-worker prefetching training input pipeline over the shuffled csv shards
+
+    Worker processes read shuffled_csv/train_k{k}.csv.gz in batch-sized chunks, parse and rasterize every
+    chunk and push the batches into a bounded queue, so parsing and rendering run ahead of the training step
+    on several cores. Every batch that is built is yielded. stats() reports batches/sec and how long the
+    consumer stalled waiting on input; a high stall fraction means the model is starved.
+
+    Usage:
+        pipeline = InputPipeline('shuffled_csv', ks=range(NCSVS - 1), batch_size=512, num_classes=163)
+        model.fit(iter(pipeline), steps_per_epoch=STEPS, epochs=epochs,
+                  callbacks=[tf.keras.callbacks.LambdaCallback(on_epoch_end=lambda *_: print(pipeline.stats()))])
+"""
+import multiprocessing
+import os
+import queue
+import threading
+import time
+import numpy as np
+from doodle_data.strokes import read_strokes
+
+
+def _worker(tasks, batches, csv_dir, batch_size, size, lw, backend):
+    """ Worker process - turns shard ids from `tasks` into (uint8 images, int16 labels) batches """
+
+    while True:
+        k = tasks.get()
+        if k is None:
+            break
+
+        filename = os.path.join(csv_dir, 'train_k{}.csv.gz'.format(k))
+        for strokes, df in read_strokes(filename, chunksize=batch_size):
+            x = strokes.rasterize(size=size, lw=lw, backend=backend)
+            batches.put((x, df['y'].to_numpy(dtype=np.int16)))
+
+
+class InputPipeline:
+    """
+        InputPipeline - parallel, prefetching replacement for DataGenerator.ipynb's image_generator
+
+        Yields (float32 (B, size, size, 1) images scaled to 0-1, one-hot float32 labels) forever, visiting
+        the shards in a new random order every epoch. At most `prefetch` batches are buffered ahead.
+    """
+
+    def __init__(self, csv_dir, ks, batch_size=512, num_classes=163, size=64, lw=6, backend='cv2', workers=None,
+                 prefetch=16, seed=None):
+        self.csv_dir = csv_dir
+        self.ks = list(ks)
+        self.batch_size = batch_size
+        self.num_classes = num_classes
+        self.size = size
+        self.lw = lw
+        self.backend = backend
+        self.workers = workers or max(1, (os.cpu_count() or 2) - 1)
+        self.prefetch = prefetch
+        self.seed = seed
+
+        self._processes = []
+        self._tasks = None
+        self._batches_queue = None
+        self._closed = threading.Event()
+
+        self._started = None
+        self._batches = 0
+        self._images = 0
+        self._stalled = 0.0
+
+    def _feed(self, tasks):
+        """ Feeder thread - queues shard ids epoch after epoch, blocking while the workers are busy """
+
+        rng = np.random.default_rng(self.seed)
+        while not self._closed.is_set():
+            for k in rng.permutation(self.ks):
+                tasks.put(int(k))
+
+    def start(self):
+        if self._processes:
+            return
+
+        # spawned workers stay clear of the parent's TensorFlow threads and work the same on Windows
+        context = multiprocessing.get_context('spawn')
+        self._tasks = context.Queue(maxsize=self.workers)
+        self._batches_queue = context.Queue(maxsize=self.prefetch)
+
+        for _ in range(self.workers):
+            process = context.Process(target=_worker, daemon=True, args=(
+                self._tasks, self._batches_queue, self.csv_dir, self.batch_size, self.size, self.lw, self.backend))
+            process.start()
+            self._processes.append(process)
+
+        threading.Thread(target=self._feed, args=(self._tasks,), name='input-pipeline-feeder', daemon=True).start()
+
+    def _next_batch(self):
+        while True:
+            try:
+                return self._batches_queue.get(timeout=1)
+            except queue.Empty:
+                if not any(process.is_alive() for process in self._processes):
+                    raise RuntimeError('All input pipeline workers exited, check their output for the error')
+
+    def close(self):
+        self._closed.set()
+        for process in self._processes:
+            process.terminate()
+        self._processes = []
+
+        # the queues may still hold batches nobody will read, don't block interpreter exit flushing them
+        # (they don't exist yet when close() runs before start() or after it failed early)
+        for tasks_or_batches in (self._tasks, self._batches_queue):
+            if tasks_or_batches is not None:
+                tasks_or_batches.cancel_join_thread()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __iter__(self):
+        self.start()
+        labels = np.eye(self.num_classes, dtype=np.float32)
+
+        while True:
+            waiting = time.perf_counter()
+            x, y = self._next_batch()
+            now = time.perf_counter()
+
+            if self._started is None:
+                self._started = waiting
+            self._stalled += now - waiting
+            self._batches += 1
+            self._images += len(y)
+
+            # normalize the image arr and one-hot encode the categories
+            x = (x / np.float32(255)).reshape((len(y), self.size, self.size, 1))
+            yield x, labels[y]
+
+    def stats(self):
+        """ Throughput since the first batch was requested, `stall_fraction` is the share spent waiting on input """
+
+        elapsed = time.perf_counter() - self._started if self._started is not None else 0
+        return {
+            'batches': self._batches,
+            'batches_per_sec': round(self._batches / elapsed, 2) if elapsed else 0,
+            'images_per_sec': round(self._images / elapsed) if elapsed else 0,
+            'stalled_sec': round(self._stalled, 2),
+            'stall_fraction': round(self._stalled / elapsed, 3) if elapsed else 0,
+        }
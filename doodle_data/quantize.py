@@ -0,0 +1,259 @@
+"""
+    Quantized TFLite export of the doodle CNN for CPU serving, and a report comparing it to the Keras model
+
+    export converts model.h5 with full integer quantization: weights and activations are int8, calibrated on
+    a sample of the image shards (see doodle_data.shards), while the input and output stay float32 so the
+    API's preprocessing is unchanged. compare runs both models on a held-out sample of the shards, each in
+    a fresh process so their memory is measured separately, and reports top-1 / top-3 agreement, latency
+    and memory. Both refuse shards rendered differently from the images the served model sees, see
+    SERVED_RENDER. Memory is read from /proc, or psutil where there is no /proc, and left out without either.
+
+    Usage:
+        python -m doodle_data.quantize export model.h5 model_int8.tflite --shards image_shards --samples 1000
+        python -m doodle_data.quantize compare model.h5 model_int8.tflite --shards image_shards --report report.json
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import time
+import numpy as np
+from doodle_data.backends import get_backend
+from doodle_data.shards import ShardDataset
+
+try:
+    import resource
+except ImportError:
+    # windows
+    resource = None
+
+MODES = ['int8', 'float16', 'dynamic']
+
+# how the served model's input images are rendered, DOODLE_MODEL['RENDERER'] and ['LINE_WIDTH'] of the API settings
+SERVED_RENDER = {'size': 64, 'lw': 5, 'backend': 'pil'}
+
+
+def check_render_params(manifest, render):
+    """ Raises ValueError unless the shards of manifest were rendered with the render parameters """
+
+    rendered = {key: manifest.get(key) for key in render}
+    if rendered != render:
+        raise ValueError('The image shards were rendered with {}, the model is served images rendered with {}'.format(
+            rendered, render))
+
+
+def sample_images(shard_dir, n, seed=0, skip=0, render=SERVED_RENDER):
+    """
+        Returns n float32 (n, size, size, 1) images scaled to 0-1 from random rows of the image shards
+
+        skip leaves out the first skip rows of the sampled order, so calibration and evaluation samples taken
+        with the same seed never overlap. The shards must have been rendered with render.
+    """
+
+    dataset = ShardDataset(shard_dir)
+    check_render_params(dataset.manifest, render)
+    counts = np.array([dataset.manifest['shards'][str(k)] for k in dataset.ks])
+    offsets = np.concatenate([[0], np.cumsum(counts)])
+    if offsets[-1] < skip + n:
+        raise ValueError('{} holds {} images, {} needed'.format(shard_dir, offsets[-1], skip + n))
+
+    picked = np.random.default_rng(seed).permutation(offsets[-1])[skip:skip + n]
+    shards = np.searchsorted(offsets, picked, side='right') - 1
+
+    images = np.empty((n, dataset.size, dataset.size, 1), dtype=np.float32)
+    for s in np.unique(shards):
+        out = np.flatnonzero(shards == s)
+        out = out[np.argsort(picked[out])]
+        shard_images, _ = dataset.shard(dataset.ks[s])
+        images[out, :, :, 0] = shard_images[picked[out] - offsets[s]] / np.float32(255)
+
+    return images
+
+
+def export_tflite(model_path, output_path, shard_dir=None, samples=1000, mode='int8', seed=0, render=SERVED_RENDER):
+    """ Converts the Keras model to a TFLite flatbuffer, int8 needs shard_dir for the calibration sample """
+
+    import keras
+    import tensorflow as tf
+
+    model = keras.models.load_model(model_path, compile=False)
+    converter = tf.lite.TFLiteConverter.from_keras_model(model)
+    converter.optimizations = [tf.lite.Optimize.DEFAULT]
+
+    if mode == 'int8':
+        if shard_dir is None:
+            raise ValueError('int8 quantization is calibrated on the image shards, pass shard_dir')
+        calibration = sample_images(shard_dir, samples, seed=seed, render=render)
+        converter.representative_dataset = lambda: ([image[np.newaxis]] for image in calibration)
+        converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+    elif mode == 'float16':
+        converter.target_spec.supported_types = [tf.float16]
+    elif mode != 'dynamic':
+        raise ValueError('Unknown quantization mode {!r}, expected one of {}'.format(mode, ', '.join(MODES)))
+
+    flatbuffer = converter.convert()
+    with open(output_path + '.tmp', 'wb') as f:
+        f.write(flatbuffer)
+    os.replace(output_path + '.tmp', output_path)
+    return len(flatbuffer)
+
+
+def _rss_mb():
+    """ Resident memory of this process, None without /proc and psutil """
+
+    if resource is not None and os.path.exists('/proc/self/statm'):
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * resource.getpagesize() / 2 ** 20
+    try:
+        import psutil
+    except ImportError:
+        return None
+    return psutil.Process().memory_info().rss / 2 ** 20
+
+
+def _peak_rss_mb():
+    """ Peak resident memory of this process, None without resource and psutil """
+
+    if resource is not None:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    try:
+        import psutil
+    except ImportError:
+        return None
+    # the peak working set, only reported on windows
+    peak = getattr(psutil.Process().memory_info(), 'peak_wset', None)
+    return peak / 2 ** 20 if peak is not None else None
+
+
+def _measure(backend, path, images, batch_size, repeat):
+    """ Runs in its own process: loads one backend and returns its predictions, latency and memory """
+
+    rss_before = _rss_mb()
+    started = time.perf_counter()
+    model = get_backend(backend, path, num_threads=1 if backend == 'tflite' else None)
+    model.load()
+    model.predict(images[:1])
+    load_s = time.perf_counter() - started
+
+    single = []
+    for image in images[:repeat]:
+        started = time.perf_counter()
+        model.predict(image[np.newaxis])
+        single.append((time.perf_counter() - started) * 1000)
+
+    started = time.perf_counter()
+    pred = np.concatenate([model.predict(images[i:i + batch_size]) for i in range(0, len(images), batch_size)])
+    batch_s = time.perf_counter() - started
+
+    return pred, {
+        'backend': backend,
+        'file_mb': os.path.getsize(path) / 2 ** 20,
+        'load_s': load_s,
+        'rss_mb': _rss_mb() - rss_before if rss_before is not None else None,
+        'peak_rss_mb': _peak_rss_mb(),
+        'single_p50_ms': float(np.percentile(single, 50)),
+        'single_p95_ms': float(np.percentile(single, 95)),
+        'batch_images_per_s': len(images) / batch_s,
+    }
+
+
+def compare(model_path, tflite_path, shard_dir, samples=2000, batch_size=32, repeat=200, seed=0, skip=1000,
+            render=SERVED_RENDER):
+    """
+        Compares the TFLite export to the Keras model on images the calibration did not see
+
+        Agreement is measured against the Keras model's own predictions: top-1 is the share of images
+        with the same best class, top-3 the share with the same set of three best classes.
+    """
+
+    # by default the first 1000 images of the seed's order, export_tflite's calibration sample, are skipped
+    images = sample_images(shard_dir, samples, seed=seed, skip=skip, render=render)
+
+    # spawned, not forked, so neither process inherits the other's runtime
+    with multiprocessing.get_context('spawn').Pool(1, maxtasksperchild=1) as pool:
+        keras_pred, keras_stats = pool.apply(_measure, ('keras', model_path, images, batch_size, repeat))
+        tflite_pred, tflite_stats = pool.apply(_measure, ('tflite', tflite_path, images, batch_size, repeat))
+
+    keras_top3 = np.sort(np.argsort(-keras_pred, axis=1)[:, :3], axis=1)
+    tflite_top3 = np.sort(np.argsort(-tflite_pred, axis=1)[:, :3], axis=1)
+
+    return {
+        'samples': samples,
+        'top1_agreement': float(np.mean(keras_pred.argmax(1) == tflite_pred.argmax(1))),
+        'top3_agreement': float(np.mean(np.all(keras_top3 == tflite_top3, axis=1))),
+        'max_abs_diff': float(np.abs(keras_pred - tflite_pred).max()),
+        'keras': keras_stats,
+        'tflite': tflite_stats,
+    }
+
+
+def _format_mb(mb, width):
+    return '{:>{}.1f}'.format(mb, width) if mb is not None else '{:>{}}'.format('-', width)
+
+
+def format_report(report):
+    lines = [
+        '{} images   top-1 agreement {:.2%}   top-3 agreement {:.2%}   max |p diff| {:.4f}'.format(
+            report['samples'], report['top1_agreement'], report['top3_agreement'], report['max_abs_diff']),
+        '{:<8} {:>8} {:>8} {:>8} {:>9} {:>9} {:>9} {:>10}'.format(
+            'backend', 'file MB', 'load s', 'RSS MB', 'peak MB', 'p50 ms', 'p95 ms', 'batch/s'),
+    ]
+    for name in ('keras', 'tflite'):
+        stats = report[name]
+        lines.append('{:<8} {:>8.2f} {:>8.2f} {} {} {:>9.2f} {:>9.2f} {:>10.0f}'.format(
+            name, stats['file_mb'], stats['load_s'], _format_mb(stats['rss_mb'], 8),
+            _format_mb(stats['peak_rss_mb'], 9), stats['single_p50_ms'], stats['single_p95_ms'],
+            stats['batch_images_per_s']))
+    return '\n'.join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    export = subparsers.add_parser('export', help='convert model.h5 to a quantized TFLite model')
+    export.add_argument('model')
+    export.add_argument('output')
+    export.add_argument('--shards', help='image shard directory to calibrate on (int8)')
+    export.add_argument('--samples', type=int, default=1000, help='calibration images')
+    export.add_argument('--mode', choices=MODES, default='int8')
+    export.add_argument('--seed', type=int, default=0)
+
+    report = subparsers.add_parser('compare', help='compare a TFLite model against the Keras model')
+    report.add_argument('model')
+    report.add_argument('tflite')
+    report.add_argument('--shards', required=True, help='image shard directory to evaluate on')
+    report.add_argument('--samples', type=int, default=2000, help='evaluation images')
+    report.add_argument('--skip', type=int, default=1000,
+                        help='images of the sampled order to leave out, the calibration sample of export')
+    report.add_argument('--batch-size', type=int, default=32)
+    report.add_argument('--repeat', type=int, default=200, help='timed single image predictions')
+    report.add_argument('--seed', type=int, default=0)
+    report.add_argument('--report', help='also write the report as json')
+
+    for command in (export, report):
+        command.add_argument('--size', type=int, default=SERVED_RENDER['size'],
+                             help='image size the shards must be rendered at, the served model\'s by default')
+        command.add_argument('--lw', type=int, default=SERVED_RENDER['lw'], help='line width of the shards')
+        command.add_argument('--renderer', default=SERVED_RENDER['backend'], help='render backend of the shards')
+
+    args = parser.parse_args()
+    render = {'size': args.size, 'lw': args.lw, 'backend': args.renderer}
+
+    if args.command == 'export':
+        nbytes = export_tflite(args.model, args.output, args.shards, samples=args.samples, mode=args.mode,
+                               seed=args.seed, render=render)
+        print('{} TFLite model written to {} ({:.2f} MB, Keras model {:.2f} MB)'.format(
+            args.mode, args.output, nbytes / 2 ** 20, os.path.getsize(args.model) / 2 ** 20))
+        return
+
+    result = compare(args.model, args.tflite, args.shards, samples=args.samples, batch_size=args.batch_size,
+                     repeat=args.repeat, seed=args.seed, skip=args.skip, render=render)
+    print(format_report(result))
+    if args.report:
+        with open(args.report, 'w') as f:
+            json.dump(result, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
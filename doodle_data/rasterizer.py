@@ -0,0 +1,170 @@
+"""
+    Stroke rasterizers used to turn QuickDraw drawings into model inputs
+
+    A drawing is the parsed `drawing` column of the QuickDraw csvs, a list of strokes where every stroke is
+    [[x0, x1, ...], [y0, y1, ...]] (the raw dataset adds a third list of timestamps, which is ignored).
+"""
+import cv2
+import numpy as np
+from PIL import Image, ImageDraw
+
+
+def draw_cv2(raw_strokes, size=256, lw=6):
+    """
+        Renderer of DataGenerator.ipynb, white strokes on a black 64x64 canvas
+
+        The canvas is always 64x64 and the 0-255 coordinates are drawn unscaled, exactly like the notebook
+        did, so models trained on its output see the same (cropped) drawings here.
+    """
+
+    img = np.zeros((64, 64), np.uint8)
+    for stroke in raw_strokes:
+        for i in range(len(stroke[0]) - 1):
+            _ = cv2.line(img, (stroke[0][i], stroke[1][i]), (stroke[0][i + 1], stroke[1][i + 1]), 255, lw)
+    if size != 256:
+        return cv2.resize(img, (size, size))
+    else:
+        return img
+
+
+def draw_it(raw_strokes, size=64, lw=5):
+    """
+        Renderer of Doodling_with_Deep_Learning.ipynb, black strokes on a white 256x256 canvas resized to size
+
+        Returns the uint8 image, the notebook's division by 255 is left to the caller.
+    """
+
+    image = Image.new('L', (256, 256), color=255)
+    image_draw = ImageDraw.Draw(image)
+
+    for stroke in raw_strokes:
+        for i in range(len(stroke[0]) - 1):
+            image_draw.line([stroke[0][i],
+                             stroke[1][i],
+                             stroke[0][i + 1],
+                             stroke[1][i + 1]],
+                            fill=0, width=lw)
+
+    # the notebook drew on a palette image, which PIL always resizes with nearest neighbour
+    if size != 256:
+        image = image.resize((size, size), Image.NEAREST)
+
+    return np.asarray(image)
+
+
+def pack_drawings(drawings):
+    """
+        Packs a list of drawings into the ragged layout taken by rasterize_batch
+
+        Returns (points, stroke_offsets, drawing_offsets):
+            points: (P, 2) int32 array of every x, y point of every stroke, back to back
+            stroke_offsets: (S + 1,) stroke i spans points[stroke_offsets[i]:stroke_offsets[i + 1]]
+            drawing_offsets: (N + 1,) drawing j spans strokes drawing_offsets[j]:drawing_offsets[j + 1]
+    """
+
+    strokes = [stroke for drawing in drawings for stroke in drawing]
+
+    drawing_offsets = np.zeros(len(drawings) + 1, dtype=np.int64)
+    np.cumsum([len(drawing) for drawing in drawings], out=drawing_offsets[1:])
+
+    stroke_offsets = np.zeros(len(strokes) + 1, dtype=np.int64)
+    np.cumsum([len(stroke[0]) for stroke in strokes], out=stroke_offsets[1:])
+
+    points = np.empty((stroke_offsets[-1], 2), dtype=np.int32)
+    if strokes:
+        points[:, 0] = np.concatenate([stroke[0] for stroke in strokes])
+        points[:, 1] = np.concatenate([stroke[1] for stroke in strokes])
+
+    return points, stroke_offsets, drawing_offsets
+
+
+def _polylines(points, stroke_offsets, drawing_offsets):
+    """ Splits a packed batch into per-drawing lists of int32 polylines, dropping single point strokes """
+
+    coords = np.ascontiguousarray(points[:stroke_offsets[-1]], dtype=np.int32)
+    lines = np.split(coords, stroke_offsets[1:-1])
+    drawable = (np.diff(stroke_offsets) > 1).tolist()
+
+    return [[lines[j] for j in range(first, last) if drawable[j]]
+            for first, last in zip(drawing_offsets[:-1].tolist(), drawing_offsets[1:].tolist())]
+
+
+def _rasterize_cv2(points, stroke_offsets, drawing_offsets, size, lw, out):
+    # draw_cv2 always draws on a 64x64 canvas and only resizes when a different size is asked for
+    canvas = None if size == 64 else np.empty((64, 64), dtype=np.uint8)
+
+    for i, lines in enumerate(_polylines(points, stroke_offsets, drawing_offsets)):
+        img = out[i] if canvas is None else canvas
+        img.fill(0)
+
+        # one polylines call per drawing draws the same segments and joints as draw_cv2's per-segment cv2.line
+        if lines:
+            cv2.polylines(img, lines, False, 255, lw)
+
+        if canvas is not None:
+            cv2.resize(canvas, (size, size), dst=out[i])
+
+    return out
+
+
+def _rasterize_pil(points, stroke_offsets, drawing_offsets, size, lw, out):
+    image = Image.new('L', (256, 256), color=255)
+    image_draw = ImageDraw.Draw(image)
+
+    for i, lines in enumerate(_polylines(points, stroke_offsets, drawing_offsets)):
+        image_draw.rectangle((0, 0, 255, 255), fill=255)
+
+        for line in lines:
+            image_draw.line(line.ravel().tolist(), fill=0, width=lw)
+
+        out[i] = np.asarray(image if size == 256 else image.resize((size, size), Image.NEAREST))
+
+    return out
+
+
+BATCH_RENDERERS = {
+    'cv2': _rasterize_cv2,
+    'pil': _rasterize_pil,
+}
+
+
+def rasterize_batch(points, stroke_offsets, drawing_offsets, size=64, lw=6, backend='cv2', out=None):
+    """
+        Rasterizes a whole batch of packed drawings (see pack_drawings) into a (N, size, size) uint8 array
+
+        Produces the same images as draw_cv2 ('cv2') or draw_it ('pil') for the same size and lw, while
+        issuing one draw call per stroke instead of one per segment. Pass a preallocated uint8 `out`
+        (e.g. a slice of a memory-mapped shard) to render in place; it is overwritten.
+        The one deliberate difference: draw_cv2(size=256) returns the unscaled 64x64 canvas, rasterize_batch
+        resizes it to 256x256 so that every image fits in `out`.
+    """
+
+    try:
+        renderer = BATCH_RENDERERS[backend]
+    except KeyError:
+        raise ValueError('Unknown render backend {!r}, expected one of {}'.format(backend, sorted(BATCH_RENDERERS)))
+
+    n = len(drawing_offsets) - 1
+    if out is None:
+        out = np.empty((n, size, size), dtype=np.uint8)
+    elif out.shape != (n, size, size) or out.dtype != np.uint8:
+        raise ValueError('out must be a uint8 array of shape {}'.format((n, size, size)))
+
+    return renderer(points, stroke_offsets, drawing_offsets, size, lw, out)
+
+
+RENDERERS = {
+    'cv2': draw_cv2,
+    'pil': draw_it,
+}
+
+
+def render(raw_strokes, size=64, lw=6, backend='cv2'):
+    """ Renders a single drawing with the given backend ('cv2' or 'pil') """
+
+    try:
+        renderer = RENDERERS[backend]
+    except KeyError:
+        raise ValueError('Unknown render backend {!r}, expected one of {}'.format(backend, sorted(RENDERERS)))
+
+    return renderer(raw_strokes, size=size, lw=lw)
@@ -0,0 +1,274 @@
+"""
+    Content-addressed on-disk cache of rasterized QuickDraw datasets
+
+    Rendered arrays are stored under a key hashed from (sha256 of the source, size, lw, backend, nrows), so
+    every notebook and run that renders the same rows with the same parameters loads the finished .npy
+    memory-mapped instead of rasterizing again. manifest.json tracks the size and last use of every entry and
+    the least recently used ones are evicted once the cache grows past max_bytes. Processes sharing the cache
+    serialize their manifest updates on manifest.lock.
+
+        cache_dir/manifest.json        entries, their render parameters and the cached source file digests
+        cache_dir/manifest.lock        held while the manifest is read, changed and written back
+        cache_dir/entries/{key}.npy   (N, size, size) uint8 images
+
+    Usage:
+        cache = RenderCache('render_cache', max_bytes=20 * 1024 ** 3)
+        x_valid = cache.render_csv('shuffled_csv/train_k99.csv.gz', size=64, lw=6, nrows=30000)
+
+        python -m doodle_data.render_cache render_cache --max-gb 20     # list entries, evict down to the budget
+"""
+import argparse
+import contextlib
+import hashlib
+import json
+import os
+import tempfile
+import time
+import numpy as np
+import pandas as pd
+from doodle_data.shards import read_manifest, write_manifest
+from doodle_data.strokes import parse_drawings, read_strokes
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+    import msvcrt
+
+
+def file_digest(path, chunk_size=1024 ** 2):
+    """ sha256 of a file's content """
+
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+@contextlib.contextmanager
+def replacing(path):
+    """
+        Yields a fresh temporary file next to path and moves it over path when the block succeeds
+
+        Every writer gets its own temporary name, so processes rendering the same key never write into the
+        same file. A failed block leaves nothing behind.
+    """
+
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix=os.path.basename(path) + '.', suffix='.tmp')
+    os.close(fd)
+    try:
+        yield tmp
+        os.replace(tmp, path)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
+def render_key(source, size, lw, backend, nrows=None):
+    """ Cache key of `source` (a content digest) rendered with the given parameters """
+
+    params = {'source': source, 'size': size, 'lw': lw, 'backend': backend, 'nrows': nrows}
+    return hashlib.sha256(json.dumps(params, sort_keys=True).encode()).hexdigest()
+
+
+class RenderCache:
+    """
+        RenderCache - rendered arrays on disk, keyed by source content and render parameters
+
+        max_bytes is the disk budget, None keeps everything. Entries being read stay on disk until evicted,
+        a returned memory map keeps working on POSIX even after its file is removed.
+    """
+
+    def __init__(self, root, max_bytes=None):
+        self.root = root
+        self.max_bytes = max_bytes
+        os.makedirs(os.path.join(root, 'entries'), exist_ok=True)
+
+    def _entry_path(self, key):
+        return os.path.join(self.root, 'entries', '{}.npy'.format(key))
+
+    @contextlib.contextmanager
+    def _locked(self):
+        """ Exclusive lock on the manifest, across processes, for a read-modify-write of the index """
+
+        with open(os.path.join(self.root, 'manifest.lock'), 'a+b') as f:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_EX)
+            else:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+            try:
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+                else:
+                    f.seek(0)
+                    msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+    def _index(self):
+        # re-read on every change under _locked(), other notebooks may be sharing the cache directory
+        index = read_manifest(self.root) or {'entries': {}, 'sources': {}}
+        index['entries'] = {key: entry for key, entry in index['entries'].items()
+                            if os.path.exists(self._entry_path(key))}
+        return index
+
+    def source_digest(self, path):
+        """ Content digest of a source file, recomputed only when its size or mtime changed """
+
+        stat = os.stat(path)
+        path = os.path.abspath(path)
+        # the manifest is replaced atomically, a lock-free read sees the old or the new one
+        source = (read_manifest(self.root) or {'sources': {}})['sources'].get(path)
+        if source and source['size'] == stat.st_size and source['mtime_ns'] == stat.st_mtime_ns:
+            return source['sha256']
+
+        # hashing a large csv takes a while, the manifest is locked only to record the digest
+        source = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'sha256': file_digest(path)}
+        with self._locked():
+            index = self._index()
+            index['sources'][path] = source
+            write_manifest(self.root, index)
+        return source['sha256']
+
+    def get(self, key, **params):
+        """
+            Memory-mapped images cached under key, or None
+
+            An entry whose file exists but is missing from the manifest (its writer was interrupted before
+            registering it) is registered again with params.
+        """
+
+        path = self._entry_path(key)
+        try:
+            images = np.load(path, mmap_mode='r')
+        except FileNotFoundError:
+            return None
+
+        with self._locked():
+            index = self._index()
+            entry = index['entries'].get(key)
+            if entry is None:
+                entry = index['entries'][key] = dict(params, bytes=os.path.getsize(path))
+            entry['last_used'] = time.time()
+            self._evict(index, keep=key)
+            write_manifest(self.root, index)
+        return images
+
+    def put(self, key, images, **params):
+        """ Stores images under key, evicts down to the budget and returns the cached memory map """
+
+        path = self._entry_path(key)
+        with replacing(path) as tmp, open(tmp, 'wb') as f:
+            np.save(f, images)
+
+        self._add(key, params)
+        return np.load(path, mmap_mode='r')
+
+    def _add(self, key, params):
+        with self._locked():
+            index = self._index()
+            index['entries'][key] = dict(params, bytes=os.path.getsize(self._entry_path(key)), last_used=time.time())
+            self._evict(index, keep=key)
+            write_manifest(self.root, index)
+
+    def _evict(self, index, keep=None):
+        """ Drops least recently used entries until the cache fits max_bytes, never keep. Called under _locked() """
+
+        if self.max_bytes is None:
+            return
+
+        total = sum(entry['bytes'] for entry in index['entries'].values())
+        for key in sorted(index['entries'], key=lambda k: index['entries'][k]['last_used']):
+            if total <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            total -= index['entries'].pop(key)['bytes']
+            os.remove(self._entry_path(key))
+
+    def prune(self):
+        """ Evicts down to max_bytes, for when the budget was lowered """
+
+        with self._locked():
+            index = self._index()
+            self._evict(index)
+            write_manifest(self.root, index)
+        return index
+
+    def clear(self):
+        with self._locked():
+            index = self._index()
+            for key in index['entries']:
+                os.remove(self._entry_path(key))
+            write_manifest(self.root, {'entries': {}, 'sources': index['sources']})
+
+    def nbytes(self):
+        return sum(entry['bytes'] for entry in self._index()['entries'].values())
+
+    def render_csv(self, csv_path, size=64, lw=6, backend='cv2', nrows=None, chunksize=10000):
+        """
+            (N, size, size) uint8 images of the `drawing` column of a QuickDraw csv, rendered on the first call
+
+            Rows are rasterized chunk by chunk straight into the .npy file, the whole csv is never in memory.
+        """
+
+        source = self.source_digest(csv_path)
+        key = render_key(source, size, lw, backend, nrows)
+        params = {'source': os.path.abspath(csv_path), 'size': size, 'lw': lw, 'backend': backend, 'nrows': nrows}
+        images = self.get(key, **params)
+        if images is not None:
+            return images
+
+        path = self._entry_path(key)
+        rows = sum(len(df) for df in pd.read_csv(csv_path, usecols=[0], nrows=nrows, chunksize=chunksize))
+        with replacing(path) as tmp:
+            images = np.lib.format.open_memmap(tmp, mode='w+', dtype=np.uint8, shape=(rows, size, size))
+
+            start = 0
+            for strokes, _ in read_strokes(csv_path, chunksize=chunksize, nrows=nrows, usecols=['drawing']):
+                strokes.rasterize(size=size, lw=lw, backend=backend, out=images[start:start + len(strokes)])
+                start += len(strokes)
+            images.flush()
+            del images
+
+        self._add(key, params)
+        return np.load(path, mmap_mode='r')
+
+    def render_drawings(self, texts, size=64, lw=6, backend='cv2'):
+        """ Same as render_csv for `drawing` column strings already in memory, e.g. df['drawing'].values """
+
+        texts = list(texts)
+        source = hashlib.sha256('\n'.join(texts).encode('ascii')).hexdigest()
+        key = render_key(source, size, lw, backend)
+
+        params = {'source': '<{} drawings>'.format(len(texts)), 'size': size, 'lw': lw, 'backend': backend}
+        images = self.get(key, **params)
+        if images is None:
+            images = self.put(key, parse_drawings(texts).rasterize(size=size, lw=lw, backend=backend), **params)
+        return images
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('cache_dir')
+    parser.add_argument('--max-gb', type=float, help='disk budget, evicts least recently used entries beyond it')
+    parser.add_argument('--clear', action='store_true', help='remove every cached entry')
+    args = parser.parse_args()
+
+    cache = RenderCache(args.cache_dir, max_bytes=int(args.max_gb * 1024 ** 3) if args.max_gb else None)
+    if args.clear:
+        cache.clear()
+
+    index = cache.prune()
+    for key, entry in sorted(index['entries'].items(), key=lambda item: -item[1]['last_used']):
+        # entries registered by a bare get(key) have no render parameters
+        print('{}  {:>10.1f} MB  size={size} lw={lw} backend={backend}  {source}'.format(
+            key[:12], entry['bytes'] / 1024 ** 2, **dict(dict.fromkeys(['size', 'lw', 'backend', 'source'], '?'),
+                                                          **entry)))
+    print('{} entries, {:.1f} MB'.format(len(index['entries']), cache.nbytes() / 1024 ** 2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,183 @@
+"""
+    Memory-mapped image shards, rasterized once from the shuffled csv shards
+
+    build_image_shards renders every shuffled_csv/train_k{k}.csv.gz into a shard directory:
+        images_k{k}.npy  (N, size, size) uint8 images
+        labels_k{k}.npy  (N,) int16 category ids (the `y` column)
+        manifest.json    render parameters and the row count of every finished shard
+    ShardDataset then streams batches straight out of the memory-mapped .npy files, so training epochs
+    no longer parse csvs or rasterize strokes.
+
+    Usage:
+        python -m doodle_data.shards shuffled_csv image_shards --size 64 --lw 6
+"""
+import argparse
+import json
+import os
+import numpy as np
+import pandas as pd
+from doodle_data.strokes import read_strokes
+
+MANIFEST = 'manifest.json'
+
+
+def read_manifest(shard_dir):
+    path = os.path.join(shard_dir, MANIFEST)
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def write_manifest(shard_dir, manifest):
+    """ Writes the manifest atomically, an interrupted build never leaves a half written one behind """
+
+    path = os.path.join(shard_dir, MANIFEST)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(path + '.tmp', path)
+
+
+def shard_paths(shard_dir, k):
+    return os.path.join(shard_dir, 'images_k{}.npy'.format(k)), os.path.join(shard_dir, 'labels_k{}.npy'.format(k))
+
+
+def build_shard(csv_path, shard_dir, k, size=64, lw=6, backend='cv2', chunksize=10000):
+    """ Rasterizes one shuffled csv shard straight into a memory-mapped .npy file and returns its row count """
+
+    images_path, labels_path = shard_paths(shard_dir, k)
+
+    labels = pd.read_csv(csv_path, usecols=['y'])['y'].to_numpy(dtype=np.int16)
+    images = np.lib.format.open_memmap(images_path + '.tmp', mode='w+', dtype=np.uint8,
+                                       shape=(len(labels), size, size))
+
+    start = 0
+    for strokes, _ in read_strokes(csv_path, chunksize=chunksize, usecols=['drawing']):
+        strokes.rasterize(size=size, lw=lw, backend=backend, out=images[start:start + len(strokes)])
+        start += len(strokes)
+
+    images.flush()
+    del images
+
+    with open(labels_path + '.tmp', 'wb') as f:
+        np.save(f, labels)
+    os.replace(labels_path + '.tmp', labels_path)
+    os.replace(images_path + '.tmp', images_path)
+
+    return len(labels)
+
+
+def build_image_shards(csv_dir, shard_dir, ks, size=64, lw=6, backend='cv2', chunksize=10000):
+    """
+        One-time build of memory-mapped image shards from shuffled_csv/train_k{k}.csv.gz
+
+        Shards already listed in the manifest are skipped, so an interrupted build resumes where it stopped.
+        Rebuilding with different render parameters needs a fresh shard_dir.
+    """
+
+    os.makedirs(shard_dir, exist_ok=True)
+
+    params = {'size': size, 'lw': lw, 'backend': backend}
+    manifest = read_manifest(shard_dir) or dict(params, shards={})
+    if any(manifest[key] != value for key, value in params.items()):
+        raise ValueError('{} was built with {}, not {}'.format(
+            shard_dir, {key: manifest[key] for key in params}, params))
+
+    for k in ks:
+        if str(k) in manifest['shards']:
+            continue
+
+        csv_path = os.path.join(csv_dir, 'train_k{}.csv.gz'.format(k))
+        manifest['shards'][str(k)] = build_shard(csv_path, shard_dir, k, size=size, lw=lw, backend=backend,
+                                                 chunksize=chunksize)
+        write_manifest(shard_dir, manifest)
+
+    return manifest
+
+
+class ShardDataset:
+    """
+        ShardDataset - streams training batches from memory-mapped image shards
+
+        Batches are zero-copy slices of the memory-mapped files, the shards are permuted every epoch and so
+        is the order of the batches inside each shard.
+    """
+
+    def __init__(self, shard_dir):
+        self.shard_dir = shard_dir
+        self.manifest = read_manifest(shard_dir)
+        if self.manifest is None:
+            raise FileNotFoundError('No {} in {}, run build_image_shards first'.format(MANIFEST, shard_dir))
+
+        self.size = self.manifest['size']
+        self.ks = sorted(int(k) for k in self.manifest['shards'])
+
+    def __len__(self):
+        return sum(self.manifest['shards'].values())
+
+    def shard(self, k):
+        """ Returns the memory-mapped (images, labels) of shard k """
+
+        images_path, labels_path = shard_paths(self.shard_dir, k)
+        return np.load(images_path, mmap_mode='r'), np.load(labels_path, mmap_mode='r')
+
+    def steps_per_epoch(self, batch_size, ks=None):
+        ks = self.ks if ks is None else ks
+        return sum(-(-self.manifest['shards'][str(k)] // batch_size) for k in ks)
+
+    def batches(self, batch_size, ks=None, epochs=None, seed=None):
+        """
+            Yields (images, labels) batches of uint8 (B, size, size) images and int16 labels
+
+            Runs forever like image_generator unless epochs is given.
+        """
+
+        ks = self.ks if ks is None else list(ks)
+        rng = np.random.default_rng(seed)
+
+        epoch = 0
+        while epochs is None or epoch < epochs:
+            for k in rng.permutation(ks):
+                images, labels = self.shard(k)
+                for start in rng.permutation(np.arange(0, len(labels), batch_size)):
+                    yield images[start:start + batch_size], labels[start:start + batch_size]
+            epoch += 1
+
+    def as_tf_dataset(self, batch_size, num_classes, ks=None, epochs=None, seed=None):
+        """ tf.data source of (float32 (B, size, size, 1) images scaled to 0-1, one-hot labels) batches """
+
+        import tensorflow as tf
+
+        dataset = tf.data.Dataset.from_generator(
+            lambda: self.batches(batch_size, ks=ks, epochs=epochs, seed=seed),
+            output_signature=(
+                tf.TensorSpec(shape=(None, self.size, self.size), dtype=tf.uint8),
+                tf.TensorSpec(shape=(None,), dtype=tf.int16),
+            )
+        )
+
+        # normalizing and one-hot encoding run inside tf.data, off the Python generator
+        dataset = dataset.map(
+            lambda x, y: (tf.cast(x, tf.float32)[..., tf.newaxis] / 255., tf.one_hot(tf.cast(y, tf.int32), num_classes)),
+            num_parallel_calls=tf.data.AUTOTUNE
+        )
+        return dataset.prefetch(tf.data.AUTOTUNE)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('csv_dir', help='directory holding train_k{k}.csv.gz')
+    parser.add_argument('shard_dir')
+    parser.add_argument('--ncsvs', type=int, default=100, help='number of shuffled csv shards')
+    parser.add_argument('--size', type=int, default=64)
+    parser.add_argument('--lw', type=int, default=6)
+    parser.add_argument('--backend', choices=['cv2', 'pil'], default='cv2')
+    args = parser.parse_args()
+
+    manifest = build_image_shards(args.csv_dir, args.shard_dir, ks=range(args.ncsvs), size=args.size, lw=args.lw,
+                                  backend=args.backend)
+    print('{} shards, {} images'.format(len(manifest['shards']), sum(manifest['shards'].values())))
+
+
+if __name__ == '__main__':
+    main()
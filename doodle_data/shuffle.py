@@ -0,0 +1,158 @@
+"""
+    Parallel single-pass builder of the shuffled csv shards (shuffled_csv/train_k{k}.csv.gz)
+
+    Replaces the shuffling cells of DataGenerator.ipynb, which filtered every category DataFrame once per
+    shard, appended to the shard csvs and then re-read every shard to shuffle and gzip it, all on one core.
+
+    partition: one task per category reads its csv once, adds the `y` and `cv` columns and splits it with a
+               single groupby into parts/k{k}/{y}.pkl
+    merge:     one task per shard concatenates its parts, shuffles them with a seed derived from (seed, k)
+               and writes train_k{k}.csv.gz exactly once
+
+    Both run on a process pool. manifest.json records finished categories and shards, so an interrupted
+    build picks up where it stopped when rerun with the same arguments.
+
+    Usage:
+        python -m doodle_data.shuffle dataset shuffled_csv --ncsvs 100 --nrows 30000
+"""
+import argparse
+import json
+import os
+import shutil
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+import pandas as pd
+
+MANIFEST = 'manifest.json'
+
+
+def extract_label_from_csv(filename: str) -> str:
+    """
+        This method will extract the label from the file name
+        Ex:
+            from `elephant.csv` -> 'elephant'
+    """
+    return filename.split('.')[0]
+
+
+def list_categories(input_dir):
+    """ Category names of the csvs in input_dir, in the order DataGenerator.ipynb assigns their `y` ids """
+
+    files = [f for f in os.listdir(input_dir) if f.endswith('.csv')]
+    return sorted([extract_label_from_csv(f) for f in files], key=str.lower)
+
+
+def partition_category(input_dir, parts_dir, category, y, ncsvs, nrows=None):
+    """ Reads one category csv and writes its rows of every shard to parts/k{k}/{y}.pkl in one groupby pass """
+
+    df = pd.read_csv(os.path.join(input_dir, category + '.csv'), nrows=nrows)
+    # add column y with category id
+    df['y'] = y
+    # add cv column by calculating random number using key_id
+    df['cv'] = (df['key_id'] // 10 ** 7) % ncsvs
+    df = df.drop(['key_id'], axis=1)
+
+    for k, chunk in df.groupby('cv', sort=False):
+        path = os.path.join(parts_dir, 'k{}'.format(k), '{}.pkl'.format(y))
+        chunk.to_pickle(path + '.tmp')
+        os.replace(path + '.tmp', path)
+
+    return category, len(df)
+
+
+def merge_shard(parts_dir, output_dir, k, seed):
+    """ Concatenates the parts of shard k in category order, shuffles them and writes train_k{k}.csv.gz """
+
+    shard_parts = os.path.join(parts_dir, 'k{}'.format(k))
+    files = sorted((f for f in os.listdir(shard_parts) if f.endswith('.pkl')), key=lambda f: int(f.split('.')[0]))
+    if not files:
+        return k, 0
+
+    df = pd.concat([pd.read_pickle(os.path.join(shard_parts, f)) for f in files], ignore_index=True)
+    df = df.iloc[np.random.default_rng([seed, k]).permutation(len(df))]
+
+    path = os.path.join(output_dir, 'train_k{}.csv.gz'.format(k))
+    df.to_csv(path + '.tmp', compression='gzip', index=False)
+    os.replace(path + '.tmp', path)
+
+    return k, len(df)
+
+
+def _load_manifest(output_dir, params):
+    path = os.path.join(output_dir, MANIFEST)
+    if not os.path.exists(path):
+        return dict(params, partitioned={}, shards={})
+
+    with open(path) as f:
+        manifest = json.load(f)
+
+    if any(manifest[key] != value for key, value in params.items()):
+        raise ValueError('{} was built with different parameters, use a fresh output directory'.format(output_dir))
+    return manifest
+
+
+def _save_manifest(output_dir, manifest):
+    path = os.path.join(output_dir, MANIFEST)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(path + '.tmp', path)
+
+
+def build_shuffled_shards(input_dir, output_dir, ncsvs=100, nrows=None, seed=0, workers=None):
+    """
+        Builds output_dir/train_k{0..ncsvs-1}.csv.gz from the category csvs in input_dir
+
+        The result only depends on the inputs and the arguments: categories get their `y` from their sorted
+        position and every shard is shuffled with its own (seed, k) generator.
+    """
+
+    categories = list_categories(input_dir)
+    parts_dir = os.path.join(output_dir, 'parts')
+    for k in range(ncsvs):
+        os.makedirs(os.path.join(parts_dir, 'k{}'.format(k)), exist_ok=True)
+
+    params = {'categories': categories, 'ncsvs': ncsvs, 'nrows': nrows, 'seed': seed}
+    manifest = _load_manifest(output_dir, params)
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        started = time.perf_counter()
+        futures = [pool.submit(partition_category, input_dir, parts_dir, category, y, ncsvs, nrows)
+                   for y, category in enumerate(categories) if category not in manifest['partitioned']]
+
+        for i, future in enumerate(as_completed(futures), 1):
+            category, rows = future.result()
+            manifest['partitioned'][category] = rows
+            _save_manifest(output_dir, manifest)
+            print('partitioned {} ({}/{}, {:.0f} rows/sec)'.format(
+                category, i, len(futures), sum(manifest['partitioned'].values()) / (time.perf_counter() - started)))
+
+        futures = [pool.submit(merge_shard, parts_dir, output_dir, k, seed)
+                   for k in range(ncsvs) if str(k) not in manifest['shards']]
+
+        for i, future in enumerate(as_completed(futures), 1):
+            k, rows = future.result()
+            manifest['shards'][str(k)] = rows
+            _save_manifest(output_dir, manifest)
+            print('wrote train_k{}.csv.gz, {} rows ({}/{})'.format(k, rows, i, len(futures)))
+
+    shutil.rmtree(parts_dir)
+    return manifest
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('input_dir', help='directory of per-category QuickDraw csvs')
+    parser.add_argument('output_dir')
+    parser.add_argument('--ncsvs', type=int, default=100, help='number of shuffled shards')
+    parser.add_argument('--nrows', type=int, help='rows to read from every category csv')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--workers', type=int, help='worker processes, defaults to the cpu count')
+    args = parser.parse_args()
+
+    build_shuffled_shards(args.input_dir, args.output_dir, ncsvs=args.ncsvs, nrows=args.nrows, seed=args.seed,
+                          workers=args.workers)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,195 @@
+"""
+    Compact ragged stroke storage and a vectorized parser for the QuickDraw `drawing` column
+
+    A StrokeBatch keeps N drawings in three flat arrays, the layout rasterize_batch takes:
+        points          (P, 2) uint8 (simplified data) or int16 x, y coordinates of every point
+        stroke_offsets  (S + 1,) stroke i spans points[stroke_offsets[i]:stroke_offsets[i + 1]]
+        drawing_offsets (N + 1,) drawing j spans strokes drawing_offsets[j]:drawing_offsets[j + 1]
+    That is a couple of bytes per point instead of a Python int object per coordinate plus a list per
+    stroke, and parse_drawings fills it with numpy operations over a whole chunk of csv text at once instead
+    of json.loads / ast.literal_eval per drawing.
+"""
+import numpy as np
+import pandas as pd
+from doodle_data.rasterizer import pack_drawings, rasterize_batch
+
+_OPEN, _CLOSE, _MINUS, _DOT = (ord(c) for c in '[]-.')
+
+
+def _ranges(starts, ends):
+    """ Concatenation of np.arange(start, end) for every (start, end) pair """
+
+    lengths = ends - starts
+    total = int(lengths.sum())
+    if not total:
+        return np.zeros(0, dtype=np.int64)
+
+    shifts = np.repeat(starts - np.concatenate(([0], np.cumsum(lengths)[:-1])), lengths)
+    return shifts + np.arange(total)
+
+
+def _offsets(counts):
+    offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+    return offsets
+
+
+def _compact(values):
+    """ Smallest of uint8 / int16 / int32 that holds every coordinate """
+
+    if not len(values) or (values.min() >= 0 and values.max() <= 255):
+        return values.astype(np.uint8)
+    if values.min() >= -2 ** 15 and values.max() < 2 ** 15:
+        return values.astype(np.int16)
+    return values.astype(np.int32)
+
+
+class StrokeBatch:
+    """
+        StrokeBatch - N drawings stored as flat coordinate arrays plus stroke and drawing offsets
+
+        Slicing with a step-1 slice returns a view, integer arrays / masks gather a compact copy and an int
+        returns that drawing as the usual nested [[xs], [ys]] lists.
+    """
+
+    def __init__(self, points, stroke_offsets, drawing_offsets):
+        self.points = points
+        self.stroke_offsets = stroke_offsets
+        self.drawing_offsets = drawing_offsets
+
+    @classmethod
+    def from_drawings(cls, drawings):
+        """ Packs already parsed drawings (nested lists) """
+
+        points, stroke_offsets, drawing_offsets = pack_drawings(drawings)
+        return cls(_compact(points), stroke_offsets, drawing_offsets)
+
+    @classmethod
+    def concatenate(cls, batches):
+        batches = list(batches)
+        if not batches:
+            return cls.from_drawings([])
+
+        points = np.concatenate([batch.points for batch in batches])
+        stroke_counts = np.concatenate([np.diff(batch.drawing_offsets) for batch in batches])
+        point_counts = np.concatenate([np.diff(batch.stroke_offsets) for batch in batches])
+        return cls(points, _offsets(point_counts), _offsets(stroke_counts))
+
+    def __len__(self):
+        return len(self.drawing_offsets) - 1
+
+    @property
+    def nbytes(self):
+        return self.points.nbytes + self.stroke_offsets.nbytes + self.drawing_offsets.nbytes
+
+    def drawing(self, i):
+        """ Drawing i as nested [[xs], [ys]] lists, the format of the parsed csv column """
+
+        first, last = self.drawing_offsets[i], self.drawing_offsets[i + 1]
+        return [self.points[start:end].T.tolist() for start, end in zip(self.stroke_offsets[first:last],
+                                                                         self.stroke_offsets[first + 1:last + 1])]
+
+    def __getitem__(self, index):
+        if isinstance(index, (int, np.integer)):
+            return self.drawing(range(len(self))[index])
+
+        if isinstance(index, slice) and index.step in (None, 1):
+            start, stop, _ = index.indices(len(self))
+            stop = max(start, stop)
+
+            first, last = self.drawing_offsets[start], self.drawing_offsets[stop]
+            point_start, point_stop = self.stroke_offsets[first], self.stroke_offsets[last]
+            return StrokeBatch(self.points[point_start:point_stop],
+                               self.stroke_offsets[first:last + 1] - point_start,
+                               self.drawing_offsets[start:stop + 1] - first)
+
+        index = np.arange(len(self))[index]
+        first, last = self.drawing_offsets[index], self.drawing_offsets[index + 1]
+        strokes = _ranges(first, last)
+        point_start, point_stop = self.stroke_offsets[strokes], self.stroke_offsets[strokes + 1]
+
+        return StrokeBatch(self.points[_ranges(point_start, point_stop)],
+                           _offsets(point_stop - point_start), _offsets(last - first))
+
+    def rasterize(self, size=64, lw=6, backend='cv2', out=None):
+        """ Renders every drawing into a (N, size, size) uint8 array, see rasterize_batch """
+
+        return rasterize_batch(self.points, self.stroke_offsets, self.drawing_offsets, size=size, lw=lw,
+                               backend=backend, out=out)
+
+
+def parse_drawings(texts):
+    """
+        Parses an iterable of `drawing` column strings straight into a StrokeBatch
+
+        The strings are joined into one byte buffer and tokenized with numpy: bracket depth tells drawings
+        (depth 1), strokes (depth 2) and coordinate lists (depth 3) apart, digit runs become the coordinates.
+        The third (timestamp) list of raw QuickDraw strokes is dropped.
+    """
+
+    texts = list(texts)
+    buf = np.frombuffer('\n'.join(texts).encode('ascii'), dtype=np.uint8)
+    if (buf == _DOT).any():
+        raise ValueError('Drawings must only contain integer coordinates')
+
+    # nesting depth of every '[': opens so far (itself included) minus closes before it
+    open_at, close_at = np.flatnonzero(buf == _OPEN), np.flatnonzero(buf == _CLOSE)
+    open_depth = np.arange(1, len(open_at) + 1) - np.searchsorted(close_at, open_at)
+    drawing_open, stroke_open, list_open = (open_at[open_depth == level] for level in (1, 2, 3))
+
+    if len(drawing_open) != len(texts):
+        raise ValueError('Expected {} drawings, found {}'.format(len(texts), len(drawing_open)))
+
+    # digit runs -> integer values, one vectorized pass per digit position
+    digits = np.zeros(len(buf) + 2, dtype=bool)
+    digits[1:-1] = (buf >= 48) & (buf <= 57)
+    starts = np.flatnonzero(digits[1:-1] & ~digits[:-2])
+    lengths = np.flatnonzero(digits[1:-1] & ~digits[2:]) + 1 - starts
+
+    values = np.zeros(len(starts), dtype=np.int64)
+    for position in range(int(lengths.max()) if len(lengths) else 0):
+        has_digit = lengths > position
+        values[has_digit] = values[has_digit] * 10 + (buf[starts[has_digit] + position] - 48)
+    values[(starts > 0) & (buf[np.maximum(starts - 1, 0)] == _MINUS)] *= -1
+
+    # which coordinate list, stroke and drawing everything belongs to, values only ever sit inside a list
+    values_per_list = np.diff(np.append(np.searchsorted(starts, list_open), len(starts)))
+    list_of_value = np.repeat(np.arange(len(list_open)), values_per_list)
+    stroke_of_list = np.searchsorted(stroke_open, list_open, side='right') - 1
+    drawing_of_stroke = np.searchsorted(drawing_open, stroke_open, side='right') - 1
+    list_position = np.arange(len(list_open)) - np.searchsorted(list_open, stroke_open)[stroke_of_list]
+
+    value_position = list_position[list_of_value]
+    xs, ys = values[value_position == 0], values[value_position == 1]
+
+    point_counts = np.bincount(stroke_of_list[list_of_value[value_position == 0]], minlength=len(stroke_open))
+    if len(xs) != len(ys) or not np.array_equal(
+            point_counts, np.bincount(stroke_of_list[list_of_value[value_position == 1]], minlength=len(stroke_open))):
+        raise ValueError('Every stroke needs as many x as y coordinates')
+
+    return StrokeBatch(_compact(np.stack([xs, ys], axis=1)), _offsets(point_counts),
+                       _offsets(np.bincount(drawing_of_stroke, minlength=len(drawing_open))))
+
+
+def read_strokes(csv_path, chunksize=100000, nrows=None, usecols=('drawing', 'y')):
+    """
+        Streams a QuickDraw csv as (StrokeBatch, DataFrame of the other columns) chunks
+
+        Only one chunk of drawing strings is alive at a time, the parsed strokes never become Python objects.
+    """
+
+    for df in pd.read_csv(csv_path, chunksize=chunksize, nrows=nrows, usecols=list(usecols)):
+        yield parse_drawings(df['drawing'].values), df.drop(columns='drawing')
+
+
+def load_strokes(csv_path, chunksize=100000, nrows=None, usecols=('drawing', 'y')):
+    """ Reads a whole QuickDraw csv into one StrokeBatch plus a DataFrame of the other columns """
+
+    batches, frames = [], []
+    for strokes, df in read_strokes(csv_path, chunksize=chunksize, nrows=nrows, usecols=usecols):
+        batches.append(strokes)
+        frames.append(df)
+
+    columns = [column for column in usecols if column != 'drawing']
+    return StrokeBatch.concatenate(batches), pd.concat(frames, ignore_index=True) if frames else pd.DataFrame(
+        columns=columns)
@@ -0,0 +1,458 @@
+"""
+    doodle_data tests
+
+    Usage:
+        python -m unittest doodle_data.tests
+"""
+import json
+import multiprocessing
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+from unittest import mock
+import cv2
+import numpy as np
+import pandas as pd
+from doodle_data.backends import artifact_version
+from doodle_data.benchmark import synthetic_drawings
+from doodle_data.export import export_pngs
+from doodle_data.pipeline import InputPipeline
+from doodle_data.quantize import SERVED_RENDER, format_report, sample_images
+from doodle_data.rasterizer import draw_cv2, draw_it, pack_drawings, rasterize_batch, render
+from doodle_data.render_cache import RenderCache
+from doodle_data.shards import ShardDataset, build_image_shards, read_manifest, shard_paths, write_manifest
+from doodle_data.shuffle import build_shuffled_shards, list_categories
+from doodle_data.strokes import StrokeBatch, parse_drawings
+
+
+def write_csv_shard(csv_dir, k, drawings, labels):
+    """ Writes a shuffled csv shard train_k{k}.csv.gz the way doodle_data.shuffle does """
+
+    df = pd.DataFrame({'drawing': [json.dumps(drawing, separators=(',', ':')) for drawing in drawings], 'y': labels})
+    df.to_csv(os.path.join(csv_dir, 'train_k{}.csv.gz'.format(k)), compression='gzip', index=False)
+
+
+class InputPipelineTestCase(unittest.TestCase):
+
+    def test_close_before_start(self):
+        pipeline = InputPipeline('shuffled_csv', ks=[0], workers=1)
+        pipeline.close()
+        pipeline.close()
+
+    def test_close_after_failed_start(self):
+        pipeline = InputPipeline('shuffled_csv', ks=[0], workers=1)
+
+        # e.g. too many open files while creating the queues, before any queue exists
+        with mock.patch('multiprocessing.get_context') as get_context:
+            get_context.return_value.Queue.side_effect = OSError('Too many open files')
+            with self.assertRaises(OSError):
+                pipeline.start()
+
+        pipeline.close()
+
+    def run_pipeline(self, n, **kwargs):
+        """ First n batches of a single worker pipeline over three shards labelled with their global row index """
+
+        with tempfile.TemporaryDirectory() as csv_dir:
+            drawings = synthetic_drawings(22, seed=5)
+            for k, (start, stop) in enumerate([(0, 10), (10, 17), (17, 22)]):
+                write_csv_shard(csv_dir, k, drawings[start:stop], np.arange(start, stop))
+
+            pipeline = InputPipeline(csv_dir, ks=[0, 1, 2], batch_size=4, num_classes=22, size=32, lw=3, workers=1,
+                                     **kwargs)
+            with pipeline:
+                batches = [batch for _, batch in zip(range(n), pipeline)]
+            return pipeline, drawings, batches
+
+    def test_iteration_order_and_completeness(self):
+        pipeline, drawings, batches = self.run_pipeline(14, seed=3)
+
+        # every epoch visits the shards in the feeder's seeded order and yields each one in file order
+        rng = np.random.default_rng(3)
+        shards = {0: range(0, 10), 1: range(10, 17), 2: range(17, 22)}
+        expected = [i for _ in range(2) for k in rng.permutation(3) for i in shards[k]]
+
+        labels = np.concatenate([y.argmax(axis=1) for _, y in batches])
+        self.assertEqual([len(y) for _, y in batches].count(4), 8)
+        self.assertEqual(labels.tolist(), expected)
+        self.assertEqual(sorted(labels[:22]), list(range(22)))
+
+        for x, y in batches:
+            self.assertEqual((x.shape[1:], x.dtype, y.dtype), ((32, 32, 1), np.float32, np.float32))
+            np.testing.assert_array_equal(y.sum(axis=1), 1)
+        images = np.concatenate([x for x, _ in batches])[:, :, :, 0]
+        rendered = rasterize_batch(*pack_drawings([drawings[i] for i in expected]), size=32, lw=3)
+        np.testing.assert_array_equal(images, rendered / np.float32(255))
+
+    def test_stats(self):
+        self.assertEqual(InputPipeline('shuffled_csv', ks=[0]).stats(), {
+            'batches': 0, 'batches_per_sec': 0, 'images_per_sec': 0, 'stalled_sec': 0, 'stall_fraction': 0})
+
+        pipeline, _, batches = self.run_pipeline(5)
+        stats = pipeline.stats()
+
+        self.assertEqual(stats['batches'], 5)
+        self.assertEqual(pipeline._images, sum(len(y) for _, y in batches))
+        self.assertGreater(stats['batches_per_sec'], 0)
+        self.assertGreater(stats['images_per_sec'], 0)
+        self.assertGreaterEqual(stats['stalled_sec'], 0)
+        self.assertTrue(0 <= stats['stall_fraction'] <= 1)
+
+
+class RasterizerTestCase(unittest.TestCase):
+
+    def test_batch_matches_the_notebook_renderers(self):
+        # single point strokes and an empty drawing along with the random walks
+        drawings = synthetic_drawings(50, seed=2) + [[[[10], [20]], [[0, 255], [255, 0]]], []]
+        packed = pack_drawings(drawings)
+
+        # draw_cv2 returns its 64x64 canvas as is for size=256, the batch renderer always returns size x size
+        for backend, legacy, sizes in [('cv2', draw_cv2, (32, 64, 128)), ('pil', draw_it, (32, 64, 256))]:
+            for size in sizes:
+                for lw in (1, 5, 6):
+                    with self.subTest(backend=backend, size=size, lw=lw):
+                        expected = np.stack([legacy(drawing, size=size, lw=lw) for drawing in drawings])
+                        np.testing.assert_array_equal(rasterize_batch(*packed, size=size, lw=lw, backend=backend),
+                                                      expected)
+                        np.testing.assert_array_equal(render(drawings[0], size=size, lw=lw, backend=backend),
+                                                      expected[0])
+
+
+class ParseDrawingsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.drawings = synthetic_drawings(200, seed=1)
+
+    def assertSameStrokes(self, batch, drawings):
+        points, stroke_offsets, drawing_offsets = pack_drawings(drawings)
+        np.testing.assert_array_equal(batch.points, points)
+        np.testing.assert_array_equal(batch.stroke_offsets, stroke_offsets)
+        np.testing.assert_array_equal(batch.drawing_offsets, drawing_offsets)
+
+    def test_matches_json_parsing(self):
+        batch = parse_drawings(json.dumps(drawing) for drawing in self.drawings)
+
+        self.assertEqual(len(batch), len(self.drawings))
+        self.assertSameStrokes(batch, self.drawings)
+        self.assertEqual([batch[i] for i in range(len(batch))], self.drawings)
+
+    def test_csv_formatting_and_raw_strokes(self):
+        # the csvs quote drawings without spaces, raw QuickDraw strokes carry a third list of timestamps
+        texts = ['[[[0,10,-5],[3,4,5],[0,17,33]],[[255],[0],[40]]]', '[[[1, 2], [3, 4]]]']
+        self.assertEqual(list(parse_drawings(texts)), [[[[0, 10, -5], [3, 4, 5]], [[255], [0]]], [[[1, 2], [3, 4]]]])
+
+    def test_invalid_drawings(self):
+        for texts in (['[[[1.5],[2]]]'], ['[[[1,2],[3]]]']):
+            with self.subTest(texts=texts), self.assertRaises(ValueError):
+                parse_drawings(texts)
+
+    def test_slicing_and_rasterizing(self):
+        batch = parse_drawings(json.dumps(drawing) for drawing in self.drawings)
+
+        self.assertSameStrokes(batch[10:20], self.drawings[10:20])
+        self.assertSameStrokes(batch[[3, 1, 4]], [self.drawings[i] for i in (3, 1, 4)])
+        self.assertSameStrokes(StrokeBatch.concatenate([batch[:5], batch[5:9]]), self.drawings[:9])
+
+        np.testing.assert_array_equal(batch.rasterize(size=64, lw=6),
+                                      rasterize_batch(*pack_drawings(self.drawings), size=64, lw=6))
+
+
+class ImageShardsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.csv_dir, self.shard_dir = os.path.join(tmp.name, 'csv'), os.path.join(tmp.name, 'shards')
+        os.makedirs(self.csv_dir)
+
+        self.drawings = {0: synthetic_drawings(25, seed=3), 1: synthetic_drawings(10, seed=4)}
+        self.labels = {0: np.arange(25) % 7, 1: np.arange(10) + 100}
+        for k in self.drawings:
+            write_csv_shard(self.csv_dir, k, self.drawings[k], self.labels[k])
+
+    def test_round_trip(self):
+        manifest = build_image_shards(self.csv_dir, self.shard_dir, ks=[0, 1], size=32, lw=3, chunksize=8)
+        self.assertEqual(manifest, {'size': 32, 'lw': 3, 'backend': 'cv2', 'shards': {'0': 25, '1': 10}})
+        self.assertEqual(read_manifest(self.shard_dir), manifest)
+
+        dataset = ShardDataset(self.shard_dir)
+        self.assertEqual((dataset.size, dataset.ks, len(dataset)), (32, [0, 1], 35))
+        self.assertEqual(dataset.steps_per_epoch(8), 4 + 2)
+
+        for k in (0, 1):
+            with self.subTest(k=k):
+                images, labels = dataset.shard(k)
+                self.assertIsInstance(images, np.memmap)
+                self.assertIsInstance(labels, np.memmap)
+                self.assertEqual((images.shape, images.dtype), ((len(self.drawings[k]), 32, 32), np.uint8))
+                self.assertEqual((labels.shape, labels.dtype), ((len(self.drawings[k]),), np.int16))
+                np.testing.assert_array_equal(labels, self.labels[k])
+                np.testing.assert_array_equal(images, rasterize_batch(*pack_drawings(self.drawings[k]), size=32, lw=3))
+
+    def test_resume_and_parameter_mismatch(self):
+        build_image_shards(self.csv_dir, self.shard_dir, ks=[0], size=32, lw=3)
+        os.remove(os.path.join(self.csv_dir, 'train_k0.csv.gz'))
+
+        # shard 0 is in the manifest and never read again
+        manifest = build_image_shards(self.csv_dir, self.shard_dir, ks=[0, 1], size=32, lw=3)
+        self.assertEqual(manifest['shards'], {'0': 25, '1': 10})
+        self.assertTrue(all(os.path.exists(path) for path in shard_paths(self.shard_dir, 1)))
+
+        with self.assertRaises(ValueError):
+            build_image_shards(self.csv_dir, self.shard_dir, ks=[0, 1], size=64, lw=3)
+
+
+class ShuffledShardsTestCase(unittest.TestCase):
+
+    ncsvs = 4
+
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.tmp = tmp.name
+        self.input_dir = os.path.join(tmp.name, 'dataset')
+        os.makedirs(self.input_dir)
+
+        # mixed case names, DataGenerator.ipynb sorts them case-insensitively to assign `y`
+        for i, word in enumerate(['cat', 'Apple', 'bus']):
+            n = 20 + 7 * i
+            pd.DataFrame({
+                'countrycode': 'US',
+                'drawing': [json.dumps(drawing) for drawing in synthetic_drawings(n, seed=10 + i)],
+                'key_id': (np.arange(n) * 3 + i) * 10 ** 7 + 12345,
+                'recognized': True,
+                'word': word,
+            }).to_csv(os.path.join(self.input_dir, word + '.csv'), index=False)
+
+    def build(self, name, **kwargs):
+        output_dir = os.path.join(self.tmp, name)
+        kwargs = dict({'ncsvs': self.ncsvs, 'workers': 2}, **kwargs)
+        with mock.patch('builtins.print'):
+            build_shuffled_shards(self.input_dir, output_dir, **kwargs)
+        return output_dir
+
+    def read_shards(self, output_dir):
+        return [pd.read_csv(os.path.join(output_dir, 'train_k{}.csv.gz'.format(k))) for k in range(self.ncsvs)]
+
+    def test_every_row_exactly_once(self):
+        output_dir = self.build('shuffled')
+        shards = self.read_shards(output_dir)
+
+        self.assertEqual(list_categories(self.input_dir), ['Apple', 'bus', 'cat'])
+        self.assertFalse(os.path.exists(os.path.join(output_dir, 'parts')))
+        self.assertEqual({k: len(df) for k, df in enumerate(shards)},
+                         {int(k): rows for k, rows in read_manifest(output_dir)['shards'].items()})
+
+        rows = pd.concat(shards, ignore_index=True)
+        self.assertEqual(list(rows.columns), ['countrycode', 'drawing', 'recognized', 'word', 'y', 'cv'])
+        self.assertTrue((rows['y'] == rows['word'].map({'Apple': 0, 'bus': 1, 'cat': 2})).all())
+        for k, df in enumerate(shards):
+            self.assertTrue((df['cv'] == k).all())
+
+        for word in ('Apple', 'bus', 'cat'):
+            with self.subTest(word=word):
+                source = pd.read_csv(os.path.join(self.input_dir, word + '.csv'))
+                self.assertEqual(sorted(rows.loc[rows['word'] == word, 'drawing']), sorted(source['drawing']))
+
+    def test_deterministic(self):
+        first = self.read_shards(self.build('first', seed=5))
+        second = self.read_shards(self.build('second', seed=5, workers=1))
+        other = self.read_shards(self.build('other', seed=6))
+
+        for a, b in zip(first, second):
+            pd.testing.assert_frame_equal(a, b)
+        self.assertFalse(all(a.equals(b) for a, b in zip(first, other)))
+
+    def test_resume(self):
+        expected = self.read_shards(self.build('expected'))
+
+        # a directory in place of shard 1 makes its merge fail after every category was partitioned
+        output_dir = os.path.join(self.tmp, 'resumed')
+        os.makedirs(os.path.join(output_dir, 'train_k1.csv.gz'))
+        with self.assertRaises(OSError):
+            self.build('resumed')
+
+        manifest = read_manifest(output_dir)
+        self.assertEqual(sorted(manifest['partitioned']), ['Apple', 'bus', 'cat'])
+        self.assertNotIn('1', manifest['shards'])
+
+        os.rmdir(os.path.join(output_dir, 'train_k1.csv.gz'))
+        with mock.patch('doodle_data.shuffle.partition_category') as partition_category:
+            self.build('resumed')
+        partition_category.assert_not_called()
+
+        for a, b in zip(expected, self.read_shards(output_dir)):
+            pd.testing.assert_frame_equal(a, b)
+
+        with self.assertRaises(ValueError):
+            self.build('resumed', seed=1)
+
+
+class ExportTestCase(unittest.TestCase):
+
+    def test_export_pngs(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        input_dir, output_dir = os.path.join(tmp.name, 'dataset'), os.path.join(tmp.name, 'images')
+        os.makedirs(input_dir)
+
+        drawings = {'cat': synthetic_drawings(7, seed=6), 'The Eiffel Tower': synthetic_drawings(3, seed=7)}
+        for word, rows in drawings.items():
+            pd.DataFrame({'drawing': [json.dumps(drawing) for drawing in rows], 'word': word}).to_csv(
+                os.path.join(input_dir, word + '.csv'), index=False)
+
+        with mock.patch('builtins.print'):
+            manifest = export_pngs(input_dir, output_dir, chunksize=3, workers=2)
+        self.assertEqual(manifest['categories'], {'cat': 7, 'The Eiffel Tower': 3})
+        self.assertEqual(manifest['chunks'], {})
+
+        for word, rows in drawings.items():
+            with self.subTest(word=word):
+                files = sorted(os.listdir(os.path.join(output_dir, word)))
+                self.assertEqual(files, sorted('{}_{}.png'.format(word, i) for i in range(len(rows))))
+
+                # draw_it's black strokes on white at 256x256, one single channel PNG per csv row
+                for i, drawing in enumerate(rows):
+                    path = os.path.join(output_dir, word, '{}_{}.png'.format(word, i))
+                    image = cv2.imread(path, cv2.IMREAD_UNCHANGED)
+                    self.assertEqual((image.shape, image.dtype), ((256, 256), np.uint8))
+                    np.testing.assert_array_equal(image, draw_it(drawing, size=256, lw=5))
+
+        # a rerun finds every category in the manifest and renders nothing
+        with mock.patch('builtins.print'), mock.patch('doodle_data.export.export_chunk') as export_chunk:
+            self.assertEqual(export_pngs(input_dir, output_dir, chunksize=3, workers=2), manifest)
+        export_chunk.assert_not_called()
+
+
+def put_entries(root, worker, n):
+    cache = RenderCache(root)
+    for i in range(n):
+        cache.put('{}-{}'.format(worker, i), np.full((2, 4, 4), i, np.uint8), source='worker {}'.format(worker))
+
+
+def put_same_key(root, worker):
+    RenderCache(root).put('shared', np.full((200, 64, 64), worker, np.uint8), source='worker {}'.format(worker))
+
+
+class RenderCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.TemporaryDirectory()
+        self.addCleanup(self.root.cleanup)
+
+    def test_concurrent_writers_keep_every_entry(self):
+        workers, n = 4, 25
+        processes = [multiprocessing.Process(target=put_entries, args=(self.root.name, worker, n))
+                     for worker in range(workers)]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join(30)
+            self.assertEqual(process.exitcode, 0)
+
+        self.assertEqual(len(read_manifest(self.root.name)['entries']), workers * n)
+
+    def test_concurrent_writers_of_the_same_key(self):
+        processes = [multiprocessing.Process(target=put_same_key, args=(self.root.name, worker)) for worker in range(4)]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join(30)
+            self.assertEqual(process.exitcode, 0)
+
+        # one writer's array in full, never a mix of several or a temporary file left behind
+        images = np.load(os.path.join(self.root.name, 'entries', 'shared.npy'))
+        self.assertEqual(images.shape, (200, 64, 64))
+        self.assertEqual(len(np.unique(images)), 1)
+        self.assertEqual(os.listdir(os.path.join(self.root.name, 'entries')), ['shared.npy'])
+
+    def test_failed_render_leaves_no_temporary_file(self):
+        csv_path = os.path.join(self.root.name, 'train_k0.csv.gz')
+        pd.DataFrame({'drawing': ['[[[0,10],[0,10]]]', '[[[1.5],[2]]]'], 'y': [0, 1]}).to_csv(csv_path, index=False)
+
+        cache = RenderCache(self.root.name)
+        with self.assertRaises(ValueError):
+            cache.render_csv(csv_path, size=16)
+        self.assertEqual(os.listdir(os.path.join(self.root.name, 'entries')), [])
+
+    def test_unregistered_entry_is_registered_on_a_hit(self):
+        cache = RenderCache(self.root.name)
+        images = cache.render_drawings(['[[[0,10],[0,10]]]'], size=16)
+        write_manifest(self.root.name, {'entries': {}, 'sources': {}})
+
+        np.testing.assert_array_equal(cache.render_drawings(['[[[0,10],[0,10]]]'], size=16), images)
+        entry, = read_manifest(self.root.name)['entries'].values()
+        self.assertEqual((entry['size'], entry['bytes']), (16, images.nbytes + 128))
+
+    def test_eviction(self):
+        cache = RenderCache(self.root.name, max_bytes=1100)
+        for key in 'abc':
+            cache.put(key, np.zeros(400, np.uint8), source=key)
+        cache.get('b')
+        cache.put('d', np.zeros(400, np.uint8), source='d')
+
+        self.assertEqual(sorted(read_manifest(self.root.name)['entries']), ['b', 'd'])
+        self.assertEqual(sorted(os.listdir(os.path.join(self.root.name, 'entries'))), ['b.npy', 'd.npy'])
+
+
+class QuantizeTestCase(unittest.TestCase):
+
+    def shards(self, **render):
+        shard_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(shard_dir.cleanup)
+
+        images_path, labels_path = shard_paths(shard_dir.name, 0)
+        np.save(images_path, np.full((10, render['size'], render['size']), 255, np.uint8))
+        np.save(labels_path, np.zeros(10, np.int16))
+        write_manifest(shard_dir.name, dict(render, shards={'0': 10}))
+        return shard_dir.name
+
+    def test_calibration_shards_match_the_served_model(self):
+        images = sample_images(self.shards(**SERVED_RENDER), 4)
+        self.assertEqual(images.shape, (4, 64, 64, 1))
+        self.assertEqual(images.max(), 1)
+
+        for render in [dict(SERVED_RENDER, backend='cv2'), dict(SERVED_RENDER, lw=6), dict(SERVED_RENDER, size=32)]:
+            with self.subTest(render=render), self.assertRaises(ValueError):
+                sample_images(self.shards(**render), 4)
+
+        self.assertEqual(len(sample_images(self.shards(**dict(SERVED_RENDER, lw=6)), 4,
+                                           render=dict(SERVED_RENDER, lw=6))), 4)
+
+    def test_import_without_resource(self):
+        # windows has no resource module
+        script = 'import sys; sys.modules["resource"] = None; import doodle_data.quantize as q; print(q._rss_mb())'
+        subprocess.run([sys.executable, '-c', script], cwd=os.path.dirname(os.path.dirname(__file__)), check=True,
+                       capture_output=True)
+
+    def test_report_without_memory(self):
+        stats = {'file_mb': 1, 'load_s': 1, 'rss_mb': None, 'peak_rss_mb': None, 'single_p50_ms': 1,
+                 'single_p95_ms': 1, 'batch_images_per_s': 1}
+        report = {'samples': 1, 'top1_agreement': 1, 'top3_agreement': 1, 'max_abs_diff': 0, 'keras': stats,
+                  'tflite': dict(stats, rss_mb=12.5, peak_rss_mb=40)}
+
+        lines = format_report(report).splitlines()
+        self.assertEqual(lines[2].split()[3:5], ['-', '-'])
+        self.assertEqual(lines[3].split()[3:5], ['12.5', '40.0'])
+
+
+class ArtifactVersionTestCase(unittest.TestCase):
+
+    def test_version_follows_the_content(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            paths = [os.path.join(tmp, name) for name in ('a.h5', 'b.h5', 'c.h5')]
+            for path, content in zip(paths, [b'weights', b'weights', b'other weights']):
+                with open(path, 'wb') as f:
+                    f.write(content)
+
+            versions = [artifact_version('keras', path) for path in paths]
+
+        self.assertEqual(versions[0], versions[1])
+        self.assertNotEqual(versions[0], versions[2])
+        self.assertTrue(versions[0].startswith('keras:'))
+
+
+if __name__ == '__main__':
+    unittest.main()